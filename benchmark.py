@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+
+"""Benchmarks the stages of create_par2.py one at a time on reproducible synthetic data sets.
+
+'generate' writes a data set, 'run' times each stage on it and writes the results as JSON, and
+'compare' compares two such JSON files to find stages that got slower."""
+
+import argparse
+import sys
+import os
+import tempfile
+import shutil
+import random
+import binascii
+import fractions
+import decimal
+import json
+import time
+import platform
+import contextlib
+
+import create_par2
+
+BENCHMARK_VERSION = 1
+DATASET_MANIFEST_FILENAME = "dataset.json"
+
+GENERATE_BUFFER_SIZE = 1024*1024
+
+JPEG_HEADER = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00"
+
+# Each profile maps to a list of (fraction of the total size, kind, minimum size, maximum size).
+# File sizes are drawn log-uniformly between the minimum and the maximum.
+DATASET_PROFILES = {
+    "photos": [(1.0, "jpeg", 1500*1000, 8*1000*1000)],
+    "videos": [(1.0, "video", 200*1000*1000, 2000*1000*1000)],
+    "mixed": [(0.6, "jpeg", 1500*1000, 8*1000*1000),
+              (0.39, "video", 50*1000*1000, 1000*1000*1000),
+              (0.01, "text", 2*1000, 50*1000)],
+}
+
+STAGES = ["distribute", "block_size", "count_blocks", "stage", "compress", "par2_builtin", "par2", "place",
+          "md5", "verify"]
+
+
+def find_executable(name):
+    which = getattr(shutil, "which", None)
+    if which is None:
+        # Python 2
+        import distutils.spawn
+        which = distutils.spawn.find_executable
+    return which(name)
+
+
+def random_bytes(rng, n):
+    if n == 0:
+        return b""
+    return binascii.unhexlify(("%0*x" % (2 * n, rng.getrandbits(8 * n))).encode("ascii"))
+
+
+def write_synthetic_file(path, kind, size, rng):
+    """Writes a file of the given size. 'jpeg' files start with a JPEG header and some
+    compressible metadata followed by incompressible data, 'video' files are all
+    incompressible, and 'text' files are very compressible."""
+    with open(path, "wb") as f:
+        written = 0
+        if kind == "jpeg":
+            metadata = JPEG_HEADER + b"Exif\x00\x00" + b"\x00" * min(size // 50, 64*1024)
+            f.write(metadata[:size])
+            written = min(size, len(metadata))
+        while written < size:
+            n = min(GENERATE_BUFFER_SIZE, size - written)
+            if kind == "text":
+                words = [b"lorem", b"ipsum", b"dolor", b"sit", b"amet", b"photo", b"album", b"2017"]
+                # getrandbits, unlike choice, gives the same results on all versions of Python.
+                chunk = b" ".join(words[rng.getrandbits(3)] for i in range(n // 5 + 1))[:n]
+            else:
+                chunk = random_bytes(rng, n)
+            f.write(chunk)
+            written += n
+
+
+def generate_dataset(outdir, profile, total_size, seed):
+    """Writes a data set of about total_size bytes into outdir, along with a manifest. The
+    same profile, size and seed always give the same files."""
+    rng = random.Random(seed)
+    files = []
+    for fraction, kind, min_size, max_size in DATASET_PROFILES[profile]:
+        kind_total = int(total_size * fraction)
+        kind_size = 0
+        while kind_size < kind_total:
+            size = int(min_size * (float(max_size) / min_size) ** rng.random())
+            size = min(size, kind_total - kind_size)
+            extension = {"jpeg": ".jpg", "video": ".mp4", "text": ".txt"}[kind]
+            files.append(("%s%05d%s" % (kind, len(files) + 1, extension), kind, size))
+            kind_size += size
+
+    for name, kind, size in files:
+        write_synthetic_file(os.path.join(outdir, name), kind, size, rng)
+
+    manifest = {"profile": profile, "seed": seed, "total_size": sum(f[2] for f in files),
+                "files": [[name, size] for name, kind, size in files]}
+    with open(os.path.join(outdir, DATASET_MANIFEST_FILENAME), "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True, separators=(",", ": "))
+    return manifest
+
+
+@contextlib.contextmanager
+def redirected_stdout(verbose):
+    """Hides what the stages print, unless verbose is set."""
+    if verbose:
+        yield
+        return
+    saved = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = saved
+
+
+@contextlib.contextmanager
+def measured_stage(results, name, num_bytes, verbose=False):
+    """Runs a stage measured by create_par2.metrics and adds the measurements to results. The
+    dict it gives can be used to add more facts about the stage."""
+    with redirected_stdout(verbose):
+        with create_par2.metrics.stage(name, num_bytes) as entry:
+            yield entry
+    results.append(entry)
+
+
+def skip_stage(results, name, reason):
+    results.append({"name": name, "skipped": reason})
+
+
+def run_stages(datadir, workdir, args):
+    """Runs each stage of create_par2.py on its own on the files in datadir and returns a list
+    with the measurements of each stage."""
+    results = []
+    infiles = sorted(os.path.join(datadir, f) for f in os.listdir(datadir)
+                        if f != DATASET_MANIFEST_FILENAME)
+    file_sizes = dict((f, os.path.getsize(f)) for f in infiles)
+    total_size = sum(file_sizes.values())
+    redundancy = decimal.Decimal(args.redundancy)
+    redundancy_fraction = fractions.Fraction(redundancy) / args.num_volumes
+    prefix = "bench_"
+
+    with measured_stage(results, "distribute", total_size, args.verbose) as t:
+        last_bin_size_fraction = redundancy % 1 or 1
+        bins, bin_sizes = create_par2.distribute_files_uniformly(
+                file_sizes, args.num_volumes - int(redundancy), last_bin_size_fraction)
+    adjusted_bin_sizes = bin_sizes[:-1] + [int(bin_sizes[-1] / last_bin_size_fraction)]
+    t["unevenness"] = max(adjusted_bin_sizes) / (float(sum(adjusted_bin_sizes)) / len(adjusted_bin_sizes))
+
+    num_sets = create_par2.get_num_recovery_sets(file_sizes, args.num_volumes, redundancy_fraction)
+    infiles_per_set = create_par2.split_into_recovery_sets(infiles, file_sizes, num_sets)
+
+    with measured_stage(results, "block_size", total_size, args.verbose) as t:
+        block_sizes = [create_par2.get_suitable_block_size(dict((f, file_sizes[f]) for f in set_files),
+                            redundancy_fraction=redundancy_fraction, jobs=args.jobs)
+                        for set_files in infiles_per_set]
+    t["block_sizes"] = block_sizes
+
+    with measured_stage(results, "count_blocks", total_size, args.verbose) as t:
+        num_data_blocks = [create_par2.get_total_num_blocks([file_sizes[f] for f in set_files], block_size)
+                            for set_files, block_size in zip(infiles_per_set, block_sizes)]
+    padding = sum(n * block_size for n, block_size in zip(num_data_blocks, block_sizes)) - total_size
+    t.update({"num_recovery_sets": num_sets, "num_data_blocks": num_data_blocks,
+                    "padding_bytes": padding, "padding_ratio": float(padding) / total_size})
+
+    set_dirs = [os.path.join(workdir, "set%d" % (i+1)) for i in range(num_sets)]
+    for set_dir in set_dirs:
+        os.mkdir(set_dir)
+    with measured_stage(results, "stage", total_size, args.verbose) as t:
+        for set_dir, set_files in zip(set_dirs, infiles_per_set):
+            create_par2.stage_files(set_files, set_dir, args.staging)
+    t["staging_mode"] = args.staging
+
+    if find_executable("7z") is None:
+        skip_stage(results, "compress", "7z not found")
+    else:
+        compressed_dir = os.path.join(workdir, "compressed")
+        os.mkdir(compressed_dir)
+        policy = create_par2.CompressionPolicy(sample=not args.compress_all)
+        with measured_stage(results, "compress", total_size, args.verbose) as t:
+            create_par2.compress_files(infiles, compressed_dir, workdir, None, jobs=args.jobs, policy=policy)
+        t["num_stored"] = policy.get_totals()[0][0]
+        compressed_size = sum(os.path.getsize(os.path.join(compressed_dir, f)) for f in os.listdir(compressed_dir))
+        t["compression_ratio"] = float(compressed_size) / total_size
+        shutil.rmtree(compressed_dir)
+
+    par2_filenames = [create_par2.get_par2_filename(prefix, i, num_sets) for i in range(num_sets)]
+    num_recovery_blocks = [create_par2.get_num_recovery_blocks(n, redundancy_fraction) for n in num_data_blocks]
+
+    # The builtin engine is also run on the same recovery sets, to compare it with par2 on the
+    # same machine. Its par2 files are removed again before the par2 stage.
+    if args.par2_engine != "builtin":
+        if create_par2.numpy is None:
+            skip_stage(results, "par2_builtin", "NumPy not found")
+        else:
+            with measured_stage(results, "par2_builtin", total_size, args.verbose):
+                for set_dir, par2_filename, block_size, n in zip(set_dirs, par2_filenames, block_sizes,
+                                                                num_recovery_blocks):
+                    create_par2.create_par2_files(set_dir, par2_filename, num_recovery_blocks=n,
+                            block_size=block_size, num_blocks=None, memory=None, engine="builtin",
+                            jobs=args.jobs, quiet=not args.verbose)
+            for set_dir in set_dirs:
+                for f in os.listdir(set_dir):
+                    if create_par2.is_par2_file(f):
+                        os.remove(os.path.join(set_dir, f))
+
+    if args.par2_engine == "builtin" and create_par2.numpy is None:
+        skip_stage(results, "par2", "NumPy not found")
+        return results
+    if args.par2_engine != "builtin" and find_executable("par2") is None:
+        skip_stage(results, "par2", "par2 not found")
+        return results
+    with measured_stage(results, "par2", total_size, args.verbose) as t:
+        for set_dir, par2_filename, block_size, n in zip(set_dirs, par2_filenames, block_sizes, num_recovery_blocks):
+            create_par2.create_par2_files(set_dir, par2_filename, num_recovery_blocks=n,
+                    block_size=block_size, num_blocks=None, memory=None, engine=args.par2_engine,
+                    jobs=args.jobs, quiet=not args.verbose)
+    par2_size = sum(os.path.getsize(os.path.join(d, f)) for d in set_dirs for f in os.listdir(d)
+                        if create_par2.is_par2_file(f))
+    t["overhead_ratio"] = float(par2_size) / total_size
+
+    outdir = os.path.join(workdir, "out")
+    os.mkdir(outdir)
+    with measured_stage(results, "place", total_size + par2_size, args.verbose) as t:
+        for set_dir, par2_filename in zip(set_dirs, par2_filenames):
+            create_par2.move_files_to_destination_dir(set_dir, outdir, par2_filename, prefix,
+                    args.num_volumes, args.staging)
+    volume_sizes = create_par2.get_size_statistics(outdir, prefix, args.num_volumes)[0]
+    t["volume_unevenness"] = max(volume_sizes) / (float(sum(volume_sizes)) / len(volume_sizes))
+
+    with measured_stage(results, "md5", total_size + par2_size, args.verbose):
+        create_par2.create_md5_sums(outdir, prefix, args.num_volumes, jobs=args.jobs)
+
+    with measured_stage(results, "verify", total_size + par2_size, args.verbose) as t:
+        # Unsuitable data sets (e.g. a small 'mixed' one) are measured all the same.
+        try:
+            create_par2.verify(outdir, prefix, args.num_volumes)
+            t["recoverable"] = True
+        except SystemExit:
+            t["recoverable"] = False
+
+    return results
+
+
+def run_benchmark(args):
+    with open(os.path.join(args.datadir, DATASET_MANIFEST_FILENAME)) as f:
+        manifest = json.load(f)
+
+    best = {}
+    for i in range(args.repeat):
+        workdir = tempfile.mkdtemp(prefix="benchmark_", dir=args.tmpdir)
+        try:
+            for result in run_stages(args.datadir, workdir, args):
+                previous = best.get(result["name"])
+                if previous is None or result.get("wall_seconds", 0) < previous.get("wall_seconds", 0):
+                    best[result["name"]] = result
+        finally:
+            shutil.rmtree(workdir)
+
+    report = {"benchmark_version": BENCHMARK_VERSION,
+              "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "machine": {"platform": platform.platform(), "python": platform.python_version(),
+                          "cpu_count": create_par2.get_default_num_jobs()},
+              "dataset": {"profile": manifest["profile"], "seed": manifest["seed"],
+                          "num_files": len(manifest["files"]), "total_size": manifest["total_size"]},
+              "parameters": {"num_volumes": args.num_volumes, "redundancy": args.redundancy,
+                             "jobs": args.jobs, "par2_engine": args.par2_engine, "staging": args.staging,
+                             "repeat": args.repeat},
+              "stages": [best[name] for name in STAGES if name in best]}
+
+    for result in report["stages"]:
+        if "skipped" in result:
+            print("%-13s skipped (%s)" % (result["name"], result["skipped"]))
+        else:
+            print("%-13s %8.2f s wall %8.2f s CPU %8.2f s child CPU %9.1f MB/s" % (
+                    result["name"], result["wall_seconds"], result["cpu_seconds"],
+                    result["child_cpu_seconds"], result["mb_per_second"] or 0))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+
+def compare_benchmarks(args):
+    """Prints the change in wall time of each stage and returns the number of stages that got
+    slower by more than the threshold."""
+    with open(args.old) as f:
+        old = dict((r["name"], r) for r in json.load(f)["stages"])
+    with open(args.new) as f:
+        new = dict((r["name"], r) for r in json.load(f)["stages"])
+
+    num_regressions = 0
+    for name in STAGES:
+        if name not in old or name not in new or "skipped" in old[name] or "skipped" in new[name]:
+            continue
+        old_wall = old[name]["wall_seconds"]
+        new_wall = new[name]["wall_seconds"]
+        change = 100.0 * (new_wall - old_wall) / old_wall if old_wall > 0 else 0.0
+        regression = change > args.threshold and new_wall - old_wall > args.min_seconds
+        num_regressions += regression
+        print("%-13s %8.2f s -> %8.2f s %+7.1f %%%s" % (name, old_wall, new_wall, change,
+                " REGRESSION" if regression else ""))
+    return num_regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=(
+        "Benchmark the stages of create_par2.py on synthetic data sets."))
+    subparsers = parser.add_subparsers(dest="command")
+
+    generate_parser = subparsers.add_parser("generate", help="Generate a synthetic data set.")
+    generate_parser.add_argument("outdir", metavar="DIR",
+            help="Directory to write the data set to. It must not exist.")
+    generate_parser.add_argument("--profile", choices=sorted(DATASET_PROFILES), default="mixed",
+            help="'photos' is many JPEG-like files of a few MB, 'videos' is a few huge incompressible "
+                    "files, and 'mixed' is both plus some small text files. Default: %(default)s.")
+    generate_parser.add_argument("--size", metavar="MEGABYTES", type=create_par2.check_integer_equal_or_greater(1),
+            default=1000,
+            help="Approximate total size of the data set. Default: %(default)s.")
+    generate_parser.add_argument("--seed", type=int, default=1,
+            help="Seed of the random generator. Default: %(default)s.")
+
+    run_parser = subparsers.add_parser("run", help="Run each stage on a data set.")
+    run_parser.add_argument("datadir", metavar="DIR",
+            help="Directory with a data set created by 'generate'.")
+    run_parser.add_argument("--json", metavar="FILE",
+            help="Write the results to this file.")
+    run_parser.add_argument("-t", "--tmpdir", metavar="DIR",
+            help="Where to create the working directory. Default: the system temporary directory.")
+    run_parser.add_argument("--num-volumes", type=create_par2.check_integer_equal_or_greater(3), default=7,
+            help="Default: %(default)s.")
+    run_parser.add_argument("--redundancy", default="1.1",
+            help="Default: %(default)s.")
+    run_parser.add_argument("-j", "--jobs", type=create_par2.check_integer_equal_or_greater(1),
+            default=create_par2.get_default_num_jobs(),
+            help="Default: %(default)s.")
+    run_parser.add_argument("--par2-engine", choices=create_par2.PAR2_ENGINES, default="par2",
+            help="Default: %(default)s.")
+    run_parser.add_argument("--staging", choices=create_par2.STAGING_MODES, default="copy",
+            help="Default: %(default)s, to measure the cost of copying the data.")
+    run_parser.add_argument("--compress-all", action="store_true",
+            help="Compress all files, like create_par2.py --compress-all, instead of only storing "
+                    "those that don't shrink.")
+    run_parser.add_argument("--repeat", type=create_par2.check_integer_equal_or_greater(1), default=1,
+            help="Run all stages this many times and keep the fastest time of each stage. "
+                    "Default: %(default)s.")
+    run_parser.add_argument("-v", "--verbose", action="store_true",
+            help="Show what the stages print.")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare the results of two runs.")
+    compare_parser.add_argument("old", metavar="OLD_JSON")
+    compare_parser.add_argument("new", metavar="NEW_JSON")
+    compare_parser.add_argument("--threshold", metavar="PERCENT", type=float, default=10.0,
+            help="Report stages that got this much slower. Default: %(default)s.")
+    compare_parser.add_argument("--min-seconds", metavar="SECONDS", type=float, default=0.1,
+            help="Ignore changes smaller than this. Default: %(default)s.")
+
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        if os.path.exists(args.outdir):
+            create_par2.print_wrap("%r already exists." % args.outdir)
+            raise SystemExit(1)
+        os.makedirs(args.outdir)
+        manifest = generate_dataset(args.outdir, args.profile, args.size * 1000 * 1000, args.seed)
+        print("Generated %d files, %d bytes" % (len(manifest["files"]), manifest["total_size"]))
+    elif args.command == "run":
+        run_benchmark(args)
+    elif args.command == "compare":
+        if compare_benchmarks(args):
+            raise SystemExit(1)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -12,95 +12,1252 @@ import itertools
 import math
 import decimal
 import fractions
-import glob
 import time
+import threading
+import multiprocessing
+import errno
+import struct
+import hashlib
+import binascii
+import zlib
+import collections
+import heapq
+import json
+import bisect
+import operator
+import tarfile
+import fnmatch
+import stat
+import contextlib
+import cProfile
+import pstats
+import traceback
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 MAX_NUM_BLOCKS = 32700
 
+# Larger inputs are split into several independent par2 recovery sets.
+MAX_NUM_FILES_PER_RECOVERY_SET = 6000
+MAX_NUM_BLOCKS_PER_RECOVERY_SET = 20000
+
+# ioctl request to make a file share the data blocks of another (reflink), see ioctl_ficlone(2).
+FICLONE = 0x40049409
+# The same for a range of a file, see ioctl_ficlonerange(2).
+FICLONERANGE = 0x4020940d
+
+COPY_BUFFER_SIZE = 1024*1024
+HASH_BUFFER_SIZE = 4*1024*1024
+MEDIA_READ_BUFFER_SIZE = 16*1024*1024
+
+MD5SUM_FILENAME = "MD5SUM"
+SPLIT_MANIFEST_FILENAME = "SPLIT_FILES"
+
+# Files larger than the part size are split into parts, so that no file is too large for the
+# volumes to be balanced. By default the part size is about this fraction of the data per volume.
+SPLIT_PARTS_PER_VOLUME = 8
+MIN_SPLIT_PART_SIZE = 1024*1024
+
+# Small files can be packed into tar containers of the same size as the parts of split files.
+PACKED_MANIFEST_FILENAME = "PACKED_FILES"
+PACKED_CONTAINER_NAME = "packed_files_%03d.tar"
+TAR_BLOCK_SIZE = 512
+# A tar archive ends with two zero filled blocks.
+TAR_END_SIZE = 2 * TAR_BLOCK_SIZE
+
+# Before a file is compressed, this many windows of this size spread over it are compressed with
+# zlib. If they don't shrink to less than INCOMPRESSIBLE_RATIO of their size, the file is only
+# stored in its archive.
+COMPRESSION_SAMPLE_SIZE = 64*1024
+COMPRESSION_NUM_SAMPLES = 4
+INCOMPRESSIBLE_RATIO = 0.95
+
+STAGING_MODES = ["auto", "reflink", "hardlink", "copy"]
+
+# See ECMA-119 (ISO 9660) and the Joliet specification. Files larger than an extent are recorded
+# as several extents (ISO 9660 level 3).
+ISO_SECTOR_SIZE = 2048
+ISO_MAX_EXTENT_SIZE = 0xFFFFF800
+ISO_FIRST_PATH_TABLE_SECTOR = 19
+# ISO 9660 allows eight levels of directories, counting the root directory.
+ISO_MAX_DIRECTORY_DEPTH = 7
+ISO_JOLIET_MAX_NAME_LENGTH = 64
+ISO_JOLIET_FORBIDDEN_CHARACTERS = "*/:;?\\"
+# The names that check_iso_filename accepts, in a single regexp that doesn't look at each
+# character in Python (names that don't match get the full check).
+iso_filename_regexp = re.compile(r"(?:[^%s]{1,%d}%s){0,%d}[^%s]{1,%d}\Z" % (
+        re.escape(ISO_JOLIET_FORBIDDEN_CHARACTERS + os.sep), ISO_JOLIET_MAX_NAME_LENGTH, re.escape(os.sep),
+        ISO_MAX_DIRECTORY_DEPTH, re.escape(ISO_JOLIET_FORBIDDEN_CHARACTERS + os.sep), ISO_JOLIET_MAX_NAME_LENGTH))
+
+# The capacity of recordable media, in bytes, using the smallest of the variants (e.g. DVD-R
+# and DVD+R) of each.
+MEDIA_CAPACITIES = {
+    "cd": 359844 * ISO_SECTOR_SIZE,
+    "dvd": 2295104 * ISO_SECTOR_SIZE,
+    "dvd-dl": 4171712 * ISO_SECTOR_SIZE,
+    "bd": 12219392 * ISO_SECTOR_SIZE,
+    "bd-dl": 24438784 * ISO_SECTOR_SIZE,
+}
+
+# See the par2 specification, http://parchive.sourceforge.net/docs/specifications/parity-volume-spec/article-spec.html
+PAR2_PACKET_MAGIC = b"PAR2\0PKT"
+PAR2_PACKET_HEADER = struct.Struct("<8sQ16s16s16s")
+PAR2_MAIN_PACKET = b"PAR 2.0\0Main\0\0\0\0"
+PAR2_FILE_DESCRIPTION_PACKET = b"PAR 2.0\0FileDesc"
+PAR2_RECOVERY_SLICE_PACKET = b"PAR 2.0\0RecvSlic"
+PAR2_INPUT_FILE_SLICE_CHECKSUM_PACKET = b"PAR 2.0\0IFSC\0\0\0\0"
+PAR2_CREATOR_PACKET = b"PAR 2.0\0Creator\0"
+PAR2_CREATOR = b"Created by create_par2.py"
 
-ignore_files_regexps = map(re.compile, [
-    r"^\.DS_Store$"
-])
+PAR2_ENGINES = ["par2", "par2-split", "builtin"]
+
+# The memory a par2 process needs besides its recovery blocks, e.g. to read the input files.
+PAR2_PROCESS_MEMORY = 64*1024*1024
+
+# par2 does its Reed-Solomon arithmetic in GF(2^16) with this generator polynomial.
+GF16_GENERATOR = 0x1100B
+GF16_ORDER = 65535
+
+
+# Files with names matching these shell patterns are never included in the volumes.
+IGNORED_FILE_PATTERNS = [
+    ".DS_Store",
+]
+
+ignore_files_regexps = [re.compile(fnmatch.translate(pattern)) for pattern in IGNORED_FILE_PATTERNS]
 
 def filter_infiles(files):
     result = []
     for filename in files:
+        name = filename[filename.rfind(os.sep) + 1:]
         for regexp in ignore_files_regexps:
-            if regexp.match(filename):
+            if regexp.match(name):
                 break
         else:
             result.append(filename)
     return result
 
 
+def scan_directory(directory):
+    """Lists a directory in one pass. Returns the name and size of each regular file (or
+    symbolic link to one) and the names of the subdirectories (but not of symbolic links to
+    directories, so that a loop of links can't be followed forever). With scandir, the type of
+    each entry comes with the listing, so only the files are stat'ed. Without it each entry is
+    stat'ed once (twice if it is a symbolic link)."""
+    files = []
+    subdirs = []
+    if scandir is not None:
+        for entry in scandir(directory):
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif entry.is_file():
+                files.append((entry.name, entry.stat().st_size))
+        return files, subdirs
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                st = os.stat(path)
+            elif stat.S_ISDIR(st.st_mode):
+                subdirs.append(name)
+                continue
+        except OSError:
+            # A broken symbolic link, or the entry was removed after listing the directory.
+            continue
+        if stat.S_ISREG(st.st_mode):
+            files.append((name, st.st_size))
+    return files, subdirs
+
+
+def scan_files(directory, recursive=True, ignore=False, exclude_dirs=(), jobs=1):
+    """Returns a dict from the path relative to directory of each file in it, and with recursive
+    in its subdirectories, to its size, collected by scan_directory. The subdirectories of
+    directory are scanned by up to jobs threads at the same time. With ignore, files matching
+    IGNORED_FILE_PATTERNS are left out. Subdirectories whose absolute paths are in exclude_dirs
+    are skipped."""
+    def scan(relative_dir):
+        files, subdirs = scan_directory(os.path.join(directory, relative_dir))
+        if ignore:
+            names = set(filter_infiles([name for name, size in files]))
+            files = [(name, size) for name, size in files if name in names]
+        # Like os.path.join, without the cost of a call per file.
+        prefix = os.path.join(relative_dir, "") if relative_dir else ""
+        file_sizes = dict((prefix + name, size) for name, size in files)
+        subdirs = [os.path.join(relative_dir, name) for name in subdirs
+                    if os.path.abspath(os.path.join(directory, relative_dir, name)) not in exclude_dirs]
+        return file_sizes, subdirs
+
+    def scan_tree(relative_dir):
+        file_sizes = {}
+        pending = [relative_dir]
+        while pending:
+            tree_file_sizes, subdirs = scan(pending.pop())
+            file_sizes.update(tree_file_sizes)
+            pending.extend(subdirs)
+        return file_sizes
+
+    file_sizes, subdirs = scan("")
+    if recursive:
+        for tree_file_sizes in run_in_parallel(scan_tree, subdirs, jobs):
+            file_sizes.update(tree_file_sizes)
+    return file_sizes
+
+
+def list_files(directory):
+    """Returns the paths relative to directory of the files in it and its subdirectories, sorted."""
+    return sorted(scan_files(directory))
+
+
+def make_parent_dirs(path):
+    """Creates the directories path is in, if they don't exist."""
+    parent = os.path.dirname(path)
+    if parent and not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError as e:
+            # Another thread may have created it in the meantime.
+            if e.errno != errno.EEXIST:
+                raise
+
+
 
 class ExecutionFailed(Exception):
     pass
 
 
-def execute_and_throw_if_error(command, cwd, shell=False):
+def print_execution_output(e):
+    """Prints the output of the program that failed with ExecutionFailed e, if it was captured.
+    The output is bytes on Python 3, and is decoded to be shown as text."""
+    output = e.args[0] if e.args else None
+    if output:
+        if not isinstance(output, str):
+            output = output.decode("utf-8", "replace")
+        print(output.rstrip("\n"))
+
+
+def wait_for_process(process):
+    """Waits for a subprocess.Popen to finish and returns its return code and its resource
+    usage. The resource usage is taken from wait4, so that it isn't mixed up with that of other
+    programs running at the same time. It is None where wait4 isn't available."""
+    if not hasattr(os, "wait4"):
+        return process.wait(), None
+    while True:
+        try:
+            pid, status, rusage = os.wait4(process.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    # Tell the Popen object that the process is gone, so that it doesn't wait for it itself.
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return process.returncode, rusage
+
+
+def execute_and_throw_if_error(command, cwd, shell=False, quiet=False, description=None, num_bytes=None):
+    """Runs command and raises ExecutionFailed if it fails. If quiet is set the output of the
+    command is captured instead of written to the terminal, and passed on in the exception.
+    The run is recorded in metrics under description (the command line may contain a password)
+    with num_bytes (if given) as the amount of data processed, and the entry recorded is returned."""
     assert isinstance(command, str) == shell, "Must be a list and shell=False or a string and shell=True"
-    if shell:
-        return_code = subprocess.call(command, cwd=cwd, shell=True)
-    else:
-        return_code = subprocess.call([c for c in command if c is not None], cwd=cwd)
+    if not shell:
+        command = [c for c in command if c is not None]
+
+    start_time = time.time()
+    process = subprocess.Popen(command, cwd=cwd, shell=shell,
+            stdout=subprocess.PIPE if quiet else None, stderr=subprocess.STDOUT if quiet else None)
+    try:
+        # stderr goes to the same pipe, so reading stdout until the end can't block.
+        output = process.stdout.read() if quiet else None
+        return_code, rusage = wait_for_process(process)
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            process.wait()
+        raise
+    finally:
+        if quiet:
+            process.stdout.close()
+
+    program = os.path.split(command.split()[0] if shell else command[0])[-1]
+    entry = metrics.record_operation(program, description, time.time() - start_time, num_bytes, rusage)
 
     if return_code != 0:
-        raise ExecutionFailed()
+        raise ExecutionFailed(output)
+    return entry
+
+
+def get_default_num_jobs():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def read_process_io():
+    """Returns the I/O counters of this process, including those of the child processes it has
+    waited for, from /proc/self/io on Linux. rchar and wchar count all bytes read and written,
+    read_bytes and write_bytes only those that went to or from the disk. Returns None where
+    the counters aren't available."""
+    try:
+        with open("/proc/self/io") as f:
+            return dict((name.strip(), int(value)) for name, value in (line.split(":") for line in f))
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def get_max_rss_kb(rusage):
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    return rusage.ru_maxrss // 1024 if sys.platform == "darwin" else rusage.ru_maxrss
+
+
+def get_mb_per_second(num_bytes, seconds):
+    if num_bytes is None or seconds <= 0:
+        return None
+    return num_bytes / (1024.0 * 1024.0) / seconds
+
+
+class Metrics(object):
+    """Records the stages of a run and the programs (7z, par2) and file hashing run during
+    them, for --metrics-json. For each stage it records the wall time, the CPU time of this
+    process and of its child processes, the peak memory use so far, the bytes read and written
+    and the throughput. For each program and hashed file it records the wall time, and where
+    available the CPU time, peak memory use and disk I/O of the program.
+
+    It also profiles the Python code with cProfile for --profile, in the main thread and in the
+    threads started through profiled(). The processes of the builtin par2 engine aren't
+    profiled."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = []
+        self.operations = []
+        self.profiles = []
+        self.main_profile = None
+
+    def take_snapshot(self):
+        times = os.times()
+        snapshot = {"time": time.time(), "cpu": times[0] + times[1], "child_cpu": times[2] + times[3],
+                    "max_rss_kb": None, "io": read_process_io()}
+        if resource is not None:
+            own = resource.getrusage(resource.RUSAGE_SELF)
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            snapshot["cpu"] = own.ru_utime + own.ru_stime
+            snapshot["child_cpu"] = children.ru_utime + children.ru_stime
+            snapshot["max_rss_kb"] = max(get_max_rss_kb(own), get_max_rss_kb(children))
+        return snapshot
+
+    @contextlib.contextmanager
+    def stage(self, name, num_bytes=None):
+        """Records the stage run in the with block. The dict it gives can be used to record the
+        amount of data processed as "bytes" and any other facts about the stage. A stage that
+        raises an exception is recorded too, with "failed" set."""
+        start = self.take_snapshot()
+        entry = {"name": name, "bytes": num_bytes, "start_time": start["time"]}
+        try:
+            yield entry
+        except BaseException:
+            entry["failed"] = True
+            raise
+        finally:
+            self.record_stage(entry, start)
+
+    def record_stage(self, entry, start):
+        end = self.take_snapshot()
+        entry.update({
+            "wall_seconds": end["time"] - start["time"],
+            "cpu_seconds": end["cpu"] - start["cpu"],
+            "child_cpu_seconds": end["child_cpu"] - start["child_cpu"],
+            "peak_rss_kb": end["max_rss_kb"]})
+        if start["io"] is not None and end["io"] is not None:
+            for key, name in [("rchar", "bytes_read"), ("wchar", "bytes_written"),
+                              ("read_bytes", "disk_bytes_read"), ("write_bytes", "disk_bytes_written")]:
+                entry[name] = end["io"].get(key, 0) - start["io"].get(key, 0)
+        if entry["bytes"] is None:
+            entry["bytes"] = entry.get("bytes_read")
+        entry["mb_per_second"] = get_mb_per_second(entry["bytes"], entry["wall_seconds"])
+        with self.lock:
+            self.stages.append(entry)
+
+    def record_operation(self, kind, name, wall_seconds, num_bytes=None, rusage=None):
+        entry = {"kind": kind, "name": name, "wall_seconds": wall_seconds, "bytes": num_bytes,
+                 "mb_per_second": get_mb_per_second(num_bytes, wall_seconds)}
+        if rusage is not None:
+            entry.update({
+                "cpu_seconds": rusage.ru_utime + rusage.ru_stime,
+                "peak_rss_kb": get_max_rss_kb(rusage),
+                "disk_bytes_read": rusage.ru_inblock * 512,
+                "disk_bytes_written": rusage.ru_oublock * 512})
+        with self.lock:
+            self.operations.append(entry)
+        return entry
+
+    def get_totals(self):
+        """Returns the number of operations, their total wall and CPU time and bytes by kind."""
+        totals = {}
+        for entry in self.operations:
+            total = totals.setdefault(entry["kind"],
+                    {"count": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "bytes": 0})
+            total["count"] += 1
+            total["wall_seconds"] += entry["wall_seconds"]
+            total["cpu_seconds"] += entry.get("cpu_seconds", 0.0)
+            total["bytes"] += entry["bytes"] or 0
+        return totals
+
+    def write_json(self, path, parameters=None):
+        with open(path, "w") as f:
+            json.dump({"parameters": parameters, "stages": self.stages, "totals": self.get_totals(),
+                       "operations": self.operations}, f, indent=1, sort_keys=True)
+
+    def start_profiling(self):
+        self.main_profile = cProfile.Profile()
+        self.main_profile.enable()
+
+    def profiled(self, func):
+        """Returns func wrapped to be profiled if profiling has been started. Meant for the
+        target functions of threads, since each thread needs a profiler of its own."""
+        def wrapper(*args):
+            if self.main_profile is None:
+                return func(*args)
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args)
+            finally:
+                with self.lock:
+                    self.profiles.append(profile)
+        return wrapper
+
+    def write_profile(self, path, num_functions=20):
+        """Writes the profiles of all threads together to path, in the format of pstats, and
+        prints the functions with the most time spent in them."""
+        self.main_profile.disable()
+        stats = pstats.Stats(self.main_profile)
+        for profile in self.profiles:
+            stats.add(profile)
+        stats.dump_stats(path)
+        stats.sort_stats("tottime").print_stats(num_functions)
+
+
+metrics = Metrics()
+
+
+def run_in_parallel(func, items, jobs, sizes=None, max_bytes_in_flight=None):
+    """Calls func for each item using up to jobs threads and returns the results in the same
+    order as items. If sizes and max_bytes_in_flight are given, a new item is only started if
+    the sizes of the running items plus its own size is at most max_bytes_in_flight (an item
+    that is larger than that on its own is run alone). When func raises an exception no more
+    items are started, and the first exception is raised again when the running items are done."""
+    items = list(items)
+    if sizes is None or max_bytes_in_flight is None:
+        sizes = [0] * len(items)
+        max_bytes_in_flight = 0
+
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    state = {"next": 0, "running": 0, "bytes": 0, "error": None}
+    condition = threading.Condition()
+
+    def worker():
+        while True:
+            with condition:
+                while True:
+                    i = state["next"]
+                    if state["error"] is not None or i >= len(items):
+                        return
+                    if state["running"] == 0 or state["bytes"] + sizes[i] <= max_bytes_in_flight:
+                        break
+                    condition.wait()
+                state["next"] += 1
+                state["running"] += 1
+                state["bytes"] += sizes[i]
+            try:
+                results[i] = func(items[i])
+            except BaseException:
+                with condition:
+                    if state["error"] is None:
+                        state["error"] = sys.exc_info()[1]
+            finally:
+                with condition:
+                    state["running"] -= 1
+                    state["bytes"] -= sizes[i]
+                    condition.notify_all()
+
+    threads = [threading.Thread(target=metrics.profiled(worker)) for i in range(min(jobs, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # Join with a timeout so that Ctrl-C is not blocked while waiting.
+        while thread.is_alive():
+            thread.join(0.5)
+
+    if state["error"] is not None:
+        raise state["error"]
+
+    return results
 
 
 def print_wrap(s):
     print("\n".join(textwrap.wrap(s)))
 
 
-def compress_file(infile, outfile, tmpdir, password):
-    execute_and_throw_if_error([
+def compress_file(infile, outfile, tmpdir, password, quiet=False, cache=None, policy=None):
+    """Compresses infile into the 7z archive outfile. If a CompressionPolicy is given, it
+    chooses the compression switches of 7z. If a CompressionCache is given, the archive is taken
+    from it if possible, and otherwise added to it."""
+    size = os.path.getsize(infile)
+    switches = policy.get_switches(infile, size) if policy is not None else []
+    if cache is not None:
+        key = cache.get_key(infile, password, switches)
+        if cache.fetch(key, outfile, size):
+            if not quiet:
+                print_wrap("Took %r from the compression cache" % os.path.split(outfile)[-1])
+            return
+    entry = execute_and_throw_if_error([
                 '7z',
                 'a',
                 ('-p%s' % password) if password else None,
-                '-w%s' % tmpdir,
+                '-w%s' % tmpdir] + switches + [
                 '--',
                 outfile,
                 infile],
-            cwd=None)
+            cwd=None, quiet=quiet, description=os.path.split(infile)[-1], num_bytes=size)
+    if policy is not None:
+        policy.record_run(infile, entry)
+    if cache is not None:
+        cache.store(key, outfile)
 
 
-def compress_files(infiles, outdir, tmpdir, password):
-    outfiles = []
-    for infile in infiles:
-        filename = os.path.split(infile)[-1]
+def compress_files(infiles, outdir, tmpdir, password, jobs=1, max_bytes_in_flight=None, on_file_done=None,
+                   cache=None, names=None, file_sizes=None, policy=None):
+    """Compresses each file into outdir, running up to jobs instances of 7z at the same time.
+    The number of bytes of input being compressed at the same time is limited to
+    max_bytes_in_flight (if given) to limit the use of the temporary disk. The output of 7z is
+    only shown when running one job at a time, or if it fails. on_file_done(infile, outfile)
+    is called (from any thread) when a file is done. names is a dict from input file to the path
+    relative to outdir to compress it to (plus .7z), by default its file name. file_sizes is a
+    dict from input file to its size, if already known. policy is the CompressionPolicy, if any,
+    and its decision is shown for each file."""
+    quiet = jobs > 1
+    lock = threading.Lock()
+    num_done = [0]
+
+    def compress(infile):
+        filename = names[infile] if names is not None else os.path.split(infile)[-1]
         outfile = os.path.join(outdir, "%s.7z" % filename)
+        make_parent_dirs(outfile)
         try:
-            compress_file(infile=infile, outfile=outfile, tmpdir=tmpdir, password=password)
-            outfiles.append(outfile)
-        except ExecutionFailed:
-            print_wrap("Couldn't compress file %r" % filename)
-            raise SystemExit(1)
-    return outfiles
+            compress_file(infile=infile, outfile=outfile, tmpdir=tmpdir, password=password, quiet=quiet,
+                    cache=cache, policy=policy)
+        except ExecutionFailed as e:
+            with lock:
+                print_execution_output(e)
+                print_wrap("Couldn't compress file %r" % filename)
+            raise
+        decision = (" (%s)" % policy.describe(infile)) if policy is not None else ""
+        if quiet:
+            with lock:
+                num_done[0] += 1
+                print_wrap("Compressed file %d of %d, %s%s" % (num_done[0], len(infiles), filename, decision))
+        elif decision:
+            print_wrap("%s%s" % (filename, decision))
+        if on_file_done is not None:
+            on_file_done(infile, outfile)
+        return outfile
+
+    try:
+        return run_in_parallel(compress, infiles, jobs,
+                sizes=[file_sizes[f] if file_sizes is not None else os.path.getsize(f) for f in infiles],
+                max_bytes_in_flight=max_bytes_in_flight)
+    except ExecutionFailed:
+        raise SystemExit(1)
+
+
+def reflink_file(src, dst):
+    """Creates dst sharing the data blocks of src, if the file system supports it. Returns
+    True on success."""
+    if fcntl is None:
+        return False
+    try:
+        with open(src, "rb") as fsrc:
+            with open(dst, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except (IOError, OSError):
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+
+
+def hardlink_file(src, dst):
+    """Creates dst as a hard link to src if they are on the same file system. Returns True on
+    success."""
+    if os.stat(src).st_dev != os.stat(os.path.dirname(os.path.abspath(dst))).st_dev:
+        return False
+    try:
+        os.link(src, dst)
+        return True
+    except OSError:
+        return False
+
+
+def copy_file_contents(fsrc, fdst, num_bytes=None):
+    """Copies the rest of the file fsrc, or the next num_bytes of it, to fdst, letting the kernel
+    do the copying with copy_file_range if available. fdst must be unbuffered or flushed."""
+    remaining = float("inf") if num_bytes is None else num_bytes
+    copy_file_range = getattr(os, "copy_file_range", None)
+    if copy_file_range is not None:
+        try:
+            while remaining > 0:
+                n = copy_file_range(fsrc.fileno(), fdst.fileno(), int(min(remaining, 1024*1024*1024)))
+                if n == 0:
+                    return
+                remaining -= n
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    # The file positions are where copy_file_range stopped, if it was used at all.
+    while remaining > 0:
+        chunk = fsrc.read(int(min(remaining, COPY_BUFFER_SIZE)))
+        if not chunk:
+            return
+        fdst.write(chunk)
+        remaining -= len(chunk)
+
+
+def stream_copy_file(src, dst):
+    """Copies src to dst, letting the kernel do the copying with copy_file_range if available."""
+    with open(src, "rb") as fsrc:
+        with open(dst, "wb", 0) as fdst:
+            copy_file_contents(fsrc, fdst)
+
+
+def stage_file(src, dst, mode="auto"):
+    """Makes the contents of src available as dst as cheaply as possible. Depending on mode and
+    what the file system supports, dst becomes a reflink or a hard link to src, or a copy of it
+    as a last resort. Returns which method was used."""
+    if mode in ("auto", "reflink") and reflink_file(src, dst):
+        return "reflink"
+    if mode in ("auto", "hardlink") and hardlink_file(src, dst):
+        return "hardlink"
+    stream_copy_file(src, dst)
+    return "copy"
 
 
-def copy_files(infiles, outdir):
+def stage_files(infiles, outdir, mode="auto", on_file_done=None, names=None):
     outfiles = []
+    methods_used = dict((method, 0) for method in ("reflink", "hardlink", "copy"))
     for infile in infiles:
-        filename = os.path.split(infile)[-1]
+        filename = names[infile] if names is not None else os.path.split(infile)[-1]
         outfile = os.path.join(outdir, filename)
         try:
-            shutil.copyfile(infile, outfile)
+            make_parent_dirs(outfile)
+            methods_used[stage_file(infile, outfile, mode)] += 1
             outfiles.append(outfile)
-        except:
+        except (IOError, OSError):
             print_wrap("Couldn't copy file %r to destination %r" % (infile, outfile))
             raise SystemExit(1)
+        if on_file_done is not None:
+            on_file_done(infile, outfile)
+    print_wrap("Staged %d files (%d reflinked, %d hard linked, %d copied)" % (
+            len(outfiles), methods_used["reflink"], methods_used["hardlink"], methods_used["copy"]))
     return outfiles
 
 
+def move_file(src, dest_dir, name=None):
+    """Moves src into dest_dir, as name (a path relative to dest_dir, by default the file name
+    of src), renaming it if possible and copying it otherwise."""
+    dst = os.path.join(dest_dir, name if name is not None else os.path.split(src)[1])
+    make_parent_dirs(dst)
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+
+
+def get_split_part_size(total_size, num_volumes, redundancy):
+    """Returns the size of the parts to split large files into: the largest power of two that is
+    at most 1/SPLIT_PARTS_PER_VOLUME of the data per volume, so that the volumes can be balanced,
+    but no less than MIN_SPLIT_PART_SIZE. The block size is then chosen among the divisors of the
+    part size (see get_block_size_candidates), so that only the last part of a file is padded."""
+    data_per_volume = float(total_size) / (num_volumes - float(redundancy))
+    part_size = MIN_SPLIT_PART_SIZE
+    while part_size * 2 <= data_per_volume / SPLIT_PARTS_PER_VOLUME:
+        part_size *= 2
+    return part_size
+
+
+def get_split_threshold(total_size, num_volumes, redundancy):
+    """Returns the size above which files are split unless a part size is given: the data per
+    volume. A file larger than that leaves its volume fuller than the others wherever the other
+    files go, which is what makes the volumes uneven, while smaller files can be balanced as they
+    are."""
+    return int(float(total_size) / (num_volumes - float(redundancy)))
+
+
+def get_part_filename(filename, index, num_parts):
+    return "%s.part%0*d" % (filename, max(3, len(str(num_parts))), index + 1)
+
+
+def plan_split_files(infiles, file_sizes, part_size, threshold=None):
+    """Returns the files larger than threshold (by default part_size) split into parts of
+    part_size, as a list of (file, [(part, offset, length), ...]).
+    The parts are named like the file with .part001, .part002 and so on appended, in the same
+    directory, where they don't exist yet; they are created by split_files."""
+    split = []
+    threshold = threshold if threshold is not None else part_size
+    for infile in infiles:
+        size = file_sizes[infile]
+        if size <= threshold:
+            continue
+        num_parts = (size + part_size - 1) // part_size
+        split.append((infile, [(get_part_filename(infile, i, num_parts), i * part_size,
+                                min(part_size, size - i * part_size)) for i in range(num_parts)]))
+    return split
+
+
+def reflink_file_range(fsrc, fdst, offset, length):
+    """Makes fdst share the data blocks of length bytes of fsrc at offset, if the file system
+    supports it and the offset is aligned to its blocks. Returns True on success."""
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONERANGE, struct.pack("qQQQ", fsrc.fileno(), offset, length, 0))
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def copy_file_part(src, dst, offset, length):
+    """Creates dst with length bytes of src starting at offset, as a reflink if possible and
+    otherwise as a copy made by the kernel (copy_file_range) or streamed. dst is written under
+    a temporary name, so that it only exists once it is complete."""
+    tmp = dst + ".tmp"
+    with open(src, "rb") as fsrc:
+        with open(tmp, "wb", 0) as fdst:
+            if not reflink_file_range(fsrc, fdst, offset, length):
+                fsrc.seek(offset)
+                copy_file_contents(fsrc, fdst, length)
+    os.rename(tmp, dst)
+
+
+def split_files(split, indir, partsdir):
+    """Creates the parts of the files planned by plan_split_files in partsdir, at the paths
+    relative to it that they were planned under relative to indir. Parts that are already there
+    (from a run that is resumed) are kept. Returns a dict from the name each part was planned
+    under to its path in partsdir."""
+    part_paths = {}
+    for infile, parts in split:
+        print_wrap("Splitting %r into %d parts" % (os.path.relpath(infile, indir), len(parts)))
+        for part, offset, length in parts:
+            path = os.path.join(partsdir, os.path.relpath(part, indir))
+            make_parent_dirs(path)
+            if not (os.path.isfile(path) and os.path.getsize(path) == length):
+                copy_file_part(infile, path, offset, length)
+            part_paths[part] = path
+    return part_paths
+
+
+def write_split_manifest(dest_dirs, split, indir):
+    """Writes a manifest of the files that were split into parts to each volume directory. The
+    files are listed by their paths relative to indir."""
+    lines = ["# These files were split into parts to spread them over the volumes. Each line is the\n"
+             "# size of a file, the number of parts and the name of the file, separated by tabs.\n"
+             "# To get a file back, join its parts in order (after extracting them if they are .7z\n"
+             "# files), e.g. cat NAME.part001 NAME.part002 NAME.part003 > NAME\n"]
+    for infile, parts in split:
+        lines.append("%d\t%d\t%s\n" % (sum(length for part, offset, length in parts), len(parts),
+                                        os.path.relpath(infile, indir)))
+    for d in dest_dirs:
+        with open(os.path.join(d, SPLIT_MANIFEST_FILENAME), "w") as f:
+            f.writelines(lines)
+
+
+def parse_split_manifest(path):
+    """Returns the (file name, size, number of parts) of each file in a manifest written by
+    write_split_manifest."""
+    entries = []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line and not line.startswith("#"):
+                size, num_parts, name = line.split("\t", 2)
+                entries.append((name, int(size), int(num_parts)))
+    return entries
+
+
+def join_split_files(directory, entries):
+    """Joins the parts of the files listed in a split manifest, which are in directory, and
+    removes the parts. Returns the names of the files whose parts are missing or whose size
+    came out wrong; those parts are left alone."""
+    failed = []
+    for name, size, num_parts in entries:
+        parts = [os.path.join(directory, get_part_filename(name, i, num_parts)) for i in range(num_parts)]
+        if not all(os.path.isfile(part) for part in parts):
+            failed.append(name)
+            continue
+        path = os.path.join(directory, name)
+        with open(path, "wb", 0) as fdst:
+            for part in parts:
+                with open(part, "rb") as fsrc:
+                    copy_file_contents(fsrc, fdst)
+        if os.path.getsize(path) != size:
+            os.remove(path)
+            failed.append(name)
+            continue
+        for part in parts:
+            os.remove(part)
+    return failed
+
+
+def get_tar_member_size(name, size):
+    """Returns the number of bytes a file takes in a tar container: its header (GNU format, with
+    an extra header for a long name) and its data padded to whole tar blocks."""
+    info = tarfile.TarInfo(name)
+    info.size = size
+    return len(info.tobuf(tarfile.GNU_FORMAT)) + size + (-size % TAR_BLOCK_SIZE)
+
+
+def plan_packed_files(infiles, file_sizes, max_file_size, container_size):
+    """Groups the files smaller than max_file_size, in order, into tar containers of
+    container_size bytes, the last one padded to a multiple of 1/16 of that instead. Filling the
+    containers to a size that is a whole number of par2 blocks (see get_split_part_size) means
+    that the small files cost neither a padded block nor packets of their own in the par2 files.
+    Returns a list of (container, container size, files), where the containers are named
+    packed_files_001.tar and so on in the directory of their files (only files in the same
+    directory are packed together), where they don't exist yet; they are created by pack_files.
+    A file that would be alone in a container is left as it is."""
+    groups = []
+    used = container_size
+    for infile in sorted(infiles, key=os.path.split):
+        if file_sizes[infile] >= max_file_size:
+            continue
+        member_size = get_tar_member_size(os.path.split(infile)[-1], file_sizes[infile])
+        if (used + member_size > container_size or
+                os.path.dirname(infile) != os.path.dirname(groups[-1][1][0])):
+            groups.append([0, []])
+            used = TAR_END_SIZE
+        groups[-1][1].append(infile)
+        groups[-1][0] = used = used + member_size
+    groups = [(used, files) for used, files in groups if len(files) > 1]
+
+    packed = []
+    for i, (used, files) in enumerate(groups):
+        size = container_size
+        if i == len(groups) - 1:
+            unit = max(TAR_BLOCK_SIZE, container_size // 16)
+            size = used + (-used % unit)
+        container = os.path.join(os.path.dirname(files[0]), PACKED_CONTAINER_NAME % (i + 1))
+        packed.append((container, size, files))
+    return packed
+
+
+def write_tar_container(path, infiles, size):
+    """Writes the files into a tar container at path of exactly size bytes, zero padded after the
+    end of the archive. The data is copied by the kernel where possible. The container is
+    written under a temporary name, so that it only exists once it is complete."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb", 0) as fdst:
+        for infile in infiles:
+            st = os.stat(infile)
+            info = tarfile.TarInfo(os.path.split(infile)[-1])
+            info.size = st.st_size
+            info.mtime = int(st.st_mtime)
+            info.mode = st.st_mode & 0o7777
+            fdst.write(info.tobuf(tarfile.GNU_FORMAT))
+            with open(infile, "rb") as fsrc:
+                copy_file_contents(fsrc, fdst, st.st_size)
+            fdst.write(b"\0" * (-st.st_size % TAR_BLOCK_SIZE))
+        fdst.write(b"\0" * TAR_END_SIZE)
+        if fdst.tell() > size:
+            raise IOError("The files to pack into %r have grown since they were listed" % path)
+        fdst.truncate(size)
+    os.rename(tmp, path)
+
+
+def pack_files(packed, indir, packdir):
+    """Creates the tar containers planned by plan_packed_files in packdir, at the paths relative
+    to it that they were planned under relative to indir. Containers that are already there
+    (from a run that is resumed) are kept. Returns a dict from the name each container was
+    planned under to its path in packdir."""
+    container_paths = {}
+    for container, size, infiles in packed:
+        path = os.path.join(packdir, os.path.relpath(container, indir))
+        make_parent_dirs(path)
+        if not (os.path.isfile(path) and os.path.getsize(path) == size):
+            write_tar_container(path, infiles, size)
+        container_paths[container] = path
+    print_wrap("Packed %d small files into %d containers" % (sum(len(f) for c, s, f in packed), len(packed)))
+    return container_paths
+
+
+def write_packed_manifest(dest_dirs, packed, indir):
+    """Writes a manifest of the tar containers the small files were packed into to each volume
+    directory. The containers are listed by their paths relative to indir."""
+    lines = ["# These files are tar archives that small files were packed into. Each line is the\n"
+             "# number of files in an archive and its name, separated by a tab. To get the files\n"
+             "# back, unpack the archives (after extracting them if they are .7z files), e.g. with\n"
+             "# tar -xf NAME\n"]
+    for container, size, infiles in packed:
+        lines.append("%d\t%s\n" % (len(infiles), os.path.relpath(container, indir)))
+    for d in dest_dirs:
+        with open(os.path.join(d, PACKED_MANIFEST_FILENAME), "w") as f:
+            f.writelines(lines)
+
+
+def parse_packed_manifest(path):
+    """Returns the (container name, number of files) of each container in a manifest written by
+    write_packed_manifest."""
+    entries = []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line and not line.startswith("#"):
+                num_files, name = line.split("\t", 1)
+                entries.append((name, int(num_files)))
+    return entries
+
+
+def unpack_containers(directory, entries):
+    """Unpacks the tar containers listed in a packed manifest, which are in directory or its
+    subdirectories, next to themselves and removes the containers. Only plain files without a
+    directory in their names are unpacked, and no file is overwritten. Returns the names of the
+    containers that are missing or couldn't be unpacked completely; those are left alone."""
+    failed = []
+    for name, num_files in entries:
+        path = os.path.join(directory, name)
+        container_dir = os.path.dirname(path)
+        try:
+            with tarfile.open(path) as container:
+                members = container.getmembers()
+                if (len(members) != num_files or
+                        any(not m.isfile() or os.path.split(m.name)[-1] != m.name or m.name in (".", "..") or
+                            os.path.lexists(os.path.join(container_dir, m.name)) for m in members)):
+                    failed.append(name)
+                    continue
+                for member in members:
+                    outfile = os.path.join(container_dir, member.name)
+                    with open(outfile, "wb") as fdst:
+                        shutil.copyfileobj(container.extractfile(member), fdst, COPY_BUFFER_SIZE)
+                    os.chmod(outfile, member.mode)
+                    os.utime(outfile, (member.mtime, member.mtime))
+        except (IOError, OSError, tarfile.TarError):
+            failed.append(name)
+            continue
+        os.remove(path)
+    return failed
+
+
+def get_sample_compression_ratio(path, size):
+    """Compresses COMPRESSION_NUM_SAMPLES windows of COMPRESSION_SAMPLE_SIZE bytes spread evenly
+    over the inside of the file (or the whole file, if it is no larger than that) with zlib at
+    its fastest level, and returns their compressed size relative to their size. The start of the
+    file is left out, since e.g. the metadata at the start of a JPEG file compresses well while
+    the rest doesn't. zlib is much faster than 7z and finds less, so this doesn't predict the
+    size of the archive, but it tells data that is already compressed (e.g. JPEG, MP4 or ZIP
+    files), which stays at about 1, from other data."""
+    if size <= COMPRESSION_SAMPLE_SIZE * COMPRESSION_NUM_SAMPLES:
+        offsets = [0]
+        window = size
+    else:
+        window = COMPRESSION_SAMPLE_SIZE
+        offsets = [(size - window) * (i + 1) // (COMPRESSION_NUM_SAMPLES + 1)
+                   for i in range(COMPRESSION_NUM_SAMPLES)]
+    num_bytes = 0
+    num_compressed_bytes = 0
+    with open(path, "rb") as f:
+        for offset in offsets:
+            f.seek(offset)
+            data = f.read(window)
+            num_bytes += len(data)
+            num_compressed_bytes += len(zlib.compress(data, 1))
+    return float(num_compressed_bytes) / num_bytes if num_bytes else 0.0
+
+
+class CompressionPolicy(object):
+    """Chooses the switches 7z compresses each file with. Files whose samples don't shrink (see
+    get_sample_compression_ratio) are only stored (-mx0), which still encrypts them if there is a
+    password. The other files are compressed at level (-mx, the default of 7z if None) using
+    threads threads (-mmt, the default of 7z if None). Without sample all files are compressed.
+
+    The decision for each file and the CPU time of the runs of 7z are kept for the summary. The
+    CPU time saved by storing files is estimated from what compressing the other files cost per
+    byte, which is rough, since some kinds of data are faster to compress than others."""
+
+    def __init__(self, level=None, threads=None, sample=True):
+        self.level = level
+        self.threads = threads
+        self.sample = sample
+        self.lock = threading.Lock()
+        self.decisions = {}
+        # The number of bytes and CPU seconds of the runs of 7z that stored files (True) and that
+        # compressed them (False).
+        self.runs = {True: [0, 0.0], False: [0, 0.0]}
+
+    def get_switches(self, infile, size):
+        ratio = get_sample_compression_ratio(infile, size) if self.sample else None
+        store = ratio is not None and ratio >= INCOMPRESSIBLE_RATIO
+        with self.lock:
+            self.decisions[infile] = (store, ratio, size)
+        if store:
+            return ["-mx0"]
+        return (["-mx%d" % self.level] if self.level is not None else []) + (
+                ["-mmt%d" % self.threads] if self.threads is not None else [])
+
+    def describe(self, infile):
+        store, ratio, size = self.decisions[infile]
+        decision = "stored" if store else ("level %d" % self.level if self.level is not None else "compressed")
+        if ratio is None:
+            return decision
+        return "%s, samples compressed to %.0f %%" % (decision, 100.0 * ratio)
+
+    def record_run(self, infile, entry):
+        """Records the run of 7z for infile, entry being what it was recorded as in metrics,
+        which also gets the decision."""
+        store, ratio, size = self.decisions[infile]
+        entry["stored"] = store
+        entry["sample_ratio"] = ratio
+        with self.lock:
+            run = self.runs[store]
+            run[0] += size
+            run[1] += entry.get("cpu_seconds", entry["wall_seconds"])
+
+    def get_totals(self):
+        """Returns the number of files and bytes stored and compressed."""
+        totals = {True: [0, 0], False: [0, 0]}
+        for store, ratio, size in self.decisions.values():
+            totals[store][0] += 1
+            totals[store][1] += size
+        return totals[True], totals[False]
+
+    def get_cpu_seconds_saved(self):
+        """Estimates the CPU time saved by storing files: what compressing them would have cost
+        at the cost per byte of the files compressed (or the estimate of --plan if none were),
+        minus what storing them cost."""
+        num_stored_bytes, stored_seconds = self.runs[True]
+        num_compressed_bytes, compressed_seconds = self.runs[False]
+        if num_compressed_bytes and compressed_seconds:
+            seconds_per_byte = compressed_seconds / num_compressed_bytes
+        else:
+            seconds_per_byte = 1.0 / PLAN_BYTES_PER_SECOND["compress"]
+        return max(0.0, num_stored_bytes * seconds_per_byte - stored_seconds)
+
+
+def get_password_digest(password, salt):
+    """Returns a slow PBKDF2 hash of password as a hex string, so that it can be stored without
+    giving the password away."""
+    return binascii.hexlify(hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, 200000))
+
+
+class CompressionCache(object):
+    """An on-disk cache of 7z archives, so that files that were compressed by an earlier run
+    (e.g. of an overlapping directory) don't have to be compressed again.
+
+    An archive is stored under a key made from the SHA-256 of the contents of the input file,
+    its name (which is stored in the archive), the compression switches of 7z and the password,
+    if any. The password only goes
+    into the key through a slow PBKDF2 hash. Since hashing the input costs a read, the hash of
+    each input file is remembered along with its device, inode, size and modification time and
+    reused while they are unchanged. Note that an archive taken from the cache has the
+    modification time of the file that was compressed first.
+
+    The index of the cache is a JSON file in the cache directory, which is written by save().
+    save() also removes the least recently used archives until the cache is no larger than
+    max_size bytes. Archives are brought in and out of the cache with stage_file, i.e. they are
+    shared with the output using reflinks or hard links when possible."""
+
+    INDEX_FILENAME = "index.json"
+    LOCK_FILENAME = "lock"
+    VERSION = 1
+
+    def __init__(self, path, max_size, staging_mode="auto"):
+        self.path = path
+        self.objects_dir = os.path.join(path, "objects")
+        self.max_size = max_size
+        self.staging_mode = staging_mode
+        self.lock = threading.Lock()
+        self.password_digests = {}
+        self.num_hits = 0
+        self.num_misses = 0
+        self.bytes_saved = 0
+        if not os.path.isdir(self.objects_dir):
+            os.makedirs(self.objects_dir)
+        self.index = self.read_index()
+
+    def read_index(self):
+        index_path = os.path.join(self.path, self.INDEX_FILENAME)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = to_native_strings(json.load(f))
+            if index.get("version") == self.VERSION:
+                return index
+        return {"version": self.VERSION, "inputs": {}, "objects": {}}
+
+    def get_object_path(self, key):
+        return os.path.join(self.objects_dir, "%s.7z" % key)
+
+    def get_content_hash(self, infile):
+        st = os.stat(infile)
+        identity = [st.st_dev, st.st_ino, st.st_size, st.st_mtime]
+        path = os.path.abspath(infile)
+        with self.lock:
+            entry = self.index["inputs"].get(path)
+        if entry is not None and entry["identity"] == identity:
+            return entry["sha256"]
+        content_hash = md5_of_file(infile, hashlib.sha256)
+        with self.lock:
+            self.index["inputs"][path] = {"identity": identity, "sha256": content_hash}
+        return content_hash
+
+    def get_password_digest(self, password):
+        if password not in self.password_digests:
+            self.password_digests[password] = get_password_digest(password, b"create_par2.py compression cache")
+        return self.password_digests[password]
+
+    def get_key(self, infile, password, switches=()):
+        """Returns the key of the archive of infile compressed (and encrypted) with password,
+        using the compression switches of 7z."""
+        key = hashlib.sha256()
+        key.update(self.get_content_hash(infile).encode("ascii"))
+        key.update(b"\0")
+        filename = os.path.split(infile)[-1]
+        key.update(filename if isinstance(filename, bytes) else filename.encode("utf-8", "surrogateescape"))
+        key.update(b"\0")
+        # Archives compressed with the default switches keep the keys of older versions.
+        if switches:
+            key.update(" ".join(switches).encode("ascii"))
+            key.update(b"\0")
+        if password:
+            key.update(self.get_password_digest(password))
+        return key.hexdigest()
+
+    def fetch(self, key, outfile, input_size):
+        """Makes the cached archive with the given key available as outfile. Returns False if
+        there is no such archive."""
+        object_path = self.get_object_path(key)
+        with self.lock:
+            entry = self.index["objects"].get(key)
+        if (entry is None or not os.path.isfile(object_path) or
+                os.path.getsize(object_path) != entry["size"]):
+            with self.lock:
+                self.num_misses += 1
+            return False
+        stage_file(object_path, outfile, self.staging_mode)
+        with self.lock:
+            entry["last_used"] = time.time()
+            self.num_hits += 1
+            self.bytes_saved += input_size
+        return True
+
+    def store(self, key, outfile):
+        object_path = self.get_object_path(key)
+        tmp_path = "%s.%d.%d.tmp" % (object_path, os.getpid(), threading.current_thread().ident)
+        try:
+            stage_file(outfile, tmp_path, self.staging_mode)
+            os.rename(tmp_path, object_path)
+        except (IOError, OSError):
+            # The cache is only an optimization, and e.g. a full disk shouldn't stop the run.
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        with self.lock:
+            self.index["objects"][key] = {"size": os.path.getsize(object_path), "last_used": time.time()}
+
+    def save(self):
+        """Writes the index, merged with what other runs using the same cache have written in the
+        meantime, and removes the least recently used archives if the cache is too large."""
+        with open(os.path.join(self.path, self.LOCK_FILENAME), "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            with self.lock:
+                index = self.read_index()
+                index["inputs"].update(self.index["inputs"])
+                for key, entry in self.index["objects"].items():
+                    if key not in index["objects"] or index["objects"][key]["last_used"] < entry["last_used"]:
+                        index["objects"][key] = entry
+
+                # Archives stored by runs that didn't get to save the index are adopted.
+                for name in os.listdir(self.objects_dir):
+                    key, ext = os.path.splitext(name)
+                    if ext == ".7z" and key not in index["objects"]:
+                        st = os.stat(os.path.join(self.objects_dir, name))
+                        index["objects"][key] = {"size": st.st_size, "last_used": st.st_mtime}
+                for key in list(index["objects"]):
+                    if not os.path.isfile(self.get_object_path(key)):
+                        del index["objects"][key]
+                for path in list(index["inputs"]):
+                    if not os.path.isfile(path):
+                        del index["inputs"][path]
+
+                total_size = sum(entry["size"] for entry in index["objects"].values())
+                for key, entry in sorted(index["objects"].items(), key=lambda item: item[1]["last_used"]):
+                    if total_size <= self.max_size:
+                        break
+                    os.remove(self.get_object_path(key))
+                    del index["objects"][key]
+                    total_size -= entry["size"]
+
+                index_path = os.path.join(self.path, self.INDEX_FILENAME)
+                with open(index_path + ".tmp", "w") as f:
+                    json.dump(index, f, indent=1, sort_keys=True)
+                os.rename(index_path + ".tmp", index_path)
+                self.index = index
+
+
 def create_par2_files(inoutdir, par2_filename, num_recovery_blocks,
-        block_size, num_blocks, memory):
+        block_size, num_blocks, memory, engine="par2", jobs=1, quiet=False):
     
     assert 0 < num_recovery_blocks < 20000, "%r" % num_recovery_blocks
     assert block_size is None or num_blocks is None, "Can't give both block_size and num_blocks"
+
+    if engine == "builtin":
+        if block_size is None:
+            block_size = get_block_size_for_num_blocks(list(scan_files(inoutdir).values()), num_blocks)
+        create_par2_files_builtin(inoutdir, par2_filename, num_recovery_blocks, block_size,
+                memory=memory, jobs=jobs)
+        return
     
     try:
-        input_filenames = os.listdir(inoutdir)
+        if engine == "par2-split":
+            if block_size is None:
+                block_size = get_block_size_for_num_blocks(list(scan_files(inoutdir).values()), num_blocks)
+            create_par2_files_split(inoutdir, par2_filename, num_recovery_blocks, block_size,
+                    memory=memory, jobs=jobs, quiet=quiet)
+            return
+
+        input_sizes = scan_files(inoutdir)
+        input_filenames = sorted(input_sizes)
         
         execute_and_throw_if_error([
                         "par2",
@@ -112,217 +1269,2482 @@ def create_par2_files(inoutdir, par2_filename, num_recovery_blocks,
                         "--",
                         par2_filename
                     ] + input_filenames,
-                cwd=inoutdir)
+                cwd=inoutdir, quiet=quiet, description=par2_filename, num_bytes=sum(input_sizes.values()))
     
-    except ExecutionFailed:
+    except ExecutionFailed as e:
+        print_execution_output(e)
         print_wrap("Couldn't create par2 files")
         raise SystemExit(1)
 
 
-def calculate_last_overshoot(file_size, max_bin_size, last_bin_size, last_bin_size_fraction):
-    space_left_until_overshoot = max_bin_size * last_bin_size_fraction - last_bin_size
-    overshoot = file_size - space_left_until_overshoot
-    if overshoot < 0:
-        return overshoot
-    else:
-        return int(overshoot / last_bin_size_fraction)
+def get_available_memory():
+    """Returns the number of bytes of memory available to new programs without swapping, from
+    /proc/meminfo on Linux, or else the size of the physical memory. Returns None if unknown."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def get_par2_split_memory():
+    """Returns the default number of megabytes the par2 processes of the par2-split engine may
+    use together: half of the available memory, leaving the rest for the page cache, which lets
+    the processes share reading the input files."""
+    return max(1, (get_available_memory() or 2 * DEFAULT_PAR2_MEMORY) // 2 // (1024*1024))
+
+
+def get_num_par2_processes(num_recovery_blocks, block_size, memory, jobs):
+    """Returns how many par2 processes to split the creation of num_recovery_blocks recovery
+    blocks between: one per core (jobs), but no more than can each get at least one recovery
+    block and their buffers within memory bytes."""
+    return max(1, min(jobs, num_recovery_blocks, memory // (block_size + PAR2_PROCESS_MEMORY)))
+
+
+def split_evenly(num_items, num_parts):
+    """Returns (first, count) of num_parts consecutive ranges covering num_items items, whose
+    counts differ by at most one."""
+    ranges = []
+    first = 0
+    for i in range(num_parts):
+        count = num_items // num_parts + (1 if i < num_items % num_parts else 0)
+        ranges.append((first, count))
+        first += count
+    return ranges
+
+
+def create_par2_files_split(inoutdir, par2_filename, num_recovery_blocks, block_size, memory=None, jobs=1,
+                            quiet=False):
+    """Creates par2 files for the files in inoutdir with several par2 processes at the same time,
+    each creating a range of the recovery blocks (par2 -f). The processes share memory megabytes
+    and the jobs cores. Each runs in a directory of its own with hard links to the input files
+    (par2cmdline-turbo refuses symbolic links), since they all write an index file. The recovery
+    files are then moved into inoutdir together with one of the index files, renamed to a common
+    numbering, after checking that they make up one recovery set with all the recovery blocks.
+    Raises ExecutionFailed if par2 fails."""
+    input_sizes = scan_files(inoutdir)
+    input_filenames = sorted(input_sizes)
+    memory_bytes = (memory or get_par2_split_memory()) * 1024 * 1024
+    num_processes = get_num_par2_processes(num_recovery_blocks, block_size, memory_bytes, jobs)
+    process_memory = max(1, memory_bytes // num_processes // (1024*1024))
+    process_threads = max(1, jobs // num_processes)
+    num_bytes = sum(input_sizes.values())
+    if not quiet:
+        print_wrap("Creating %d recovery blocks with %d par2 process%s" % (
+                num_recovery_blocks, num_processes, "es" if num_processes > 1 else ""))
+
+    lock = threading.Lock()
+    workdirs = []
+
+    def create_range(recovery_range):
+        first, count = recovery_range
+        workdir = tempfile.mkdtemp(prefix=".par2_split_", dir=os.path.dirname(os.path.abspath(inoutdir)))
+        with lock:
+            workdirs.append(workdir)
+        for f in input_filenames:
+            dst = os.path.join(workdir, f)
+            make_parent_dirs(dst)
+            stage_file(os.path.realpath(os.path.join(inoutdir, f)), dst, "hardlink")
+        execute_and_throw_if_error([
+                        "par2",
+                        "create",
+                        "-s%d" % block_size,
+                        "-f%d" % first,
+                        "-c%d" % count,
+                        "-m%d" % process_memory,
+                        "-t%d" % process_threads,
+                        "--",
+                        par2_filename
+                    ] + input_filenames,
+                cwd=workdir, quiet=quiet or num_processes > 1,
+                description="%s (recovery blocks %d to %d)" % (par2_filename, first, first + count - 1),
+                num_bytes=num_bytes)
+        return workdir
+
+    try:
+        results = run_in_parallel(create_range, split_evenly(num_recovery_blocks, num_processes), num_processes)
+
+        base_name = os.path.splitext(par2_filename)[0]
+        recovery_file_regexp = re.compile(re.escape(base_name) + r"\.vol(\d+)\+(\d+)\.par2$")
+        recovery_files = []
+        for workdir in results:
+            for name in os.listdir(workdir):
+                match = recovery_file_regexp.match(name)
+                if match:
+                    recovery_files.append((int(match.group(1)), int(match.group(2)), os.path.join(workdir, name)))
+        index_path = os.path.join(results[0], par2_filename)
+
+        recovery_sets = read_par2_recovery_sets([index_path] + [path for first, count, path in recovery_files])
+        if (len(recovery_sets) != 1 or
+                list(recovery_sets.values())[0].recovery_exponents != set(range(num_recovery_blocks))):
+            raise ExecutionFailed("The par2 processes didn't create one recovery set with blocks 0 to %d" % (
+                    num_recovery_blocks - 1))
+
+        exponent_digits = len(str(max(first for first, count, path in recovery_files)))
+        count_digits = len(str(max(count for first, count, path in recovery_files)))
+        for first, count, path in recovery_files:
+            os.rename(path, os.path.join(inoutdir, "%s.vol%0*d+%0*d.par2" % (
+                    base_name, exponent_digits, first, count_digits, count)))
+        os.rename(index_path, os.path.join(inoutdir, par2_filename))
+    finally:
+        for workdir in workdirs:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def get_block_size_for_num_blocks(file_sizes, num_blocks):
+    """Returns the smallest block size (a multiple of 4) giving at most num_blocks blocks."""
+    block_size = max(4, (sum(file_sizes) + num_blocks - 1) // num_blocks)
+    block_size += -block_size % 4
+    while get_total_num_blocks(file_sizes, block_size) > num_blocks:
+        block_size += 4 * max(1, block_size // 400)
+    return block_size
+
+
+def make_par2_packet(set_id, packet_type, body):
+    packet_hash = hashlib.md5(set_id + packet_type + body).digest()
+    return PAR2_PACKET_HEADER.pack(PAR2_PACKET_MAGIC, PAR2_PACKET_HEADER.size + len(body),
+            packet_hash, set_id, packet_type) + body
+
+
+def pad_to_multiple_of_4(data):
+    return data + b"\0" * (-len(data) % 4)
+
+
+def encode_par2_filename(name):
+    if not isinstance(name, bytes):
+        name = name.encode("utf-8")
+    return name
+
+
+Par2InputFile = collections.namedtuple("Par2InputFile", "path length file_id num_slices packets")
+
+
+def describe_par2_input_file(path, slice_size, name=None):
+    """Hashes a file and returns a Par2InputFile with its file description packet body and its
+    input file slice checksum packet body (the latter is None for an empty file). name is the
+    path par2 knows the file by, relative to the par2 files, by default its file name."""
+    md5 = hashlib.md5()
+    slice_checksums = []
+    with open(path, "rb") as f:
+        md5_16k = hashlib.md5(f.read(16*1024)).digest()
+        f.seek(0)
+        while True:
+            data = f.read(slice_size)
+            if not data:
+                break
+            md5.update(data)
+            padded = data + b"\0" * (slice_size - len(data))
+            slice_checksums.append(hashlib.md5(padded).digest() +
+                    struct.pack("<I", zlib.crc32(padded) & 0xffffffff))
+
+    length = os.path.getsize(path)
+    name = encode_par2_filename(name if name is not None else os.path.split(path)[-1])
+    file_id = hashlib.md5(md5_16k + struct.pack("<Q", length) + name).digest()
+    packets = [(PAR2_FILE_DESCRIPTION_PACKET,
+                file_id + md5.digest() + md5_16k + struct.pack("<Q", length) + pad_to_multiple_of_4(name))]
+    if slice_checksums:
+        packets.append((PAR2_INPUT_FILE_SLICE_CHECKSUM_PACKET, file_id + b"".join(slice_checksums)))
+    return Par2InputFile(path, length, file_id, len(slice_checksums), packets)
+
+
+def get_par2_recovery_file_layout(num_recovery_blocks, max_blocks_per_file):
+    """Returns (first exponent, number of blocks) for each recovery file, using the same scheme as
+    par2 by default: files with 1, 2, 4, ... blocks, but no more than max_blocks_per_file each."""
+    layout = []
+    first_exponent = 0
+    count = 1
+    while first_exponent < num_recovery_blocks:
+        count = min(count, max_blocks_per_file, num_recovery_blocks - first_exponent)
+        layout.append((first_exponent, count))
+        first_exponent += count
+        count *= 2
+    return layout
+
+
+def get_par2_input_slice_logs(num_slices):
+    """Returns the logarithms of the constants par2 multiplies the input slices with. The
+    constants are the powers of 2 whose exponent is not divisible by 3, 5, 17 or 257 (the prime
+    factors of 65535)."""
+    logs = [n for n in range(1, GF16_ORDER) if n % 3 and n % 5 and n % 17 and n % 257]
+    assert num_slices <= len(logs), "par2 can't have more than %d input blocks" % len(logs)
+    return logs[:num_slices]
+
+
+gf16_tables = None
+
+def get_gf16_tables():
+    """Returns NumPy log and antilog tables for GF(2^16). The antilog table is repeated so that
+    the sum of two logarithms can be used as an index directly, and the logarithm of 0 points
+    into a zero filled tail of it, so multiplication by 0 needs no special case."""
+    global gf16_tables
+    if gf16_tables is None:
+        log = [2 * GF16_ORDER] * (GF16_ORDER + 1)
+        antilog = [0] * (3 * GF16_ORDER)
+        value = 1
+        for power in range(GF16_ORDER):
+            antilog[power] = antilog[power + GF16_ORDER] = value
+            log[value] = power
+            value <<= 1
+            if value & 0x10000:
+                value ^= GF16_GENERATOR
+        gf16_tables = numpy.array(log, dtype=numpy.uint32), numpy.array(antilog, dtype=numpy.uint16)
+    return gf16_tables
+
+
+def compute_par2_recovery_packets(task):
+    """Computes the recovery blocks with the exponents first_exponent, first_exponent+1, ... and
+    writes them as packets at offset in the recovery file at recovery_path. Each recovery block
+    is the sum over all input slices of the slice times its constant raised to the exponent,
+    treating the data as little endian 16 bit words in GF(2^16). The input files are memory
+    mapped and processed one slice at a time."""
+    input_files, slice_size, set_id, first_exponent, num_exponents, recovery_path, offset = task
+    log, antilog = get_gf16_tables()
+
+    num_words = slice_size // 2
+    exponents = numpy.arange(first_exponent, first_exponent + num_exponents, dtype=numpy.int64)
+    recovery = numpy.zeros((num_exponents, num_words), dtype=numpy.uint16)
+    index = numpy.empty(num_words, dtype=numpy.uint32)
+    product = numpy.empty(num_words, dtype=numpy.uint16)
+    padded = numpy.zeros(slice_size, dtype=numpy.uint8)
+
+    input_slice_logs = iter(get_par2_input_slice_logs(sum(f.num_slices for f in input_files)))
+    for input_file in input_files:
+        data = numpy.memmap(input_file.path, dtype=numpy.uint8, mode="r")
+        for start in range(0, input_file.length, slice_size):
+            input_slice = data[start:start + slice_size]
+            if len(input_slice) < slice_size:
+                padded[:] = 0
+                padded[:len(input_slice)] = input_slice
+                input_slice = padded
+            word_logs = log[input_slice.view("<u2")]
+            coefficient_logs = (next(input_slice_logs) * exponents) % GF16_ORDER
+            for row, coefficient_log in zip(recovery, coefficient_logs):
+                numpy.add(word_logs, int(coefficient_log), out=index)
+                numpy.take(antilog, index, out=product)
+                numpy.bitwise_xor(row, product, out=row)
+        del data
+
+    with open(recovery_path, "r+b") as f:
+        f.seek(offset)
+        for exponent, row in zip(range(first_exponent, first_exponent + num_exponents), recovery):
+            body = struct.pack("<I", exponent) + row.astype("<u2").tobytes()
+            f.write(make_par2_packet(set_id, PAR2_RECOVERY_SLICE_PACKET, body))
+
+
+def create_par2_files_builtin(inoutdir, par2_filename, num_recovery_blocks, block_size, memory=None, jobs=1):
+    """Creates par2 files for the files in inoutdir without the par2 program. The result is an
+    index file and recovery files named like the ones par2 creates, which par2 can verify and
+    repair with. The recovery blocks are computed by a pool of jobs processes, each working on a
+    range of recovery blocks no larger than its share of memory megabytes."""
+    if numpy is None:
+        print_wrap("The builtin par2 engine requires NumPy.")
+        raise SystemExit(1)
+    assert block_size % 4 == 0, "%r" % block_size
+
+    input_files = run_in_parallel(
+            lambda name: describe_par2_input_file(os.path.join(inoutdir, name), block_size, name),
+            list_files(inoutdir), jobs)
+    input_files.sort(key=lambda f: f.file_id)
+    recovery_set_files = [f for f in input_files if f.length > 0]
+    non_recovery_set_files = [f for f in input_files if f.length == 0]
+    get_par2_input_slice_logs(sum(f.num_slices for f in recovery_set_files))
+
+    main_body = (struct.pack("<QI", block_size, len(recovery_set_files)) +
+                    b"".join(f.file_id for f in recovery_set_files + non_recovery_set_files))
+    set_id = hashlib.md5(main_body).digest()
+    critical_packets = b"".join(
+            [make_par2_packet(set_id, PAR2_MAIN_PACKET, main_body)] +
+            [make_par2_packet(set_id, packet_type, body)
+                for f in input_files for packet_type, body in f.packets] +
+            [make_par2_packet(set_id, PAR2_CREATOR_PACKET, pad_to_multiple_of_4(PAR2_CREATOR))])
+
+    with open(os.path.join(inoutdir, par2_filename), "wb") as f:
+        f.write(critical_packets)
+
+    # Each recovery file gets its recovery packets followed by a copy of the critical packets. The
+    # file is created at its final size so that the workers can fill in the recovery packets.
+    packet_size = PAR2_PACKET_HEADER.size + 4 + block_size
+    layout = get_par2_recovery_file_layout(num_recovery_blocks,
+            max(1, max(f.num_slices for f in input_files)))
+    base_name = os.path.splitext(par2_filename)[0]
+    exponent_digits = len(str(layout[-1][0]))
+    count_digits = len(str(max(count for first, count in layout)))
+    max_blocks_per_task = max(1, int((memory or 1024) * 1024 * 1024 // max(1, jobs) // block_size))
+    max_blocks_per_task = min(max_blocks_per_task, (num_recovery_blocks + jobs - 1) // jobs)
+
+    tasks = []
+    for first_exponent, count in layout:
+        recovery_path = os.path.join(inoutdir, "%s.vol%0*d+%0*d.par2" % (
+                base_name, exponent_digits, first_exponent, count_digits, count))
+        with open(recovery_path, "wb") as f:
+            f.seek(count * packet_size)
+            f.write(critical_packets)
+        for i in range(0, count, max_blocks_per_task):
+            tasks.append((recovery_set_files, block_size, set_id, first_exponent + i,
+                    min(max_blocks_per_task, count - i), recovery_path, i * packet_size))
+
+    print_wrap("Computing %d recovery blocks of %d bytes from %d input blocks" % (
+            num_recovery_blocks, block_size, sum(f.num_slices for f in recovery_set_files)))
+    if jobs <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            compute_par2_recovery_packets(task)
+    else:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        try:
+            # A timeout makes the wait interruptible with Ctrl-C.
+            pool.map_async(compute_par2_recovery_packets, tasks, chunksize=1).get(10**9)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+
+def get_block_weights(file_sizes, block_size):
+    """Returns the number of par2 blocks each file occupies, including the padded last block. For
+    par2 recovery files the weight is the number of recovery blocks in them."""
+    weights = {}
+    for path, size in file_sizes.items():
+        if is_par2_file(path):
+            weights[path] = sum(len(recovery_set.recovery_exponents)
+                                    for recovery_set in read_par2_recovery_sets([path]).values())
+        else:
+            weights[path] = (size + block_size - 1) // block_size
+    return weights
+
+
+MAX_LOCAL_SEARCH_CANDIDATES = 256
+
+
+def improve_bins_by_local_search(bin_items, bin_loads, capacities, max_iterations):
+    """Repeatedly moves an item from the most loaded bin (relative to its capacity) to another bin,
+    or swaps an item of the most loaded bin for a smaller one of another bin, as long as that
+    lowers the load of the most loaded bin. bin_items are sorted lists of (weight, key)."""
+    def relative_load(i):
+        return float(bin_loads[i]) / capacities[i]
+
+    for iteration in range(max_iterations):
+        high = max(range(len(bin_loads)), key=relative_load)
+        high_load = relative_load(high)
+        others = sorted((i for i in range(len(bin_loads)) if i != high), key=relative_load)
+
+        best = None
+        for low in others:
+            low_load = relative_load(low)
+            if low_load >= high_load:
+                break
+            # Moving or swapping a net weight of delta from high to low is an improvement if the
+            # new load of both bins is lower than the current load of high. The best delta is the
+            # one that makes both loads equal.
+            ideal_delta = (high_load - low_load) / (1.0 / capacities[high] + 1.0 / capacities[low])
+            candidates = bin_items[high][-MAX_LOCAL_SEARCH_CANDIDATES:]
+            low_weights = [0] + [weight for weight, key in bin_items[low]]
+            for weight, key in candidates:
+                j = bisect.bisect_left(low_weights, weight - ideal_delta)
+                for k in (0, j - 1, j):
+                    if 0 <= k < len(low_weights) and low_weights[k] < weight:
+                        delta = weight - low_weights[k]
+                        new_load = max(float(bin_loads[high] - delta) / capacities[high],
+                                        float(bin_loads[low] + delta) / capacities[low])
+                        if new_load < high_load and (best is None or new_load < best[0]):
+                            swap = bin_items[low][k - 1] if k > 0 else None
+                            best = (new_load, low, (weight, key), swap)
+            if best is not None:
+                break
+
+        if best is None:
+            return
+        new_load, low, moved, swapped = best
+        bin_items[high].remove(moved)
+        bisect.insort(bin_items[low], moved)
+        bin_loads[high] -= moved[0]
+        bin_loads[low] += moved[0]
+        if swapped is not None:
+            bin_items[low].remove(swapped)
+            bisect.insort(bin_items[high], swapped)
+            bin_loads[low] -= swapped[0]
+            bin_loads[high] += swapped[0]
+
+
+def distribute_files_uniformly(files_with_sizes, num_bins, last_bin_size_fraction=1, weights=None,
+        initial_loads=None):
+    """Tries to distribute a set of files about uniformly into a set of bins. It may optionally
+    try to only put a fraction of the size of the other bins into the last bin. The files are
+    balanced by their weights if given (e.g. their number of par2 blocks) and by their sizes
+    otherwise. initial_loads is the weight already in each bin, if any. The files are first
+    placed largest first, each in the bin where it ends up least loaded, and the result is then
+    refined by moving and swapping files between bins."""
+    assert 0 < last_bin_size_fraction <= 1
+    if weights is None:
+        weights = files_with_sizes
+
+    items = sorted(((weights[f], files_with_sizes[f], f) for f in files_with_sizes), reverse=True)
+    capacities = [1.0] * (num_bins - 1) + [float(last_bin_size_fraction)]
+
+    bin_loads = list(initial_loads) if initial_loads is not None else [0] * num_bins
+    bin_items = [[] for i in range(num_bins)]
+    heap = [(bin_loads[i], i) for i in range(num_bins - 1)]
+    heapq.heapify(heap)
+    for key, (weight, size, file) in enumerate(items):
+        last = num_bins - 1
+        if not heap or float(bin_loads[last] + weight) / capacities[last] < heap[0][0] + weight:
+            target_index = last
+        else:
+            load, target_index = heapq.heappop(heap)
+            heapq.heappush(heap, (load + weight, target_index))
+        bin_loads[target_index] += weight
+        bin_items[target_index].append((weight, key))
+
+    for current_items in bin_items:
+        current_items.sort()
+    improve_bins_by_local_search(bin_items, bin_loads, capacities, max_iterations=10 * num_bins + 100)
+
+    bins = []
+    bin_sizes = []
+    for current_items in bin_items:
+        keys = sorted(key for weight, key in current_items)
+        bins.append([items[key][2] for key in keys])
+        bin_sizes.append(sum(items[key][1] for key in keys))
+    return bins, bin_sizes
+
+
+def create_bar_chart(values, width=60):
+    max_value = max(values)
+
+    lines = []
+    for value in values:
+        num_x = int(round(float(value) * width / max_value))
+        num_space = width - num_x
+        lines.append("%s%s %d" % ("#" * num_x, " " * num_space, value))
+
+    return lines
+
+
+def prepare_and_place_files(infiles_per_set, set_dirs, prepare_file, on_set_prepared,
+        jobs, max_bytes_in_flight, queue_size, file_sizes=None, parallel_sets=1):
+    """Prepares (compresses or stages) the input files as a pipeline. Up to jobs files are
+    prepared at the same time by prepare_file(infile, set_dir), which returns the path of the
+    prepared file. The prepared files are passed through a queue of at most queue_size files to
+    a thread that hashes each one while it is still in the page cache. As soon as all files of a
+    recovery set have been prepared, on_set_prepared(set_index) is started in a thread of its
+    own (e.g. to create its par2 files and move the set into the volumes) while the files of the
+    following sets are prepared. At most parallel_sets of these run at the same time, the others
+    wait for one of them to finish, so that the memory and cores given to each set are not
+    exceeded in total. file_sizes is a dict from input file to its size, if already known.
+
+    Returns the prepared files of each set, the MD5 sums of the prepared files as a dict from
+    (file name, size) to MD5 hex string and the time when all files had been prepared."""
+    items = [(i, infile) for i, infiles in enumerate(infiles_per_set) for infile in infiles]
+    prepared_files = queue.Queue(queue_size)
+    md5_sums = {}
+    num_hashed = [0] * len(infiles_per_set)
+    set_threads = []
+    set_slots = threading.BoundedSemaphore(parallel_sets)
+    errors = []
+
+    def run_and_record_error(func, *args):
+        try:
+            func(*args)
+        except BaseException as e:
+            errors.append(e)
+
+    def run_set(set_index):
+        with set_slots:
+            if not errors:
+                on_set_prepared(set_index)
+
+    def hash_files():
+        while True:
+            item = prepared_files.get()
+            if item is None:
+                return
+            # After an error, keep emptying the queue so that the preparing threads don't block.
+            if not errors:
+                run_and_record_error(hash_file, *item)
+
+    def hash_file(set_index, path):
+        size = os.path.getsize(path)
+        name = os.path.relpath(path, set_dirs[set_index])
+        md5_sums[(name, size)] = md5_of_file(path)
+
+        num_hashed[set_index] += 1
+        if num_hashed[set_index] == len(infiles_per_set[set_index]):
+            thread = threading.Thread(target=metrics.profiled(run_and_record_error),
+                    args=(run_set, set_index))
+            thread.daemon = True
+            thread.start()
+            set_threads.append(thread)
+
+    def prepare(item):
+        if errors:
+            return None
+        set_index, infile = item
+        outfile = prepare_file(infile, set_dirs[set_index])
+        prepared_files.put((set_index, outfile))
+        return outfile
+
+    hasher = threading.Thread(target=metrics.profiled(run_and_record_error), args=(hash_files,))
+    hasher.daemon = True
+    hasher.start()
+    try:
+        outfiles = run_in_parallel(prepare, items, jobs,
+                sizes=[file_sizes[infile] if file_sizes is not None else os.path.getsize(infile)
+                        for set_index, infile in items],
+                max_bytes_in_flight=max_bytes_in_flight)
+    finally:
+        prepared_time = time.time()
+        prepared_files.put(None)
+        while hasher.is_alive():
+            hasher.join(0.5)
+    for thread in set_threads:
+        while thread.is_alive():
+            thread.join(0.5)
+    if errors:
+        raise errors[0]
+
+    files_per_set = [[] for infiles in infiles_per_set]
+    for (set_index, infile), outfile in zip(items, outfiles):
+        files_per_set[set_index].append(outfile)
+    return files_per_set, md5_sums, prepared_time
+
+
+def get_dest_dirs(destdir, prefix, num_volumes):
+    dest_dirs = [os.path.abspath(os.path.join(destdir, "%s%d" % (prefix, i+1)))
+                    for i in range(num_volumes)]
+    return dest_dirs
+
+
+def move_files_to_destination_dir(srcdir, destdir, par2_filename, prefix, num_volumes, staging_mode="auto",
+        quiet=False):
+    """Distributes the files in srcdir over the volume directories."""
+    sizes = scan_files(srcdir)
+    assert par2_filename in sizes
+    del sizes[par2_filename]
+    
+    par2_src_path = os.path.join(srcdir, par2_filename)
+
+    dest_dirs = get_dest_dirs(destdir, prefix, num_volumes)
+
+    file_sizes = dict((os.path.join(srcdir, name), size) for name, size in sizes.items())
+
+    # Balance the volumes by the number of par2 blocks in them, since that determines how many
+    # blocks must be recovered if a volume is lost.
+    block_size = read_par2_recovery_sets([par2_src_path]).popitem()[1].slice_size
+    weights = get_block_weights(file_sizes, block_size)
+    bins, bin_sizes = distribute_files_uniformly(file_sizes, num_volumes, 1, weights)
+
+    i = 0
+    for current_bin, current_dest_dir in zip(bins, dest_dirs):
+        if not os.path.isdir(current_dest_dir):
+            os.mkdir(current_dest_dir)
+        if current_dest_dir == dest_dirs[-1]:
+            move_file(par2_src_path, current_dest_dir)
+        else:
+            stage_file(par2_src_path, os.path.join(current_dest_dir, par2_filename), staging_mode)
+
+        for filepath in (current_bin):
+            if not quiet:
+                print("Moving file %d of %d" % (i+1, len(file_sizes)))
+            move_file(filepath, current_dest_dir, os.path.relpath(filepath, srcdir))
+            i += 1
+
+
+Par2FileDescription = collections.namedtuple("Par2FileDescription", "file_id name length md5 md5_16k")
+
+
+class Par2RecoverySet(object):
+    """The parts of a par2 recovery set that are needed to reason about its recoverability
+    without looking at the data itself."""
+
+    def __init__(self, set_id):
+        self.set_id = set_id
+        self.slice_size = None
+        self.file_ids = []
+        self.files = {}
+        self.recovery_exponents = set()
+        self.par2_names = set()
+
+    def merge(self, other):
+        self.slice_size = self.slice_size or other.slice_size
+        self.file_ids = self.file_ids or other.file_ids
+        self.files.update(other.files)
+        self.recovery_exponents.update(other.recovery_exponents)
+        self.par2_names.update(other.par2_names)
+
+    def get_name(self):
+        """Returns the name of the index file, which has the shortest name of the par2 files."""
+        return min(self.par2_names, key=lambda name: (len(name), name))
+
+    def files_by_name(self):
+        return dict((f.name, f) for f in self.files.values())
+
+    def num_data_blocks(self, file_description):
+        return (file_description.length + self.slice_size - 1) // self.slice_size
+
+
+def find_par2_packet_start(f, offset):
+    """Returns the offset of the first packet header at or after offset, or None."""
+    f.seek(offset)
+    tail = b""
+    while True:
+        chunk = f.read(COPY_BUFFER_SIZE)
+        if not chunk:
+            return None
+        data = tail + chunk
+        index = data.find(PAR2_PACKET_MAGIC)
+        if index >= 0:
+            return offset - len(tail) + index
+        tail = data[-(len(PAR2_PACKET_MAGIC) - 1):]
+        offset += len(chunk)
+
+
+def read_par2_packets(path, packet_types):
+    """Yields (recovery set id, packet type, body) for the packets in the par2 file at path whose
+    type is in packet_types. Of recovery slice packets only the exponent is read, and packets
+    with a corrupt body are skipped. Damaged parts of the file are skipped by searching for the
+    next packet header."""
+    with open(path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset + PAR2_PACKET_HEADER.size <= file_size:
+            f.seek(offset)
+            magic, length, packet_hash, set_id, packet_type = PAR2_PACKET_HEADER.unpack(
+                    f.read(PAR2_PACKET_HEADER.size))
+            if (magic != PAR2_PACKET_MAGIC or length % 4 != 0 or length < PAR2_PACKET_HEADER.size
+                    or offset + length > file_size):
+                offset = find_par2_packet_start(f, offset + 1)
+                if offset is None:
+                    return
+                continue
+
+            if packet_type == PAR2_RECOVERY_SLICE_PACKET and packet_type in packet_types:
+                yield set_id, packet_type, f.read(4)
+            elif packet_type in packet_types:
+                body = f.read(length - PAR2_PACKET_HEADER.size)
+                if hashlib.md5(set_id + packet_type + body).digest() == packet_hash:
+                    yield set_id, packet_type, body
+            offset += length
+
+
+def decode_par2_filename(name):
+    name = name.rstrip(b"\0")
+    if not isinstance(name, str):
+        name = name.decode("utf-8", "replace")
+    return name
+
+
+def read_par2_recovery_sets(par2_paths):
+    """Reads the main, file description and recovery slice packets of a number of par2 files
+    and returns a dict from recovery set id to Par2RecoverySet."""
+    recovery_sets = {}
+    packet_types = (PAR2_MAIN_PACKET, PAR2_FILE_DESCRIPTION_PACKET, PAR2_RECOVERY_SLICE_PACKET)
+    for path in par2_paths:
+        for set_id, packet_type, body in read_par2_packets(path, packet_types):
+            recovery_set = recovery_sets.setdefault(set_id, Par2RecoverySet(set_id))
+            recovery_set.par2_names.add(os.path.split(path)[-1])
+            if packet_type == PAR2_MAIN_PACKET:
+                recovery_set.slice_size, num_files = struct.unpack("<QI", body[:12])
+                recovery_set.file_ids = [body[12 + 16*i:12 + 16*(i+1)] for i in range(num_files)]
+            elif packet_type == PAR2_FILE_DESCRIPTION_PACKET:
+                file_id, md5, md5_16k, length = struct.unpack("<16s16s16sQ", body[:56])
+                recovery_set.files[file_id] = Par2FileDescription(
+                        file_id, decode_par2_filename(body[56:]), length, md5, md5_16k)
+            else:
+                recovery_set.recovery_exponents.add(struct.unpack("<I", body)[0])
+    return recovery_sets
+
+
+def is_par2_file(path):
+    return os.path.splitext(path)[-1] == ".par2"
+
+
+def list_volume_files(volume_dirs):
+    """Returns for each volume directory the (name, path) of the files in it, where the name is
+    the path relative to the volume directory."""
+    return [[(f, os.path.join(d, f)) for f in list_files(d)] for d in volume_dirs]
+
+
+def count_blocks_per_volume(volume_files):
+    """Returns a dict from recovery set name (the name of its index file) to a tuple (data blocks
+    per volume, recovery block exponents per volume, names of protected files not found in any
+    volume)."""
+    volume_recovery_sets = [read_par2_recovery_sets([path for name, path in files if is_par2_file(name)])
+                                for files in volume_files]
+    recovery_sets = {}
+    for sets in volume_recovery_sets:
+        for set_id, recovery_set in sets.items():
+            recovery_sets.setdefault(set_id, Par2RecoverySet(set_id)).merge(recovery_set)
+
+    result = {}
+    for set_id, recovery_set in recovery_sets.items():
+        if recovery_set.slice_size is None:
+            continue
+        files_by_name = recovery_set.files_by_name()
+        missing_names = set(files_by_name)
+        data_blocks = []
+        recovery_exponents = []
+        for files, sets in zip(volume_files, volume_recovery_sets):
+            data_blocks.append(0)
+            for name, path in files:
+                if name in files_by_name and not is_par2_file(name):
+                    data_blocks[-1] += recovery_set.num_data_blocks(files_by_name[name])
+                    missing_names.discard(name)
+            recovery_exponents.append(sets[set_id].recovery_exponents if set_id in sets else set())
+        result[recovery_set.get_name()] = (data_blocks, recovery_exponents, sorted(missing_names))
+    return result
+
+
+def find_unrecoverable_volume_losses(data_blocks, recovery_exponents, num_lost_volumes):
+    """Returns the combinations of num_lost_volumes volumes (as tuples of volume indices) whose
+    loss would leave more missing data blocks than there are recovery blocks left. This assumes
+    that any set of distinct recovery blocks can replace the same number of data blocks."""
+    failures = []
+    volume_indices = range(len(data_blocks))
+    for lost in itertools.combinations(volume_indices, num_lost_volumes):
+        missing = sum(data_blocks[i] for i in lost)
+        surviving_exponents = set()
+        for i in volume_indices:
+            if i not in lost:
+                surviving_exponents.update(recovery_exponents[i])
+        if missing > len(surviving_exponents):
+            failures.append(lost)
+    return failures
+
+
+def md5_of_file(path, algorithm=hashlib.md5):
+    """Returns the MD5 (or another hash given by algorithm) of a file as a hex string. hashlib
+    releases the GIL while hashing large buffers, so several files can be hashed in parallel
+    using threads."""
+    start_time = time.time()
+    h = algorithm()
+    num_bytes = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_BUFFER_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+            num_bytes += len(chunk)
+    metrics.record_operation(h.name.lower(), os.path.split(path)[-1], time.time() - start_time, num_bytes)
+    return h.hexdigest()
+
+
+def format_md5sum_line(md5_hex, name):
+    """Formats a line the way md5sum does, including its escaping of unusual file names."""
+    if "\\" in name or "\n" in name:
+        return "\\%s  %s\n" % (md5_hex, name.replace("\\", "\\\\").replace("\n", "\\n"))
+    return "%s  %s\n" % (md5_hex, name)
+
+
+def get_known_md5_sums(volume_files):
+    """Returns a dict from (file name, size) to the MD5 hex string par2 computed for that file,
+    taken from the file description packets of the par2 files in the volumes."""
+    par2_paths = [path for files in volume_files for name, path in files if is_par2_file(name)]
+    known_md5_sums = {}
+    for recovery_set in read_par2_recovery_sets(par2_paths).values():
+        for f in recovery_set.files.values():
+            known_md5_sums[(f.name, f.length)] = binascii.hexlify(f.md5).decode("ascii")
+    return known_md5_sums
+
+
+def create_md5_sums(inoutdir, prefix, num_volumes, jobs=1, known_md5_sums=None):
+    """Writes an MD5SUM file in each volume directory, in the format of md5sum. The MD5 sums of
+    the data files are taken from the par2 files (or from known_md5_sums, a dict from (file
+    name, size) to MD5 hex string), so only the par2 files themselves (and any file par2
+    doesn't know about) are read. Those are hashed using up to jobs threads."""
+    dest_dirs = get_dest_dirs(inoutdir, prefix, num_volumes)
+    volume_files = [[(name, path) for name, path in files if name != MD5SUM_FILENAME]
+                        for files in list_volume_files(dest_dirs)]
+
+    known_md5_sums = dict(known_md5_sums or {})
+    known_md5_sums.update(get_known_md5_sums(volume_files))
+    md5_sums = {}
+    files_to_hash = []
+    for name, path in itertools.chain(*volume_files):
+        key = (name, os.path.getsize(path))
+        if key in known_md5_sums and not is_par2_file(name):
+            md5_sums[path] = known_md5_sums[key]
+        else:
+            files_to_hash.append(path)
+
+    md5_sums.update(zip(files_to_hash, run_in_parallel(md5_of_file, files_to_hash, jobs)))
+
+    for d, files in zip(dest_dirs, volume_files):
+        with open(os.path.join(d, MD5SUM_FILENAME), "w") as f:
+            for name, path in files:
+                f.write(format_md5sum_line(md5_sums[path], name))
+
+
+def verify(outdir, prefix, num_volumes, max_lost_volumes=1):
+    """Checks from the par2 packet headers and the file sizes that all files can be restored if
+    up to max_lost_volumes volumes are lost, without reading the data. Each recovery set is
+    checked on its own."""
+    dest_dirs = get_dest_dirs(outdir, prefix, num_volumes)
+    blocks = count_blocks_per_volume(list_volume_files(dest_dirs))
+    if not blocks:
+        print_wrap("Failure, no par2 recovery set found in the volumes.")
+        raise SystemExit(1)
+
+    total_data_blocks = [0] * num_volumes
+    total_recovery_blocks = [0] * num_volumes
+    for name, (data_blocks, recovery_exponents, missing_names) in sorted(blocks.items()):
+        if missing_names:
+            print_wrap("Failure, the following files protected by %s are not in any volume: %s" %
+                        (name, ", ".join(missing_names)))
+            raise SystemExit(1)
+
+        if len(blocks) > 1:
+            print("Recovery set %s:" % name)
+        print("Data blocks per volume: %s" % " ".join("%d" % n for n in data_blocks))
+        print("Recovery blocks per volume: %s" % " ".join("%d" % len(e) for e in recovery_exponents))
+        for i in range(num_volumes):
+            total_data_blocks[i] += data_blocks[i]
+            total_recovery_blocks[i] += len(recovery_exponents[i])
+
+        for num_lost_volumes in range(1, max_lost_volumes + 1):
+            failures = find_unrecoverable_volume_losses(data_blocks, recovery_exponents, num_lost_volumes)
+            if failures:
+                print("\n")
+                print_wrap("Failure, not all files are recoverable if volume(s) %s fail. " %
+                            ", ".join("+".join("%d" % (i+1) for i in lost) for lost in failures) +
+                            "This usually happens either because you have chosen your redundancy too low "
+                            "(try increasing it with the --redundancy option) or because your files are "
+                            "too few and/or are of vastly different sizes. A workaround is to split your "
+                            "large files.")
+                raise SystemExit(1)
+            print("Success, all files are recoverable if any %d volume(s) fail." % num_lost_volumes)
+
+    if len(blocks) > 1:
+        print("In total for %d recovery sets:" % len(blocks))
+        print("Data blocks per volume: %s" % " ".join("%d" % n for n in total_data_blocks))
+        print("Recovery blocks per volume: %s" % " ".join("%d" % n for n in total_recovery_blocks))
+
+
+def link_files(files, directory):
+    """Creates symbolic links in directory to files, given as (name, path) where the name is the
+    path of the link relative to directory, so that par2 can be run on files from several
+    volumes. Of files with the same name (e.g. the copies of the par2 index file in each volume)
+    the first one is linked."""
+    for name, src in files:
+        dst = os.path.abspath(os.path.join(directory, name))
+        if not os.path.lexists(dst):
+            make_parent_dirs(dst)
+            os.symlink(os.path.abspath(src), dst)
+
+
+def deep_verify_volume(outdir, par2_filename, dest_dirs, i):
+    """Runs par2 verify on all volumes except volume i and returns its exit code and output."""
+    skip_dir = dest_dirs[i]
+    test_dir = tempfile.mkdtemp(prefix="verify_%d_" % (i+1), dir=outdir)
+    try:
+        for link_dir in dest_dirs:
+            if link_dir != skip_dir:
+                link_files([(f, os.path.join(link_dir, f)) for f in list_files(link_dir)], test_dir)
+
+        start_time = time.time()
+        process = subprocess.Popen(["par2", "verify", par2_filename], cwd=test_dir,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.stdout.read()
+        process.stdout.close()
+        return_code, rusage = wait_for_process(process)
+        metrics.record_operation("par2", "verify %s without volume %d" % (par2_filename, i+1),
+                time.time() - start_time, rusage=rusage)
+        return return_code, output
+    finally:
+        shutil.rmtree(test_dir)
+
+
+def deep_verify(outdir, par2_filenames, prefix, num_volumes, jobs=1):
+    """Runs a full par2 verify of each recovery set without each of the volumes, up to jobs at
+    the same time."""
+    dest_dirs = get_dest_dirs(outdir, prefix, num_volumes)
+    checks = [(par2_filename, i) for par2_filename in par2_filenames for i in range(num_volumes)]
+
+    print("Verifying restorability without each volume using par2")
+    results = run_in_parallel(lambda check: deep_verify_volume(outdir, check[0], dest_dirs, check[1]),
+            checks, jobs)
+
+    failed = False
+    for (par2_filename, i), (return_code, output) in zip(checks, results):
+        name = (" for %s" % par2_filename) if len(par2_filenames) > 1 else ""
+        if return_code == 0:
+            print("Success, no recovery needed at all if volume %d fails%s." % (i+1, name))
+        elif return_code == 1:
+            print("Success, all files are recoverable if volume %d fails%s." % (i+1, name))
+        else:
+            print(output)
+            print_wrap("Failure, not all files are recoverable if volume %d fails%s. " % (i+1, name) +
+                        "This usually happens either because you have chosen your redundancy too low "
+                        "(try increasing it with the --redundancy option) or because your files are "
+                        "too few and/or are of vastly different sizes. A workaround is to split your "
+                        "large files.")
+            failed = True
+
+    if failed:
+        raise SystemExit(1)
+
+
+def parse_md5sum_file(path):
+    """Returns the (MD5 hex string, file name) pairs of a file in the format of md5sum."""
+    entries = []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            escaped = line.startswith("\\")
+            if escaped:
+                line = line[1:]
+            # The hash is followed by a space and then a space or (in binary mode) an asterisk.
+            md5_hex, name = line[:32], line[34:]
+            if escaped:
+                name = re.sub(r"\\(.)", lambda m: "\n" if m.group(1) == "n" else m.group(1), name)
+            entries.append((md5_hex.lower(), name))
+    return entries
+
+
+def advise_kernel(f, advice):
+    """Gives the kernel a hint about how the file f will be used, where posix_fadvise exists."""
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, getattr(os, advice))
+        except OSError:
+            pass
+
+
+def check_media_file(path, md5_hex):
+    """Reads a file from a medium and compares its MD5 to md5_hex. Returns the status ("ok",
+    "damaged", "unreadable" or "missing") and the number of bytes read. The kernel is told that
+    the file is read sequentially, so that it reads ahead, and to drop it from the page cache
+    afterwards, so that a later check reads the medium again."""
+    if not os.path.isfile(path):
+        return "missing", 0
+    md5 = hashlib.md5()
+    num_bytes = 0
+    try:
+        with open(path, "rb") as f:
+            advise_kernel(f, "POSIX_FADV_SEQUENTIAL")
+            while True:
+                chunk = f.read(MEDIA_READ_BUFFER_SIZE)
+                if not chunk:
+                    break
+                md5.update(chunk)
+                num_bytes += len(chunk)
+            advise_kernel(f, "POSIX_FADV_DONTNEED")
+    except (IOError, OSError):
+        return "unreadable", num_bytes
+    return ("ok" if md5.hexdigest() == md5_hex else "damaged"), num_bytes
+
+
+def check_volume(mount_point, lock, verbose=False):
+    """Checks all files listed in the MD5SUM file of a volume, in the order of their names (which
+    is the order of their data in the images written by --iso). Returns a dict with the status
+    of the volume and of each of its files, the number of bytes read and the time it took."""
+    start_time = time.time()
+    result = {"mount_point": mount_point, "files": [], "bytes": 0}
+    md5sum_path = os.path.join(mount_point, MD5SUM_FILENAME)
+    try:
+        entries = parse_md5sum_file(md5sum_path)
+    except (IOError, OSError):
+        with lock:
+            print_wrap("%s: can't read %s, so the volume can't be checked" % (mount_point, MD5SUM_FILENAME))
+        result.update(status="no %s" % MD5SUM_FILENAME, seconds=time.time() - start_time)
+        return result
+
+    for md5_hex, name in sorted(entries, key=lambda entry: entry[1]):
+        file_start_time = time.time()
+        status, num_bytes = check_media_file(os.path.join(mount_point, name), md5_hex)
+        seconds = time.time() - file_start_time
+        result["files"].append({"name": name, "status": status, "bytes": num_bytes, "seconds": seconds})
+        result["bytes"] += num_bytes
+        if status != "ok" or verbose:
+            with lock:
+                print("%s: %s: %s%s" % (mount_point, name, status, "" if status == "missing" else
+                        " (%.1f MB/s)" % (get_mb_per_second(num_bytes, seconds) or 0)))
+    result["seconds"] = time.time() - start_time
+    result["status"] = "ok" if all(f["status"] == "ok" for f in result["files"]) else "damaged"
+    with lock:
+        print("%s: %s, %d files, %.1f MB/s" % (mount_point, result["status"], len(result["files"]),
+                get_mb_per_second(result["bytes"], result["seconds"]) or 0))
+    return result
+
+
+def check_volumes(mount_points, verbose=False):
+    """Checks the volumes at mount_points, one thread per device so that the volumes on the same
+    device (e.g. several directories on one disk) are read one at a time and the drives don't
+    have to seek back and forth. Returns the result of check_volume for each mount point."""
+    devices = collections.OrderedDict()
+    for mount_point in mount_points:
+        devices.setdefault(os.stat(mount_point).st_dev, []).append(mount_point)
+    lock = threading.Lock()
+
+    def check_device(device_mount_points):
+        return [check_volume(mount_point, lock, verbose) for mount_point in device_mount_points]
+
+    results = {}
+    for device_results in run_in_parallel(check_device, list(devices.values()), len(devices)):
+        for result in device_results:
+            results[result["mount_point"]] = result
+    return [results[mount_point] for mount_point in mount_points]
+
+
+def assess_repair(volume_results):
+    """Estimates whether par2 can repair the files that are not intact, from the intact par2
+    files. Damaged files are counted as if all their blocks were lost, so this errs on the side
+    of caution. Returns a dict from recovery set name to (number of data blocks lost, number of
+    intact recovery blocks)."""
+    intact_files = [(f["name"], os.path.join(result["mount_point"], f["name"])) for result in volume_results
+                        for f in result["files"] if f["status"] == "ok"]
+    intact_names = set(name for name, path in intact_files if not is_par2_file(name))
+    intact_paths = [path for name, path in intact_files]
+    assessment = {}
+    for recovery_set in read_par2_recovery_sets([f for f in intact_paths if is_par2_file(f)]).values():
+        if recovery_set.slice_size is None:
+            continue
+        num_lost_blocks = sum(recovery_set.num_data_blocks(f) for f in recovery_set.files.values()
+                                if f.name not in intact_names)
+        assessment[recovery_set.get_name()] = (num_lost_blocks, len(recovery_set.recovery_exponents))
+    return assessment
+
+
+def check_media(argv):
+    parser = argparse.ArgumentParser(prog="%s check-media" % os.path.split(sys.argv[0])[-1], description=(
+        "Check burned volumes by reading back all files listed in the MD5SUM file of each volume. "
+        "Volumes on different devices are read at the same time. Lists the files that are damaged "
+        "or missing and estimates whether par2 can repair them."))
+    parser.add_argument("mount_points", metavar="MOUNT_POINT", nargs="+",
+            help="Where a volume is mounted, or a volume directory.")
+    parser.add_argument("-v", "--verbose", action="store_true",
+            help="Show the status of every file, not only of those that are not intact.")
+    args = parser.parse_args(argv)
+
+    for mount_point in args.mount_points:
+        if not os.path.isdir(mount_point):
+            print_wrap("%r is not a directory." % mount_point)
+            raise SystemExit(1)
+
+    volume_results = check_volumes(args.mount_points, args.verbose)
+
+    print("")
+    print("Volumes:")
+    for result in volume_results:
+        print("%s: %s, %d files, %.1f MB in %.1f seconds (%.1f MB/s)" % (
+                result["mount_point"], result["status"], len(result["files"]), result["bytes"] / (1024.0 * 1024.0),
+                result["seconds"], get_mb_per_second(result["bytes"], result["seconds"]) or 0))
+
+    bad_files = [(result["mount_point"], f) for result in volume_results for f in result["files"]
+                    if f["status"] != "ok"]
+    unchecked = [result["mount_point"] for result in volume_results if result["status"] not in ("ok", "damaged")]
+    if not bad_files and not unchecked:
+        print("")
+        print("All files are intact.")
+        return
+
+    bad_data_files = [(mount_point, f) for mount_point, f in bad_files if not is_par2_file(f["name"])]
+    bad_par2_files = [(mount_point, f) for mount_point, f in bad_files if is_par2_file(f["name"])]
+    if bad_data_files:
+        print("")
+        print("Files that need to be repaired with par2:")
+        for mount_point, f in bad_data_files:
+            print("%s (%s, %s)" % (f["name"], f["status"], mount_point))
+    if bad_par2_files:
+        print("")
+        print("Par2 files that are not intact (their recovery blocks can't be relied on):")
+        for mount_point, f in bad_par2_files:
+            print("%s (%s, %s)" % (f["name"], f["status"], mount_point))
+    if unchecked:
+        print("")
+        print_wrap("Volumes that could not be checked, and are counted as lost: %s" % ", ".join(unchecked))
+
+    print("")
+    assessment = assess_repair(volume_results)
+    if not assessment:
+        print_wrap("No intact par2 files were found, so it can't be assessed whether the files can be repaired.")
+    for name, (num_lost_blocks, num_recovery_blocks) in sorted(assessment.items()):
+        if num_lost_blocks <= num_recovery_blocks:
+            print_wrap("%s: repairable, %d data blocks at most are lost and %d recovery blocks are intact." % (
+                    name, num_lost_blocks, num_recovery_blocks))
+        else:
+            print_wrap("%s: possibly not repairable, up to %d data blocks are lost and only %d recovery "
+                        "blocks are intact. par2 only needs to replace the damaged blocks of the damaged "
+                        "files, so it may still succeed." % (name, num_lost_blocks, num_recovery_blocks))
+    raise SystemExit(1)
+
+
+def copy_readable_part(src, dst):
+    """Copies src to dst up to the first read error and returns the number of bytes copied. par2
+    can use the intact blocks of the part that could be read."""
+    num_bytes = 0
+    with open(dst, "wb") as fdst:
+        try:
+            with open(src, "rb") as fsrc:
+                while True:
+                    chunk = fsrc.read(MEDIA_READ_BUFFER_SIZE)
+                    if not chunk:
+                        break
+                    fdst.write(chunk)
+                    num_bytes += len(chunk)
+        except (IOError, OSError):
+            pass
+    return num_bytes
+
+
+def choose_recovery_files(recovery_files, num_blocks_needed):
+    """Chooses the par2 files to give par2 when repairing, given (path, number of recovery blocks)
+    for the intact par2 files of a recovery set. The index file (the one without recovery blocks,
+    or else the smallest) is always chosen, and then the files with the most recovery blocks
+    until there are num_blocks_needed, so that par2 has fewer files to read. All files are chosen
+    if they don't have enough recovery blocks."""
+    recovery_files = sorted(recovery_files, key=lambda item: (item[1], len(item[0]), item[0]))
+    chosen = [recovery_files[0]]
+    for item in reversed(recovery_files[1:]):
+        if sum(n for path, n in chosen) >= num_blocks_needed:
+            break
+        chosen.append(item)
+    return [path for path, n in chosen]
+
+
+def repair_recovery_set(recovery_set, par2_paths, intact, damaged, workdir, quiet=False):
+    """Repairs the files of a recovery set that are not among the intact files, with par2 in
+    workdir. The intact files and the damaged files that can be read are linked into workdir and
+    the chosen par2 files are staged there (par2 renames a damaged file and writes the repaired
+    one next to it, so the media are only read). Files with read errors are copied up to the first error instead,
+    since par2 stops at a read error. Returns a dict from name to path of the repaired files
+    (files that par2 found to be intact after all are still links to the volume, which are
+    resolved)."""
+    files = recovery_set.files_by_name()
+    lost = [name for name in files if name not in intact]
+    num_lost_blocks = sum(recovery_set.num_data_blocks(files[name]) for name in lost)
+
+    link_files([(name, intact[name]) for name in files if name in intact], workdir)
+    for name in lost:
+        if name not in damaged:
+            continue
+        path, status = damaged[name]
+        if status == "unreadable":
+            make_parent_dirs(os.path.join(workdir, name))
+            copy_readable_part(path, os.path.join(workdir, name))
+        else:
+            link_files([(name, path)], workdir)
+
+    # par2cmdline-turbo skips par2 files that are symbolic links, so they are staged as real
+    # files (they are small compared to the data files).
+    par2_files = choose_recovery_files(par2_paths, num_lost_blocks)
+    for path in par2_files:
+        dst = os.path.join(workdir, os.path.split(path)[-1])
+        if not os.path.lexists(dst):
+            stage_file(path, dst)
+
+    execute_and_throw_if_error(["par2", "repair", "--", os.path.split(par2_files[0])[-1]], cwd=workdir,
+            quiet=quiet, description=recovery_set.get_name(),
+            num_bytes=sum(f.length for f in files.values()))
+    return dict((name, os.path.realpath(os.path.join(workdir, name))) for name in lost)
+
+
+def restore_file(path, outdir, password, quiet=False, extract=True, move=False, name=None):
+    """Extracts the 7z archive at path into outdir if extract is set. Otherwise, or if it isn't
+    an archive, the file is moved there if move is set (for repaired files), and else reflinked
+    or copied (a hard link would let changes to the restored file alter the volume). name is
+    the path of the file in the volume, which is kept relative to outdir, by default its file
+    name."""
+    name = name if name is not None else os.path.split(path)[-1]
+    if not extract or os.path.splitext(name)[-1] != ".7z":
+        if move:
+            move_file(path, outdir, name)
+        else:
+            make_parent_dirs(os.path.join(outdir, name))
+            stage_file(path, os.path.join(outdir, name), "reflink")
+        return
+    execute_and_throw_if_error([
+                '7z',
+                'x',
+                '-y',
+                ('-p%s' % password) if password else None,
+                '-o%s' % os.path.join(outdir, os.path.dirname(name)),
+                '--',
+                path],
+            cwd=None, quiet=quiet, description=name, num_bytes=os.path.getsize(path))
+
+
+def restore(argv):
+    parser = argparse.ArgumentParser(prog="%s restore" % os.path.split(sys.argv[0])[-1], description=(
+        "Restore the files from a set of volumes, repairing with par2 what is damaged or missing. "
+        "The files listed in the MD5SUM file of each volume are checked first (volumes on different "
+        "devices at the same time), and par2 is only run for the recovery sets that have files that "
+        "are not intact, with no more of the recovery volumes than it needs. The files are then "
+        "decompressed (and decrypted) in parallel."))
+    parser.add_argument("mount_points", metavar="MOUNT_POINT", nargs="+",
+            help="Where a volume is mounted, or a volume directory. Volumes that are lost are simply left out.")
+    parser.add_argument("-o", "--outdir", metavar="DIR", required=True,
+            help="Restore the files into this directory.")
+    parser.add_argument("-t", "--tmpdir", "--tempdir", metavar="DIR",
+            help="The directory to repair files in. Needs room for the files that are repaired. "
+                    "Default: output directory.")
+    parser.add_argument("-e", "--encrypted", action="store_true",
+            help="The files are encrypted. You will be prompted for the password.")
+    parser.add_argument("--keep-archives", action="store_true",
+            help="Restore the .7z files as they are instead of extracting them.")
+    parser.add_argument("-j", "--jobs", metavar="N", type=check_integer_equal_or_greater(1),
+            default=get_default_num_jobs(),
+            help="Number of files to extract, and of recovery sets to repair, at the same time. "
+                    "Default: %(default)s.")
+    parser.add_argument("-v", "--verbose", action="store_true",
+            help="Show the status of every file, not only of those that are not intact.")
+    args = parser.parse_args(argv)
+
+    for mount_point in args.mount_points:
+        if not os.path.isdir(mount_point):
+            print_wrap("%r is not a directory." % mount_point)
+            raise SystemExit(1)
+    outdir = args.outdir
+    tmpdir = args.tmpdir or outdir
+    create_dir_if_not_exists_or_fail(outdir)
+    create_dir_if_not_exists_or_fail(tmpdir)
+
+    password = None
+    if args.encrypted:
+        password = raw_input("Password: ")
+
+    with metrics.stage("check"):
+        volume_results = check_volumes(args.mount_points, args.verbose)
+
+    # The first intact copy of each file (the par2 index files are in every volume), and the
+    # files that are not intact. The files of volumes without an MD5SUM file can't be checked,
+    # so they are left to par2 to check.
+    intact = {}
+    damaged = {}
+    for result in volume_results:
+        files = result["files"]
+        if result["status"] not in ("ok", "damaged"):
+            files = [{"name": f, "status": "damaged"} for f in list_files(result["mount_point"])]
+        for f in files:
+            path = os.path.join(result["mount_point"], f["name"])
+            if f["status"] == "ok":
+                intact.setdefault(f["name"], path)
+            elif f["status"] != "missing":
+                damaged.setdefault(f["name"], (path, f["status"]))
+
+    recovery_sets = {}
+    recovery_files = collections.defaultdict(list)
+    for name, path in sorted(intact.items()):
+        if is_par2_file(name):
+            for set_id, recovery_set in read_par2_recovery_sets([path]).items():
+                recovery_sets.setdefault(set_id, Par2RecoverySet(set_id)).merge(recovery_set)
+                recovery_files[set_id].append((path, len(recovery_set.recovery_exponents)))
+    recovery_sets = dict((set_id, recovery_set) for set_id, recovery_set in recovery_sets.items()
+                            if recovery_set.slice_size is not None)
+
+    # The parts of split files are joined and the containers of packed files unpacked after they
+    # are extracted, unless the archives are kept, in which case the manifests are restored along
+    # with them.
+    split_entries = []
+    packed_entries = []
+    not_restored = [MD5SUM_FILENAME]
+    if not args.keep_archives:
+        not_restored += [SPLIT_MANIFEST_FILENAME, PACKED_MANIFEST_FILENAME]
+        if SPLIT_MANIFEST_FILENAME in intact:
+            split_entries = parse_split_manifest(intact[SPLIT_MANIFEST_FILENAME])
+        if PACKED_MANIFEST_FILENAME in intact:
+            packed_entries = parse_packed_manifest(intact[PACKED_MANIFEST_FILENAME])
+    sources = dict((name, path) for name, path in intact.items()
+                    if not is_par2_file(name) and name not in not_restored)
+    to_repair = sorted((recovery_set for recovery_set in recovery_sets.values()
+                            if any(name not in intact for name in recovery_set.files_by_name())),
+                        key=lambda recovery_set: recovery_set.get_name())
+    lost = set(name for name in damaged if not is_par2_file(name) and name not in not_restored)
+    for recovery_set in recovery_sets.values():
+        lost.update(name for name in recovery_set.files_by_name() if name not in intact)
+    print("")
+    print_wrap("%d files are intact and %d need to be repaired, in %d of %d recovery sets." % (
+            len(sources), len(lost), len(to_repair), len(recovery_sets)))
+
+    restore_names = sorted(set(sources) | lost)
+    if not args.keep_archives:
+        restore_names = [re.sub(r"\.7z$", "", name) for name in restore_names]
+    restore_names += [name for name, size, num_parts in split_entries]
+    existing = [name for name in restore_names if os.path.exists(os.path.join(outdir, name))]
+    if existing:
+        print_wrap("Files already exist in the output directory, remove them first: %s" % ", ".join(existing))
+        raise SystemExit(1)
+
+    lock = threading.Lock()
+    quiet = args.jobs > 1 and len(to_repair) > 1
+    failed_sets = []
+    workdirs = []
+
+    def repair(recovery_set):
+        workdir = os.path.realpath(tempfile.mkdtemp(prefix="restore_", dir=tmpdir))
+        with lock:
+            workdirs.append(workdir)
+            print_wrap("Repairing %s" % recovery_set.get_name())
+        try:
+            repaired = repair_recovery_set(recovery_set, recovery_files[recovery_set.set_id], intact, damaged,
+                                            workdir, quiet)
+        except ExecutionFailed as e:
+            with lock:
+                print_execution_output(e)
+                print_wrap("Couldn't repair %s" % recovery_set.get_name())
+                failed_sets.append(recovery_set.get_name())
+            return
+        with lock:
+            sources.update(repaired)
+
+    try:
+        with metrics.stage("repair"):
+            run_in_parallel(repair, to_repair, args.jobs)
+
+        unrestorable = sorted(lost - set(sources))
+        to_restore = sorted(sources.items())
+        num_done = [0]
+        extract_failed = []
+        quiet = args.jobs > 1
+
+        def restore_one(item):
+            name, path = item
+            try:
+                restore_file(path, outdir, password, quiet, extract=not args.keep_archives,
+                             move=any(path.startswith(workdir + os.sep) for workdir in workdirs), name=name)
+            except (ExecutionFailed, IOError, OSError) as e:
+                with lock:
+                    if isinstance(e, ExecutionFailed):
+                        print_execution_output(e)
+                    print_wrap("Couldn't restore file %r" % name)
+                    extract_failed.append(name)
+                return
+            if quiet:
+                with lock:
+                    num_done[0] += 1
+                    print("Restored file %d of %d" % (num_done[0], len(to_restore)))
+
+        with metrics.stage("extract", sum(os.path.getsize(path) for name, path in to_restore)):
+            run_in_parallel(restore_one, to_restore, args.jobs,
+                    sizes=[os.path.getsize(path) for name, path in to_restore])
+
+        join_failed = []
+        if split_entries:
+            with metrics.stage("join", sum(size for name, size, num_parts in split_entries)):
+                join_failed = join_split_files(outdir, split_entries)
+
+        unpack_failed = []
+        if packed_entries:
+            with metrics.stage("unpack", sum(os.path.getsize(os.path.join(outdir, name))
+                                             for name, num_files in packed_entries
+                                             if os.path.isfile(os.path.join(outdir, name)))):
+                unpack_failed = unpack_containers(outdir, packed_entries)
+    finally:
+        for workdir in workdirs:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print("")
+    print("Time statistics:")
+    stage_labels = {"check": "Checking the volumes", "repair": "Repair", "extract": "Restoring the files",
+                    "join": "Joining split files", "unpack": "Unpacking small files"}
+    for stage in metrics.stages:
+        print("%s: %.1f seconds (%.1f MB/s)" % (stage_labels[stage["name"]], stage["wall_seconds"],
+                stage["mb_per_second"] or 0))
+    print("")
+
+    if failed_sets:
+        print_wrap("Recovery sets that could not be repaired: %s" % ", ".join(failed_sets))
+    if unrestorable:
+        print_wrap("Files that could not be restored: %s" % ", ".join(unrestorable))
+    if extract_failed:
+        print_wrap("Files that could not be extracted: %s" % ", ".join(sorted(extract_failed)))
+    if join_failed:
+        print_wrap("Split files whose parts could not be joined: %s" % ", ".join(join_failed))
+    if unpack_failed:
+        print_wrap("Containers of small files that could not be unpacked: %s" % ", ".join(unpack_failed))
+    if failed_sets or unrestorable or extract_failed or join_failed or unpack_failed:
+        raise SystemExit(1)
+    print_wrap("Restored %d files into %r." % (len(to_restore) - sum(n for name, size, n in split_entries) +
+                                                len(split_entries) - len(packed_entries) +
+                                                sum(n for name, n in packed_entries), outdir))
+
+
+def get_par2_set_name(par2_filename):
+    """Returns the name of the index file of the recovery set a par2 file belongs to."""
+    return re.sub(r"\.vol\d+\+\d+\.par2$", ".par2", par2_filename)
+
+
+def get_size_statistics(outdir, prefix, num_volumes):
+    """Returns the total size of each volume, the size of the par2 files in each volume, and the
+    total size of the par2 files of each recovery set."""
+    dest_dirs = get_dest_dirs(outdir, prefix, num_volumes)
+
+    volume_sizes = []
+    par2_sizes = []
+    par2_set_sizes = collections.defaultdict(int)
+    for d in dest_dirs:
+        volume_sizes.append(0)
+        par2_sizes.append(0)
+        for f, size in scan_files(d).items():
+            volume_sizes[-1] += size
+            if os.path.splitext(f)[-1] == ".par2":
+                par2_sizes[-1] += size
+                par2_set_sizes[get_par2_set_name(f)] += size
+
+    return volume_sizes, par2_sizes, dict(par2_set_sizes)
+
+
+
+def both_endian_16(n):
+    return struct.pack("<H", n) + struct.pack(">H", n)
+
+
+def both_endian_32(n):
+    return struct.pack("<I", n) + struct.pack(">I", n)
+
+
+def iso_recording_time(t):
+    tm = time.gmtime(t)
+    return struct.pack("7B", tm.tm_year - 1900, tm.tm_mon, tm.tm_mday, tm.tm_hour, tm.tm_min, tm.tm_sec, 0)
+
+
+def iso_volume_time(t):
+    return time.strftime("%Y%m%d%H%M%S00", time.gmtime(t)).encode("ascii") + b"\0"
+
+
+def iso_directory_record(identifier, sector, size, mtime, flags=0):
+    padding = b"\0" if len(identifier) % 2 == 0 else b""
+    return (struct.pack("<BB", 33 + len(identifier) + len(padding), 0) + both_endian_32(sector) +
+            both_endian_32(size) + iso_recording_time(mtime) + struct.pack("<BBB", flags, 0, 0) +
+            both_endian_16(1) + struct.pack("<B", len(identifier)) + identifier + padding)
+
+
+def pack_iso_directory_records(records):
+    """Concatenates directory records, which may not cross a sector boundary, into whole sectors."""
+    data = b""
+    for record in records:
+        if len(data) % ISO_SECTOR_SIZE + len(record) > ISO_SECTOR_SIZE:
+            data += b"\0" * (-len(data) % ISO_SECTOR_SIZE)
+        data += record
+    return data + b"\0" * (-len(data) % ISO_SECTOR_SIZE)
+
+
+def to_unicode(name):
+    return name if isinstance(name, type(u"")) else name.decode("utf-8")
+
+
+def check_iso_filename(name):
+    """Returns why name (a path relative to the volume) can't be stored with its name intact in
+    an ISO image, or None if it can."""
+    if iso_filename_regexp.match(name):
+        return None
+    components = to_unicode(name).split(os.sep)
+    if len(components) - 1 > ISO_MAX_DIRECTORY_DEPTH:
+        return "it is in more than %d levels of directories" % ISO_MAX_DIRECTORY_DEPTH
+    for component in components:
+        subject = "it" if len(components) == 1 else "%r in it" % component
+        if len(component) > ISO_JOLIET_MAX_NAME_LENGTH:
+            return "%s is longer than %d characters" % (subject, ISO_JOLIET_MAX_NAME_LENGTH)
+        if any(c in ISO_JOLIET_FORBIDDEN_CHARACTERS for c in component):
+            return "%s contains one of the characters %s" % (subject, ISO_JOLIET_FORBIDDEN_CHARACTERS)
+    return None
+
+
+def get_iso_primary_identifiers(names):
+    """Returns a dict from file name to the identifier used in the ISO 9660 directory, which
+    only allows 30 upper case letters, digits and underscores plus an extension. Programs that
+    read Joliet see the real names."""
+    identifiers = {}
+    used = set()
+    for name in sorted(names):
+        base, extension = os.path.splitext(to_unicode(name))
+        base = re.sub(r"[^A-Z0-9_]", "_", base.upper()) or "_"
+        extension = re.sub(r"[^A-Z0-9_]", "_", extension[1:].upper())[:8]
+        candidate = base[:30 - len(extension)]
+        n = 1
+        while (candidate, extension) in used:
+            suffix = "_%d" % n
+            candidate = base[:30 - len(extension) - len(suffix)] + suffix
+            n += 1
+        used.add((candidate, extension))
+        identifiers[name] = ("%s.%s;1" % (candidate, extension)).encode("ascii")
+    return identifiers
+
+
+def get_iso_primary_directory_identifiers(names):
+    """Returns a dict from directory name to the identifier used in the ISO 9660 directory it
+    is in, which only allows 31 upper case letters, digits and underscores."""
+    identifiers = {}
+    used = set()
+    for name in sorted(names):
+        base = re.sub(r"[^A-Z0-9_]", "_", to_unicode(name).upper()) or "_"
+        candidate = base[:31]
+        n = 1
+        while candidate in used:
+            suffix = "_%d" % n
+            candidate = base[:31 - len(suffix)] + suffix
+            n += 1
+        used.add(candidate)
+        identifiers[name] = candidate.encode("ascii")
+    return identifiers
+
+
+def iso_identifier_sort_key(identifier, separator, padding):
+    """Directory records are sorted by name and then extension, each padded with spaces."""
+    if separator not in identifier:
+        return (identifier + padding * 64, b"")
+    base, _, extension = identifier.rpartition(separator)
+    return (base + padding * 64, extension)
+
+
+class IsoImage(object):
+    """An ISO 9660 image with Joliet names of a set of files in a tree of directories, with the
+    layout
+
+        0-15    System area (empty)
+        16      Primary volume descriptor
+        17      Supplementary volume descriptor (Joliet)
+        18      Volume descriptor set terminator
+        19-     Path tables (little and big endian for each of the descriptors), then the
+                directories, then the Joliet directories, then the files
+
+    The directories of each tree are in the order of its path table: by level, then by parent
+    directory and then by name. The files are in the order of their paths. The layout is
+    computed up front, so the size of the image is known before it is written. The image is
+    then written sequentially in a single pass."""
+
+    def __init__(self, files, volume_id, sizes=None):
+        """files are the (name, path) of the files to store, where the name is the path of the
+        file in the image. If sizes, a dict from name to size, is given the files aren't looked
+        at, so that the layout (and size) of an image can be worked out before the files exist."""
+        files = sorted(files)
+        self.names = [name for name, path in files]
+        self.paths = [path for name, path in files]
+        self.indices = dict((name, i) for i, name in enumerate(self.names))
+        self.volume_id = volume_id
+        self.creation_time = time.time()
+        if sizes is None:
+            stats = [os.stat(path) for path in self.paths]
+            self.sizes = [st.st_size for st in stats]
+            self.mtimes = [st.st_mtime for st in stats]
+        else:
+            self.sizes = [sizes[name] for name in self.names]
+            self.mtimes = [self.creation_time] * len(self.names)
+
+        # The paths of the files and directories in each directory, by its path ("" is the root).
+        self.children = collections.defaultdict(set)
+        for name in self.names:
+            child = name
+            while child:
+                parent = os.path.dirname(child)
+                self.children[parent].add(child)
+                child = parent
+        self.directories = set(self.children) | set([""])
+
+        self.identifiers = {False: {}, True: {}}
+        for d in self.directories:
+            names = [os.path.split(child)[-1] for child in self.children[d] if child not in self.directories]
+            dir_names = [os.path.split(child)[-1] for child in self.children[d] if child in self.directories]
+            for identifiers in (get_iso_primary_identifiers(names),
+                                get_iso_primary_directory_identifiers(dir_names)):
+                self.identifiers[False].update((os.path.join(d, name), identifier)
+                                                for name, identifier in identifiers.items())
+            self.identifiers[True].update((child, to_unicode(os.path.split(child)[-1]).encode("utf-16-be"))
+                                            for child in self.children[d])
+
+        # The sizes of the path tables and directories don't depend on the locations and sizes in
+        # them, so the layout can be computed from their sizes with placeholder values.
+        self.directory_order = dict((joliet, self.get_path_table_order(joliet)) for joliet in (False, True))
+        self.directory_sectors = dict((joliet, dict((d, 0) for d in self.directories)) for joliet in (False, True))
+        self.directory_sizes = dict((joliet, dict((d, 0) for d in self.directories)) for joliet in (False, True))
+        self.file_sectors = [0] * len(self.paths)
+        self.path_table_sizes = {}
+        self.path_table_sectors = {}
+        sector = ISO_FIRST_PATH_TABLE_SECTOR
+        for joliet in (False, True):
+            self.path_table_sizes[joliet] = len(self.get_path_table(joliet, "<"))
+            num_sectors = (self.path_table_sizes[joliet] + ISO_SECTOR_SIZE - 1) // ISO_SECTOR_SIZE
+            self.path_table_sectors[joliet] = (sector, sector + num_sectors)
+            sector += 2 * num_sectors
+        for joliet in (False, True):
+            for d in self.directory_order[joliet]:
+                self.directory_sectors[joliet][d] = sector
+                self.directory_sizes[joliet][d] = len(self.get_directory(joliet, d))
+                sector += self.directory_sizes[joliet][d] // ISO_SECTOR_SIZE
+        for i, size in enumerate(self.sizes):
+            self.file_sectors[i] = sector
+            sector += (size + ISO_SECTOR_SIZE - 1) // ISO_SECTOR_SIZE
+        self.num_sectors = sector
+        self.size = self.num_sectors * ISO_SECTOR_SIZE
+
+    def get_sort_key(self, joliet, name):
+        if joliet:
+            return iso_identifier_sort_key(self.identifiers[True][name], b"\0.", b"\0 ")
+        return iso_identifier_sort_key(self.identifiers[False][name], b".", b" ")
+
+    def get_path_table_order(self, joliet):
+        order = [""]
+        level = [""]
+        while level:
+            level = [subdir for d in level for subdir in sorted(
+                        (child for child in self.children[d] if child in self.directories),
+                        key=lambda child: self.get_sort_key(joliet, child))]
+            order += level
+        return order
+
+    def get_path_table(self, joliet, byte_order):
+        order = self.directory_order[joliet]
+        numbers = dict((d, i + 1) for i, d in enumerate(order))
+        records = []
+        for d in order:
+            identifier = self.identifiers[joliet][d] if d else b"\0"
+            records.append(struct.pack(byte_order + "BBIH", len(identifier), 0, self.directory_sectors[joliet][d],
+                                        numbers[os.path.dirname(d)]) +
+                           identifier + (b"\0" if len(identifier) % 2 else b""))
+        return b"".join(records)
+
+    def get_directory(self, joliet, d):
+        sectors, sizes = self.directory_sectors[joliet], self.directory_sizes[joliet]
+        parent = os.path.dirname(d)
+        records = [iso_directory_record(b"\0", sectors[d], sizes[d], self.creation_time, 2),
+                   iso_directory_record(b"\1", sectors[parent], sizes[parent], self.creation_time, 2)]
+        for name in sorted(self.children[d], key=lambda name: self.get_sort_key(joliet, name)):
+            identifier = self.identifiers[joliet][name]
+            if name in self.directories:
+                records.append(iso_directory_record(identifier, sectors[name], sizes[name], self.creation_time, 2))
+                continue
+            i = self.indices[name]
+            num_extents = max(1, (self.sizes[i] + ISO_MAX_EXTENT_SIZE - 1) // ISO_MAX_EXTENT_SIZE)
+            for j in range(num_extents):
+                extent_size = min(ISO_MAX_EXTENT_SIZE, self.sizes[i] - j * ISO_MAX_EXTENT_SIZE)
+                records.append(iso_directory_record(identifier,
+                        self.file_sectors[i] + j * (ISO_MAX_EXTENT_SIZE // ISO_SECTOR_SIZE), extent_size,
+                        self.mtimes[i], 0x80 if j < num_extents - 1 else 0))
+        return pack_iso_directory_records(records)
+
+    def get_volume_descriptor(self, joliet):
+        if joliet:
+            text = lambda s, n: (s.encode("utf-16-be") + b"\0 " * n)[:n]
+        else:
+            text = lambda s, n: (s.encode("ascii") + b" " * n)[:n]
+        l_path_table_sector, m_path_table_sector = self.path_table_sectors[joliet]
+        volume_id = to_unicode(self.volume_id)
+        if not joliet:
+            volume_id = re.sub(r"[^A-Z0-9_]", "_", volume_id.upper())
+
+        descriptor = (struct.pack("<B", 2 if joliet else 1) + b"CD001\x01\0" + text(u"", 32) +
+                text(volume_id, 32) + b"\0" * 8 + both_endian_32(self.num_sectors) +
+                # The escape sequence for UCS-2 level 3 marks the descriptor as Joliet.
+                (b"%/E" + b"\0" * 29 if joliet else b"\0" * 32) +
+                both_endian_16(1) + both_endian_16(1) + both_endian_16(ISO_SECTOR_SIZE) +
+                both_endian_32(self.path_table_sizes[joliet]) + struct.pack("<II", l_path_table_sector, 0) +
+                struct.pack(">II", m_path_table_sector, 0) +
+                iso_directory_record(b"\0", self.directory_sectors[joliet][""], self.directory_sizes[joliet][""],
+                                     self.creation_time, 2) +
+                text(u"", 128) * 3 + text(u"CREATE_PAR2.PY", 128) + text(u"", 37) * 3 +
+                iso_volume_time(self.creation_time) * 2 + (b"0" * 16 + b"\0") * 2 + b"\x01\0")
+        return descriptor + b"\0" * (ISO_SECTOR_SIZE - len(descriptor))
+
+    def get_header(self):
+        """Returns everything in the image before the data of the first file."""
+        terminator = b"\xffCD001\x01"
+        path_tables = b""
+        for joliet in (False, True):
+            for byte_order in "<>":
+                path_table = self.get_path_table(joliet, byte_order)
+                path_tables += path_table + b"\0" * (-len(path_table) % ISO_SECTOR_SIZE)
+        return (b"\0" * (16 * ISO_SECTOR_SIZE) + self.get_volume_descriptor(False) +
+                self.get_volume_descriptor(True) + terminator + b"\0" * (ISO_SECTOR_SIZE - len(terminator)) +
+                path_tables + b"".join(self.get_directory(joliet, d)
+                                        for joliet in (False, True) for d in self.directory_order[joliet]))
+
+    def write(self, image_path, remove_files=False):
+        """Writes the image in a single sequential pass, copying the data of each file with
+        copy_file_range where possible. If remove_files is set, the files are removed as soon as
+        they have been copied, so that no more than one extra copy of the data exists at a time."""
+        with open(image_path, "wb", 0) as image:
+            header = self.get_header()
+            assert not self.paths or len(header) == self.file_sectors[0] * ISO_SECTOR_SIZE
+            image.write(header)
+            for path, size in zip(self.paths, self.sizes):
+                with open(path, "rb") as f:
+                    if os.fstat(f.fileno()).st_size != size:
+                        raise IOError("%r changed while writing the image" % path)
+                    copy_file_contents(f, image)
+                image.write(b"\0" * (-size % ISO_SECTOR_SIZE))
+            os.fsync(image.fileno())
+        if os.path.getsize(image_path) != self.size:
+            raise IOError("The image %r has the wrong size" % image_path)
+        if remove_files:
+            for path in self.paths:
+                os.remove(path)
+
+
+def get_iso_paths(outdir, prefix, num_volumes):
+    return [d + ".iso" for d in get_dest_dirs(outdir, prefix, num_volumes)]
+
+
+def write_iso_images(outdir, prefix, num_volumes, capacity=None):
+    """Writes each volume directory as an ISO image next to it and removes the directory. Each
+    image is written to a temporary name and renamed when complete, and volumes whose directory
+    is already gone are skipped, so an interrupted run can be resumed. Fails before writing
+    anything if an image would be larger than capacity. Returns the sizes of the images."""
+    dest_dirs = get_dest_dirs(outdir, prefix, num_volumes)
+    iso_paths = get_iso_paths(outdir, prefix, num_volumes)
+    images = []
+    for i, d in enumerate(dest_dirs):
+        if not os.path.isdir(d):
+            images.append(None)
+            continue
+        image = IsoImage(list_volume_files([d])[0], os.path.split(d)[-1])
+        if capacity is not None and image.size > capacity:
+            print_wrap("The image of volume %d would be %d bytes, which doesn't fit on the media "
+                        "(%d bytes). Use more volumes. The volume directories are left in place." % (
+                            i+1, image.size, capacity))
+            raise SystemExit(1)
+        images.append(image)
+
+    for i, (d, iso_path, image) in enumerate(zip(dest_dirs, iso_paths, images)):
+        if image is None:
+            continue
+        print("Writing image %d of %d" % (i+1, num_volumes))
+        image.write(iso_path + ".tmp", remove_files=True)
+        os.rename(iso_path + ".tmp", iso_path)
+        # Only the directories the files were in are left.
+        shutil.rmtree(d)
+    return [os.path.getsize(iso_path) for iso_path in iso_paths]
+
+
+def estimate_iso_image_sizes(volume_sizes, spread_files, common_files):
+    """Estimates the size of the image of each volume from the sizes of the volumes, the sizes
+    of the files spread over them (spread_files, a list of dicts from name to size, each file
+    in one of the volumes) and of the files that every volume has (common_files, a dict from
+    name to size), without laying out the images like IsoImage. Only sums over the files and
+    their directories are needed: each file adds its padding to whole sectors and a record in
+    both directory trees, and each directory with n files in its subtree is assumed to be in
+    min(n, number of volumes) of them, with an equal share of the records. The images are
+    assumed to share the padding and directories evenly."""
+    num_volumes = len(volume_sizes)
+    padding = 0
+    # The number of files in each directory, and the bytes of their records in the primary
+    # and the Joliet directory, summed over the volumes.
+    num_files = collections.Counter()
+    record_sizes = {False: collections.Counter(), True: collections.Counter()}
+    for files, copies in [(d, 1) for d in spread_files] + [(common_files, num_volumes)]:
+        sizes = list(files.values())
+        # The files are counted by directory and length of name without a loop in Python, and
+        # only those counts are gone through one by one.
+        parts = list(map(operator.methodcaller("rpartition", os.sep), files))
+        names_by_length = collections.Counter(zip(map(operator.itemgetter(0), parts),
+                                                  map(len, map(operator.itemgetter(2), parts))))
+        num_sectors = sum(map(operator.floordiv, map((ISO_SECTOR_SIZE - 1).__add__, sizes),
+                              itertools.repeat(ISO_SECTOR_SIZE)))
+        padding += (num_sectors * ISO_SECTOR_SIZE - sum(sizes)) * copies
+        for (d, length), n in names_by_length.items():
+            num_files[d] += n * copies
+        if sizes and max(sizes) > ISO_MAX_EXTENT_SIZE:
+            # The large files have a record for each extent.
+            for (d, _, base), size in zip(parts, sizes):
+                names_by_length[d, len(base)] += (size - 1) // ISO_MAX_EXTENT_SIZE
+        for (d, length), n in names_by_length.items():
+            # The primary identifier has at most 30 characters plus ".;1", the Joliet one two
+            # bytes per character, and both are padded to an even length. (With Python 2 the
+            # length of the name is in bytes of UTF-8, which can only overestimate.)
+            record_sizes[False][d] += (34 + min(length, 30) + 3) * n * copies
+            record_sizes[True][d] += (34 + 2 * length) * n * copies
+
+    # Each directory is in the volumes of the files in its subtree, and has a record in its
+    # parent in each of them.
+    num_files_in_subtree = collections.Counter()
+    for d, n in num_files.items():
+        while d:
+            num_files_in_subtree[d] += n
+            d = os.path.dirname(d)
+    num_copies = dict((d, min(n, num_volumes)) for d, n in num_files_in_subtree.items())
+    num_copies[""] = num_volumes
+    path_table_size = {False: 0, True: 0}
+    for d, copies in num_copies.items():
+        base = os.path.split(d)[-1]
+        for joliet, length in ((False, min(len(base), 31)), (True, 2 * len(to_unicode(base)))):
+            if d:
+                record_sizes[joliet][os.path.dirname(d)] += (33 + length + (length + 1) % 2) * copies
+            path_table_size[joliet] += (8 + max(length, 1) + max(length, 1) % 2) * copies
+
+    # The directories of a tree hold a record of their own and of their parent besides those of
+    # their files and subdirectories.
+    directory_sectors = 0
+    for joliet in (False, True):
+        for d, copies in num_copies.items():
+            size_per_copy = 2 * 34 + float(record_sizes[joliet][d]) / copies
+            directory_sectors += copies * int(math.ceil(size_per_copy / ISO_SECTOR_SIZE))
+    header_sectors = ISO_FIRST_PATH_TABLE_SECTOR + sum(
+            2 * int(math.ceil(float(size) / num_volumes / ISO_SECTOR_SIZE)) for size in path_table_size.values())
+    overhead = header_sectors * ISO_SECTOR_SIZE + float(directory_sectors * ISO_SECTOR_SIZE + padding) / num_volumes
+    return [int(math.ceil((size + overhead) / ISO_SECTOR_SIZE)) * ISO_SECTOR_SIZE for size in volume_sizes]
+
+
+def estimate_volume_size(total_size, num_files, num_volumes, redundancy):
+    """Estimates the size of the largest volume (and image) from the total size of the data,
+    assuming that compression doesn't make the files larger, a few percent of unevenness and
+    block padding, and on average half a sector of padding per file in an image."""
+    data_per_volume = float(total_size) / (num_volumes - float(redundancy))
+    return int(data_per_volume * 1.03 + (num_files / float(num_volumes) + 100) * ISO_SECTOR_SIZE)
+
+
+def get_prepared_filename(name, compress):
+    return ("%s.7z" % name) if compress else name
+
+
+def get_file_signature(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+
+def to_native_strings(value):
+    """Converts the unicode strings json gives on Python 2 to str."""
+    if isinstance(value, dict):
+        return dict((to_native_strings(k), to_native_strings(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [to_native_strings(v) for v in value]
+    if not isinstance(value, str) and isinstance(value, type(u"")):
+        return value.encode("utf-8")
+    return value
+
+
+class Journal(object):
+    """Records the progress of a run in a JSON file, so that an interrupted run can be continued
+    with --resume. It records the parameters of the run, its temporary directory, the stages
+    that are done, the size and modification time of each prepared (compressed or staged) file
+    and of its input, and the par2 files of each recovery set. If the files are encrypted, the
+    parameters also hold a salted hash of the password, so that a run is not resumed with
+    another password. With no path nothing is written.
+
+    The first line of the file is the whole state, written by save() when a stage is done or a
+    recovery set has its par2 files. Each prepared file is appended as a line of its own, so
+    that recording a file costs the same however many there are. load() reads the appended
+    lines into the state and writes it as a single line again."""
+
+    STAGES = ["prepare", "par2", "move", "md5", "verify", "iso"]
+
+    def __init__(self, path, parameters, tmpdir):
+        self.path = path
+        self.lock = threading.Lock()
+        self.log = None
+        self.state = {"parameters": parameters, "tmpdir": tmpdir, "stages": [], "files": {}, "par2_sets": {}}
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            lines = f.read().splitlines()
+        state = to_native_strings(json.loads(lines[0]))
+        for line in lines[1:]:
+            try:
+                record = to_native_strings(json.loads(line))
+            except ValueError:
+                # The last line is cut short if the run was killed while writing it.
+                break
+            state["files"][record["outfile"]] = record["entry"]
+        journal = cls(path, state["parameters"], state["tmpdir"])
+        journal.state = state
+        journal.save()
+        return journal
+
+    def close_log(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            self.close_log()
+            with open(self.path + ".tmp", "w") as f:
+                f.write(json.dumps(self.state, sort_keys=True) + "\n")
+            os.rename(self.path + ".tmp", self.path)
+
+    def remove(self):
+        with self.lock:
+            self.close_log()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    @staticmethod
+    def get_password_verifier(password, salt=None):
+        """Returns [salt, hash of password] as hex strings, with a new random salt if none is
+        given."""
+        salt = salt if salt is not None else binascii.hexlify(os.urandom(16)).decode("ascii")
+        return [salt, get_password_digest(password, binascii.unhexlify(salt)).decode("ascii")]
+
+    def is_password_right(self, password):
+        verifier = self.state["parameters"].get("password_verifier")
+        return verifier is not None and self.get_password_verifier(password, verifier[0]) == verifier
+
+    def is_stage_done(self, stage):
+        return stage in self.state["stages"]
+
+    def mark_stage_done(self, stage):
+        assert stage in self.STAGES
+        if stage not in self.state["stages"]:
+            self.state["stages"].append(stage)
+        self.save()
+
+    def record_prepared_file(self, infile, outfile, name, md5=None):
+        entry = {"input": infile, "input_signature": get_file_signature(infile), "name": name,
+                 "signature": get_file_signature(outfile), "md5": md5}
+        line = json.dumps({"outfile": outfile, "entry": entry}, sort_keys=True) + "\n"
+        with self.lock:
+            self.state["files"][outfile] = entry
+            if self.path is not None:
+                if self.log is None:
+                    self.log = open(self.path, "a")
+                self.log.write(line)
+                self.log.flush()
+
+    def is_file_prepared(self, infile, outfile):
+        entry = self.state["files"].get(outfile)
+        return (entry is not None and os.path.isfile(outfile) and not os.path.islink(outfile) and
+                entry["input"] == infile and
+                entry["input_signature"] == get_file_signature(infile) and
+                entry["signature"] == get_file_signature(outfile))
+
+    def get_md5_sums(self):
+        """Returns the recorded MD5 sums as a dict from (file name, size) to MD5 hex string."""
+        return dict(((entry["name"], entry["signature"][0]), entry["md5"])
+                        for outfile, entry in self.state["files"].items() if entry["md5"])
+
+    def record_par2_set(self, set_dir, par2_filename):
+        names = list_files(set_dir)
+        entry = {"index": par2_filename,
+                 "data": dict((f, get_file_signature(os.path.join(set_dir, f))) for f in names if not is_par2_file(f)),
+                 "par2": dict((f, get_file_signature(os.path.join(set_dir, f))) for f in names if is_par2_file(f))}
+        with self.lock:
+            self.state["par2_sets"][set_dir] = entry
+        self.save()
+
+    def is_par2_set_done(self, set_dir, par2_filename):
+        """Checks that the par2 files recorded for set_dir are still there, unchanged, were
+        created from the data files that are there now, and that the index file is readable and
+        describes those data files."""
+        entry = self.state["par2_sets"].get(set_dir)
+        if entry is None or entry["index"] != par2_filename:
+            return False
+        names = list_files(set_dir)
+        data = dict((f, get_file_signature(os.path.join(set_dir, f))) for f in names if not is_par2_file(f))
+        if data != entry["data"]:
+            return False
+        for name, signature in entry["par2"].items():
+            path = os.path.join(set_dir, name)
+            if not os.path.isfile(path) or get_file_signature(path) != signature:
+                return False
+        recovery_sets = list(read_par2_recovery_sets([os.path.join(set_dir, par2_filename)]).values())
+        return (len(recovery_sets) == 1 and recovery_sets[0].slice_size is not None and
+                sorted(recovery_sets[0].files_by_name()) == sorted(data))
+
+
+def return_files_to_set_dirs(dest_dirs, set_dirs, journal):
+    """Undoes a partial move of the files of the recovery sets into the volume directories."""
+    set_dir_by_name = {}
+    for set_dir, entry in journal.state["par2_sets"].items():
+        for name in itertools.chain(entry["data"], entry["par2"]):
+            set_dir_by_name[name] = set_dir
+    for d in dest_dirs:
+        if not os.path.isdir(d):
+            continue
+        for name in list_files(d):
+            path = os.path.join(d, name)
+            set_dir = set_dir_by_name.get(name)
+            if set_dir is None or os.path.exists(os.path.join(set_dir, name)):
+                # MD5SUM files and the copies of the par2 index files.
+                os.remove(path)
+            else:
+                make_parent_dirs(os.path.join(set_dir, name))
+                os.rename(path, os.path.join(set_dir, name))
+        # Only the directories the files were in are left.
+        shutil.rmtree(d)
+
+
+def create_dir_if_not_exists_or_fail(directory):
+    if os.path.exists(directory) and not os.path.isdir(directory):
+        print_wrap("Specified directory %r is not a directory" % directory)
+        raise SystemExit(1)
+    if not os.path.exists(directory):
+        try:
+            os.mkdir(directory)
+        except:
+            print_wrap("Could not create directory %r" % directory)
+            raise SystemExit(1)
+
+
 
+# Assumptions of the cost model used to choose the block size. The score of a block size is an
+# estimate of the seconds it costs: the time par2 needs, plus the padding it causes (wasted
+# space on the volumes, in par2 files as well as in data files) converted to seconds.
+PAR2_BYTES_PER_SECOND_PER_CORE = 1000*1000*1000
+DISK_BYTES_PER_SECOND = 100*1000*1000
+PADDING_BYTES_PER_SECOND = 100*1000
+DEFAULT_PAR2_MEMORY = 1024*1024*1024
+NUM_EXACTLY_SCORED_BLOCK_SIZES = 10
 
+BlockSizeCandidate = collections.namedtuple("BlockSizeCandidate",
+        "block_size num_blocks num_recovery_blocks padding par2_seconds memory_passes score")
 
-def index_of_smallest(a):
-    return a.index(min(a))
 
+def estimate_num_blocks(sorted_sizes, prefix_sums, block_size):
+    """Estimates the number of blocks in O(log n): files no larger than the block size take one
+    block each, the others are assumed to waste half a block each on average."""
+    i = bisect.bisect_right(sorted_sizes, block_size)
+    num_large = len(sorted_sizes) - i
+    large_total = prefix_sums[-1] - prefix_sums[i]
+    return i + int(math.ceil(float(large_total) / block_size + 0.5 * num_large))
 
-def distribute_files_uniformly(files_with_sizes, num_bins, last_bin_size_fraction=1):
-    """Tries to distribute a set of files about uniformly into a set of bins. It may optionally
-    try to only put a fraction of the size of the other bins into the last bin."""
-    assert 0 < last_bin_size_fraction <= 1
 
-    sizes_to_files = sorted([(size, file) for file, size in files_with_sizes.items()])
+def score_block_size(block_size, num_blocks, total_size, redundancy_fraction, memory, jobs):
+    num_recovery_blocks = get_num_recovery_blocks(num_blocks, redundancy_fraction)
+    padding = (num_blocks + num_recovery_blocks) * block_size - total_size / (1 - float(redundancy_fraction))
+    # par2 multiplies every input block into every recovery block, and reads the input once for
+    # each batch of recovery blocks that fits in memory.
+    memory_passes = int(math.ceil(float(num_recovery_blocks) * block_size / memory))
+    par2_seconds = (float(num_blocks) * block_size * num_recovery_blocks / (PAR2_BYTES_PER_SECOND_PER_CORE * jobs) +
+                    float(memory_passes) * total_size / DISK_BYTES_PER_SECOND)
+    score = par2_seconds + max(padding, 0) / PADDING_BYTES_PER_SECOND
+    return BlockSizeCandidate(block_size, num_blocks, num_recovery_blocks, int(max(padding, 0)),
+            par2_seconds, memory_passes, score)
 
-    bins = [[] for i in range(num_bins)]
-    bin_sizes = [0] * num_bins
 
-    for size, file in reversed(sizes_to_files):
-        adjusted_last_bin_size = int(bin_sizes[-1] / last_bin_size_fraction)
-        max_bin_size = max(adjusted_last_bin_size, *bin_sizes[:-1])
-        
-        overshoot_if_put_in_bin = [size - (max_bin_size - bin_size) for bin_size in bin_sizes[:-1]]
-        overshoot_if_put_in_bin.append(
-                calculate_last_overshoot(size, max_bin_size, bin_sizes[-1], last_bin_size_fraction))
+def get_divisors_of_multiple_of_4(n):
+    """Returns the divisors of n that are multiples of 4, in ascending order."""
+    odd, twos = n, 1
+    while odd % 2 == 0:
+        odd //= 2
+        twos *= 2
+    odd_divisors = set()
+    d = 1
+    while d * d <= odd:
+        if odd % d == 0:
+            odd_divisors.update([d, odd // d])
+        d += 2
+    return sorted(d * power for d in odd_divisors for power in [2 ** i for i in range(2, twos.bit_length())])
 
-        target_index = index_of_smallest(overshoot_if_put_in_bin)
-        bins[target_index].append(file)
-        bin_sizes[target_index] += size
 
-    return bins, bin_sizes
+def get_block_size_candidates(file_sizes, redundancy_fraction, max_num_blocks=MAX_NUM_BLOCKS_PER_RECOVERY_SET,
+        memory=None, jobs=1, part_size=None):
+    """Scores a sweep of block sizes (multiples of 4) and returns the candidates that don't give
+    more than max_num_blocks blocks, best first. The sweep covers the range between 4 kB and the
+    largest file in small geometric steps, plus fractions of the file sizes at a number of
+    quantiles so that block sizes that fit common file sizes exactly are tried. Each candidate is
+    first scored on an estimate of its number of blocks using prefix sums over the sorted sizes,
+    and the best ones are then scored on their exact number of blocks. If part_size is given
+    (the size of the parts of split files and of the containers of packed files), only its
+    divisors are tried, so that only the last part of a file is padded."""
+    sizes = sorted(file_sizes.values())
+    prefix_sums = [0]
+    for size in sizes:
+        prefix_sums.append(prefix_sums[-1] + size)
+    total_size = prefix_sums[-1]
+    memory = memory or DEFAULT_PAR2_MEMORY
+    if max_num_blocks is None:
+        max_num_blocks = float("inf")
 
+    def round_up_to_4(n):
+        return max(4, int(n) + (-int(n) % 4))
 
-def create_bar_chart(values, width=60):
-    max_value = max(values)
+    if sizes[-1] == 0:
+        # All files are empty, so there are no blocks and any block size will do.
+        return [score_block_size(4096, 0, 0, redundancy_fraction, memory, jobs)]
 
-    lines = []
-    for value in values:
-        num_x = int(round(float(value) * width / max_value))
-        num_space = width - num_x
-        lines.append("%s%s %d" % ("#" * num_x, " " * num_space, value))
+    candidates = set()
+    block_size = float(max(4, min(4096, sizes[-1])))
+    while block_size <= sizes[-1]:
+        candidates.add(round_up_to_4(block_size))
+        block_size *= 2 ** 0.125
+    candidates.add(round_up_to_4(sizes[-1]))
+    for quantile in range(0, 21):
+        size = sizes[min(len(sizes) - 1, len(sizes) * quantile // 20)]
+        for parts in range(1, 9):
+            candidates.add(round_up_to_4((size + parts - 1) // parts))
+    largest_block_size = round_up_to_4(sizes[-1])
+    if part_size is not None and part_size % 4 == 0:
+        # Each candidate is replaced by the smallest divisor of the part size that is at least
+        # as large.
+        divisors = get_divisors_of_multiple_of_4(part_size)
+        candidates = set(divisors[min(bisect.bisect_left(divisors, b), len(divisors) - 1)] for b in candidates)
+        largest_block_size = divisors[min(bisect.bisect_left(divisors, largest_block_size), len(divisors) - 1)]
 
-    return lines
+    estimated = [score_block_size(b, estimate_num_blocks(sizes, prefix_sums, b), total_size,
+                        redundancy_fraction, memory, jobs) for b in candidates]
+    estimated = [c for c in estimated if c.num_blocks <= max_num_blocks * 1.1]
+    estimated.sort(key=lambda c: c.score)
 
+    exact = [score_block_size(c.block_size, get_total_num_blocks_of_sorted(sizes, c.block_size), total_size,
+                    redundancy_fraction, memory, jobs)
+                for c in estimated[:NUM_EXACTLY_SCORED_BLOCK_SIZES]]
+    exact = [c for c in exact if c.num_blocks <= max_num_blocks]
+    if not exact:
+        # Even the largest block size gives too many blocks; use it anyway.
+        exact = [score_block_size(largest_block_size, get_total_num_blocks_of_sorted(sizes, largest_block_size),
+                    total_size, redundancy_fraction, memory, jobs)]
+    exact.sort(key=lambda c: c.score)
+    return exact
 
-def get_dest_dirs(destdir, prefix, num_volumes):
-    dest_dirs = [os.path.abspath(os.path.join(destdir, "%s%d" % (prefix, i+1)))
-                    for i in range(num_volumes)]
-    return dest_dirs
 
+def explain_block_size_candidates(candidates, num_candidates=5):
+    print("Best block sizes (score is the estimated cost in seconds, with %d bytes of padding "
+            "counted as one second):" % PADDING_BYTES_PER_SECOND)
+    print("%12s %8s %9s %14s %12s %7s %10s" % (
+            "Block size", "Blocks", "Recovery", "Padding", "Par2 time", "Passes", "Score"))
+    for c in candidates[:num_candidates]:
+        print("%12d %8d %9d %14d %11.1fs %7d %10.1f" % (
+                c.block_size, c.num_blocks, c.num_recovery_blocks, c.padding, c.par2_seconds,
+                c.memory_passes, c.score))
 
-def move_files_to_destination_dir(srcdir, destdir, par2_filename, prefix, num_volumes):
-    files = os.listdir(srcdir)
-    assert par2_filename in files
-    files.remove(par2_filename)
-    
-    par2_src_path = os.path.join(srcdir, par2_filename)
 
-    dest_dirs = get_dest_dirs(destdir, prefix, num_volumes)
+def get_suitable_block_size(file_sizes, max_num_blocks=MAX_NUM_BLOCKS_PER_RECOVERY_SET,
+        redundancy_fraction=fractions.Fraction(11, 70), memory=None, jobs=1, explain=False, part_size=None):
+    """Returns the block size with the lowest estimated cost, see get_block_size_candidates."""
+    candidates = get_block_size_candidates(file_sizes, redundancy_fraction, max_num_blocks, memory, jobs,
+            part_size)
+    if explain:
+        explain_block_size_candidates(candidates)
+    return candidates[0].block_size
 
-    file_paths = [os.path.join(srcdir, f) for f in files]
-    file_sizes = {f: os.path.getsize(f) for f in file_paths}
 
-    bins, bin_sizes = distribute_files_uniformly(file_sizes, num_volumes, 1)
+def get_total_num_blocks(file_sizes, block_size):
+    total = 0
+    for size in file_sizes:
+        total += (size + block_size - 1) // block_size
 
-    i = 0
-    for current_bin, current_dest_dir in zip(bins, dest_dirs):
-        os.mkdir(current_dest_dir)
-        shutil.copyfile(par2_src_path, os.path.join(current_dest_dir, os.path.split(par2_src_path)[1]))
+    return total
 
-        for filepath in (current_bin):
-            print("Moving file %d of %d" % (i+1, len(file_sizes)))
-            shutil.move(filepath, current_dest_dir)
-            i += 1
 
-    os.remove(par2_src_path)
+def get_total_num_blocks_of_sorted(sorted_sizes, block_size):
+    """Like get_total_num_blocks, for sizes sorted in ascending order. A file takes one block for
+    each multiple of the block size (from 0) that is smaller than its size, so the files larger
+    than each multiple are counted with a binary search instead, which is faster when there are
+    many more files than blocks in the largest one."""
+    num_multiples = (sorted_sizes[-1] + block_size - 1) // block_size if sorted_sizes else 0
+    if num_multiples > len(sorted_sizes):
+        return get_total_num_blocks(sorted_sizes, block_size)
+    total = 0
+    index = 0
+    for k in range(num_multiples):
+        index = bisect.bisect_right(sorted_sizes, k * block_size, index)
+        total += len(sorted_sizes) - index
+    return total
 
 
-def create_md5_sums(inoutdir, prefix, num_volumes):
-    dest_dirs = get_dest_dirs(inoutdir, prefix, num_volumes)
+def get_num_recovery_sets(file_sizes, num_volumes, redundancy_fraction, part_size=None):
+    """Returns the number of independent par2 recovery sets to split the files into. Each set
+    gets at most MAX_NUM_FILES_PER_RECOVERY_SET files, and no more than
+    MAX_NUM_BLOCKS_PER_RECOVERY_SET blocks with the block size that would be chosen if there
+    were no limit on the number of blocks. Each set must still have enough files to be spread
+    over all volumes."""
+    sizes = list(file_sizes.values())
+    num_sets = (len(sizes) + MAX_NUM_FILES_PER_RECOVERY_SET - 1) // MAX_NUM_FILES_PER_RECOVERY_SET
+    block_size = get_suitable_block_size(file_sizes, max_num_blocks=None,
+            redundancy_fraction=redundancy_fraction, part_size=part_size)
+    num_blocks = get_total_num_blocks(sizes, block_size)
+    num_sets = max(num_sets,
+            (num_blocks + MAX_NUM_BLOCKS_PER_RECOVERY_SET - 1) // MAX_NUM_BLOCKS_PER_RECOVERY_SET)
+    return max(1, min(num_sets, len(sizes) // (2 * num_volumes)))
 
-    for d in dest_dirs:
-        input_filepaths = [os.path.join(inoutdir, f) for f in glob.glob("%s/*" % d)]
-        execute_and_throw_if_error("md5sum -- * > MD5SUM", cwd=d, shell=True)
 
+def split_into_recovery_sets(files, file_sizes, num_sets):
+    """Deals out the files to num_sets sets in order of decreasing size, back and forth, so
+    that the sets get about the same number of files and the same total size."""
+    # Sorted by name first, since the sort by size keeps the order of files of the same size.
+    order = sorted(files)
+    order.sort(key=file_sizes.__getitem__, reverse=True)
+    # Set i gets the files at positions i and 2 * num_sets - 1 - i of every lap there and back.
+    return [sorted(order[i::2 * num_sets] + order[2 * num_sets - 1 - i::2 * num_sets]) for i in range(num_sets)]
 
-def verify(outdir, par2_filename, prefix, num_volumes):
-    dest_dirs = get_dest_dirs(outdir, prefix, num_volumes)
 
-    for i, skip_dir in enumerate(dest_dirs):
-        test_dir = tempfile.mkdtemp(prefix="verify_%d_" % (i+1), dir=outdir)
+def get_par2_filename(prefix, set_index, num_sets):
+    if num_sets == 1:
+        return "%s.par2" % prefix.strip().strip("_")
+    return "%s_set%d.par2" % (prefix.strip().strip("_"), set_index + 1)
 
-        print("Verifying restorability without volume %d" % (i+1))
-        try:
-            for link_dir in dest_dirs:
-                if link_dir == skip_dir:
-                    continue
 
-                files = os.listdir(link_dir)
-                for f in files:
-                    src = os.path.abspath(os.path.join(link_dir, f))
-                    dst = os.path.abspath(os.path.join(test_dir, f))
-                    if not os.path.islink(dst):
-                        os.symlink(src, dst)
-        
-            print("")
-            return_code = subprocess.call(["par2", "verify", par2_filename], cwd=test_dir)
-            if return_code == 0:
-                print("\nSuccess, no recovery needed at all if volume %d fails." % (i+1))
-            elif return_code == 1:
-                print("\nSuccess, all files are recoverable if volume %d fails." % (i+1))
-            else:
-                print("\n")
-                print_wrap("Failure, not all files are recoverable if volume %d fails. " % (i+1) +
-                            "This usually happens either because you have chosen your redundancy too low "
-                            "(try increasing it with the --redundancy option) or because your files are "
-                            "too few and/or are of vastly different sizes. A workaround is to split your "
-                            "large files.")
-                raise SystemExit(1)
-        finally:
-            shutil.rmtree(test_dir)
+def get_num_recovery_blocks(num_data_blocks, redundancy_fraction):
+    """Return the number of blocks needed to make the fraction of blocks
+    that are recovery blocks equal to redundancy_fraction"""
 
+    # In integers, since this is done for every block size that is scored.
+    ratio = redundancy_fraction
+    if not isinstance(ratio, fractions.Fraction):
+        ratio = fractions.Fraction(ratio)
+    return -(-num_data_blocks * ratio.numerator // (ratio.denominator - ratio.numerator))
 
-def get_size_statistics(outdir, prefix, num_volumes):
-    dest_dirs = get_dest_dirs(outdir, prefix, num_volumes)
 
-    volume_sizes = []
-    par2_sizes = []
-    for d in dest_dirs:
-        volume_sizes.append(0)
-        par2_sizes.append(0)
-        for f in os.listdir(d):
-            size = os.path.getsize(os.path.join(d, f))
-            volume_sizes[-1] += size
-            if os.path.splitext(f)[-1] == ".par2":
-                par2_sizes[-1] += size
 
-    return volume_sizes, par2_sizes
+# Throughputs the plan (--plan) assumes for the stages other than par2 creation, in bytes of
+# data per second (per core for compression), before calibration with earlier runs.
+PLAN_BYTES_PER_SECOND = {
+    "split": DISK_BYTES_PER_SECOND,
+    "pack": DISK_BYTES_PER_SECOND,
+    "compress": 20*1000*1000,
+    "copy": DISK_BYTES_PER_SECOND,
+    "move": 1000*1000*1000,
+    "md5": 500*1000*1000,
+    "verify": DISK_BYTES_PER_SECOND,
+    "iso": DISK_BYTES_PER_SECOND,
+}
 
 
+def get_par2_resources(memory, engine, jobs, num_recovery_sets):
+    """Returns how many recovery sets to create at the same time, and the number of cores and
+    megabytes of memory (or None to let par2 decide) each of them gets."""
+    parallel_sets = min(jobs, num_recovery_sets)
+    par2_jobs = max(1, jobs // parallel_sets)
+    if memory is None and engine == "par2-split":
+        memory = get_par2_split_memory()
+    par2_memory = max(1, memory // parallel_sets) if memory is not None else None
+    return parallel_sets, par2_jobs, par2_memory
 
-def create_dir_if_not_exists_or_fail(directory):
-    if os.path.exists(directory) and not os.path.isdir(directory):
-        print_wrap("Specified directory %r is not a directory" % directory)
-        raise SystemExit(1)
-    if not os.path.exists(directory):
-        try:
-            os.mkdir(directory)
-        except:
-            print_wrap("Could not create directory %r" % directory)
-            raise SystemExit(1)
 
+def estimate_par2_file_sizes(par2_filename, file_sizes, block_size, num_recovery_blocks):
+    """Returns the sizes and numbers of recovery blocks of the par2 files of a recovery set,
+    given the sizes of its files by name, as a dict from par2 file name to (size, number of
+    recovery blocks). The files are laid out as by the builtin engine: the index file holds the
+    main, file description, checksum and creator packets, and each recovery file its recovery
+    packets and a copy of those."""
+    num_slices = [(size + block_size - 1) // block_size for size in file_sizes.values()]
+    critical_size = (PAR2_PACKET_HEADER.size + 12 + 16 * len(file_sizes) +
+                     PAR2_PACKET_HEADER.size + len(pad_to_multiple_of_4(PAR2_CREATOR)) +
+                     (PAR2_PACKET_HEADER.size + 56 + PAR2_PACKET_HEADER.size + 16) * len(file_sizes) +
+                     len(encode_par2_filename("".join(file_sizes))) + 20 * sum(num_slices))
 
+    par2_file_sizes = {par2_filename: (critical_size, 0)}
+    layout = get_par2_recovery_file_layout(num_recovery_blocks, max([1] + num_slices))
+    if not layout:
+        return par2_file_sizes
+    base_name = os.path.splitext(par2_filename)[0]
+    exponent_digits = len(str(layout[-1][0]))
+    count_digits = len(str(max(count for first, count in layout)))
+    for first_exponent, count in layout:
+        name = "%s.vol%0*d+%0*d.par2" % (base_name, exponent_digits, first_exponent, count_digits, count)
+        par2_file_sizes[name] = (count * (PAR2_PACKET_HEADER.size + 4 + block_size) + critical_size, count)
+    return par2_file_sizes
 
-def get_suitable_block_size(file_sizes):
-    sizes = list(sorted(file_sizes.values()))
-    total_size = sum(sizes)
-    greatest_common_divider = sizes[0]
-    
-    x = sizes[len(sizes)/4]
-    if x == sizes[-1] and total_size / x + len(sizes) < 20000:
-        # At least 3/4 of the files are the same size.
-        if x > 1024*1024:
-            # Chose a value between 1 and 2 MB that doesn't cause too much overshoot (and thus padding
-            # and wasted space).
-            approximate_size_in_MB = x / (1024*1024)
-            block_size = (x + approximate_size_in_MB - 1) // approximate_size_in_MB
+
+def make_plan(infiles_per_set, input_filesizes, prefix, num_volumes, redundancy, compress,
+              block_size=None, num_blocks=None, memory=None, jobs=1, par2_engine="par2", pipeline=False,
+              verify=True, deep_verify=False, iso=False, split_bytes=0, pack_bytes=0, calibration=None,
+              names=None, part_size=None):
+    """Works out what a run would do from the sizes of the input files alone: the block size and
+    number of recovery blocks of each recovery set, the sizes of the par2 files, how the files
+    are spread over the volumes, and how long each stage takes (split_bytes and pack_bytes are
+    the sizes of the files that are split into parts and packed into containers, which are among
+    the input files, names is a dict from input file to its path in the volumes, by default its
+    file name, and part_size is passed on to get_block_size_candidates). The prepared files are
+    assumed to be the size of the input files times the compression ratio of the calibration,
+    and the par2 files the size estimate_par2_file_sizes gives. The time of each stage is first estimated from fixed throughputs
+    (PLAN_BYTES_PER_SECOND and the par2 cost model used to choose the block size), and then
+    multiplied by the factor of the stage in the calibration, see read_calibration."""
+    calibration = calibration or {"compression_ratio": None, "factors": {}}
+    compression_ratio = (calibration["compression_ratio"] or 1.0) if compress else 1.0
+    redundancy_fraction = fractions.Fraction(redundancy) / num_volumes
+    parallel_sets, par2_jobs, par2_memory = get_par2_resources(memory, par2_engine, jobs, len(infiles_per_set))
+
+    volume_sizes = [0] * num_volumes
+    par2_sizes = [0] * num_volumes
+    num_files = [0] * num_volumes
+    # The name and size of the files spread over the volumes, and of those every volume has.
+    iso_files = []
+    common_files = {}
+    recovery_sets = []
+    par2_model_seconds = 0.0
+    input_size = 0
+    for set_index, infiles in enumerate(infiles_per_set):
+        set_names = list(map(names.__getitem__, infiles)) if names is not None else [os.path.split(f)[-1] for f in infiles]
+        if compress:
+            set_names = [get_prepared_filename(name, compress) for name in set_names]
+        set_input_sizes = list(map(input_filesizes.__getitem__, infiles))
+        input_size += sum(set_input_sizes)
+        if compression_ratio != 1.0:
+            set_input_sizes = [int(size * compression_ratio) for size in set_input_sizes]
+        file_sizes = dict(zip(set_names, set_input_sizes))
+        set_block_size = block_size
+        total_blocks = None
+        if num_blocks is not None:
+            set_block_size = get_block_size_for_num_blocks(list(file_sizes.values()), num_blocks)
+        elif set_block_size is None:
+            # The best candidate already has the exact number of blocks.
+            best = get_block_size_candidates(file_sizes, redundancy_fraction,
+                    memory=par2_memory * 1024 * 1024 if par2_memory else None, jobs=par2_jobs,
+                    part_size=part_size)[0]
+            set_block_size, total_blocks = best.block_size, best.num_blocks
+        if total_blocks is None:
+            total_blocks = get_total_num_blocks(file_sizes.values(), set_block_size)
+        num_recovery_blocks = get_num_recovery_blocks(total_blocks, redundancy_fraction)
+        par2_model_seconds += score_block_size(set_block_size, total_blocks, sum(file_sizes.values()),
+                redundancy_fraction, (par2_memory or DEFAULT_PAR2_MEMORY // (1024*1024)) * 1024 * 1024,
+                par2_jobs).par2_seconds
+
+        par2_filename = get_par2_filename(prefix, set_index, len(infiles_per_set))
+        par2_file_sizes = estimate_par2_file_sizes(par2_filename, file_sizes, set_block_size, num_recovery_blocks)
+        index_size = par2_file_sizes.pop(par2_filename)[0]
+        sizes = dict(file_sizes)
+        sizes.update((name, size) for name, (size, count) in par2_file_sizes.items())
+        if iso:
+            iso_files.append(sizes)
+            common_files[par2_filename] = index_size
+        # The files are balanced by their number of blocks, see distribute_files_uniformly.
+        max_weight = max([(max(set_input_sizes) + set_block_size - 1) // set_block_size] +
+                         [count for size, count in par2_file_sizes.values()])
+        total_weight = total_blocks + sum(count for size, count in par2_file_sizes.values())
+        if max_weight * num_volumes * 2 <= total_weight:
+            # Packing the set file by file is most of the time of a plan with many files. When no
+            # file is larger than half of what each volume gets, the packing comes out even to
+            # within a fraction of a percent, so each volume is given an even share of the set
+            # instead.
+            set_size = sum(sizes.values())
+            set_par2_size = sum(size for size, count in par2_file_sizes.values())
+            for i in range(num_volumes):
+                volume_sizes[i] += (set_size + i) // num_volumes + index_size
+                par2_sizes[i] += (set_par2_size + i) // num_volumes + index_size
+                num_files[i] += (len(sizes) + i) // num_volumes + 1
         else:
-            block_size = x
-    else:
-        block_size = max(sizes[len(sizes)/5] / 4, 4096)
+            weights = dict((name, (size + set_block_size - 1) // set_block_size) for name, size in file_sizes.items())
+            weights.update((name, count) for name, (size, count) in par2_file_sizes.items())
+            bins, bin_sizes = distribute_files_uniformly(sizes, num_volumes, 1, weights)
+            for i, current_bin in enumerate(bins):
+                volume_sizes[i] += bin_sizes[i] + index_size
+                par2_sizes[i] += sum(sizes[name] for name in current_bin if name in par2_file_sizes) + index_size
+                num_files[i] += len(current_bin) + 1
+        recovery_sets.append({"par2_filename": par2_filename, "num_files": len(file_sizes),
+                              "block_size": set_block_size, "num_blocks": total_blocks,
+                              "num_recovery_blocks": num_recovery_blocks,
+                              "par2_size": index_size * num_volumes + sum(
+                                    size for size, count in par2_file_sizes.values())})
 
-    # Can't have more than about 20000 blocks
-    while total_size / block_size + len(sizes) > 20000:
-        block_size = min(block_size * 2, sizes[-1])
+    # The MD5SUM file of each volume has a line of about the same length for every file.
+    for i in range(num_volumes):
+        volume_sizes[i] += num_files[i] * (32 + 2 + len(prefix) + 20)
+    common_files[MD5SUM_FILENAME] = max(num_files) * (32 + 2 + len(prefix) + 20)
+    prepared_size = int(input_size * compression_ratio)
+    output_size = sum(volume_sizes)
 
-    # Must be multiple of 4
-    if block_size % 4 != 0:
-        block_size += 4 - (block_size % 4)
+    model_seconds = collections.OrderedDict()
+    if split_bytes:
+        model_seconds["split"] = float(split_bytes) / PLAN_BYTES_PER_SECOND["split"]
+    if pack_bytes:
+        model_seconds["pack"] = float(pack_bytes) / PLAN_BYTES_PER_SECOND["pack"]
+    prepare_stage = "compress" if compress else "copy"
+    prepare_seconds = float(input_size) / PLAN_BYTES_PER_SECOND[prepare_stage] / (jobs if compress else 1)
+    par2_seconds = par2_model_seconds / parallel_sets
+    if pipeline:
+        model_seconds["pipeline"] = max(prepare_seconds, par2_seconds)
+    else:
+        model_seconds[prepare_stage] = prepare_seconds
+        model_seconds["par2"] = par2_seconds
+        model_seconds["move"] = float(output_size) / PLAN_BYTES_PER_SECOND["move"]
+    model_seconds["md5"] = float(output_size) / PLAN_BYTES_PER_SECOND["md5"]
+    if verify:
+        # A deep verification reads all volumes but one, once for each volume.
+        verify_bytes = sum(par2_sizes)
+        if deep_verify:
+            verify_bytes += float(output_size) * (num_volumes - 1) * num_volumes / min(jobs, num_volumes)
+        model_seconds["verify"] = float(verify_bytes) / PLAN_BYTES_PER_SECOND["verify"]
+    image_sizes = None
+    if iso:
+        image_sizes = estimate_iso_image_sizes(volume_sizes, iso_files, common_files)
+        model_seconds["iso"] = float(output_size) / PLAN_BYTES_PER_SECOND["iso"]
 
-    return block_size
+    factors = calibration["factors"]
+    predicted_seconds = collections.OrderedDict(
+            (stage, seconds * factors.get(stage, 1.0)) for stage, seconds in model_seconds.items())
+    return {"recovery_sets": recovery_sets, "volume_sizes": volume_sizes, "par2_sizes": par2_sizes,
+            "image_sizes": image_sizes, "input_size": input_size, "prepared_size": prepared_size,
+            "model_seconds": model_seconds, "predicted_seconds": predicted_seconds}
 
 
-def get_total_num_blocks(file_sizes, block_size):
-    total = 0
-    for size in file_sizes:
-        total += (size + block_size - 1) // block_size
+def read_calibration(paths, par2_engine):
+    """Reads the metrics files (--metrics-json) of earlier runs and returns how they compare to
+    the plan: for each stage the factor to multiply the plan's estimate of its time with (the
+    total time of the stage in the runs divided by the total estimate made for them), and the
+    ratio of the size of the compressed files to the size of the input files. The par2 stage is
+    only calibrated from runs with the same par2 engine. Runs that were resumed have no
+    estimates and only count for the compression ratio."""
+    times = collections.defaultdict(lambda: [0.0, 0.0])
+    sizes = [0, 0]
+    for path in paths:
+        try:
+            with open(path) as f:
+                run = json.load(f)
+            parameters = run.get("parameters") or {}
+            for stage in run["stages"]:
+                # Stages that failed didn't do all their work.
+                if not stage.get("model_seconds") or stage.get("failed"):
+                    continue
+                if stage["name"] in ("par2", "pipeline") and parameters.get("par2_engine") != par2_engine:
+                    continue
+                times[stage["name"]][0] += stage["wall_seconds"]
+                times[stage["name"]][1] += stage["model_seconds"]
+            if parameters.get("compress") and parameters.get("prepared_size") and parameters.get("input_size"):
+                sizes[0] += parameters["prepared_size"]
+                sizes[1] += parameters["input_size"]
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            print_wrap("Could not read the metrics file %r: %s" % (path, e))
+            raise SystemExit(1)
+    return {"factors": dict((stage, wall / model) for stage, (wall, model) in times.items()),
+            "compression_ratio": float(sizes[0]) / sizes[1] if sizes[1] else None}
 
-    return total
 
+def format_duration(seconds):
+    if seconds < 60:
+        return "%.1f seconds" % seconds
+    if seconds < 3600:
+        return "%d min %d s" % divmod(int(round(seconds)), 60)
+    return "%d h %d min" % divmod(int(round(seconds / 60)), 60)
 
-def get_num_recovery_blocks(num_data_blocks, redundancy_fraction):
-    """Return the number of blocks needed to make the fraction of blocks
-    that are recovery blocks equal to redundancy_fraction"""
 
-    return int(math.ceil(num_data_blocks * redundancy_fraction / (1 - redundancy_fraction)))
+def get_stage_labels(compress):
+    return {"split": "Splitting large files", "pack": "Packing small files", "compress": "Compression", "copy": "Initial file copy",
+            "pipeline": "Compression, moving and par2 creation" if compress else
+                        "Initial file copy, moving and par2 creation",
+            "par2": "Par2 creation", "move": "Moving to the volumes", "md5": "MD5 sum",
+            "verify": "Verification", "iso": "Writing the images"}
 
 
+def print_plan(plan, compress, redundancy, num_volumes, capacity, calibration_paths):
+    print("")
+    print("Plan (nothing has been written):")
+    print("")
+    for recovery_set in plan["recovery_sets"]:
+        print_wrap("%s: %d files, block size %d, %d blocks and %d recovery blocks" % (
+                recovery_set["par2_filename"], recovery_set["num_files"], recovery_set["block_size"],
+                recovery_set["num_blocks"], recovery_set["num_recovery_blocks"]))
+    print("")
+    sizes = plan["image_sizes"] or plan["volume_sizes"]
+    print("Predicted %s sizes:" % ("image" if plan["image_sizes"] else "volume"))
+    print("\n".join(create_bar_chart(sizes)))
+    print("")
+    if compress:
+        print_wrap("The input is %.1f MB, and is assumed to compress to %.1f MB." % (
+                plan["input_size"] / (1024.0 * 1024.0), plan["prepared_size"] / (1024.0 * 1024.0)))
+    print_wrap(("Par2 recovery files will be about %.1f %% of the output (ideal for a redundancy "
+                "of %s volumes out of %d would be %.1f %%)") % (
+            100.0 * sum(plan["par2_sizes"]) / sum(plan["volume_sizes"]), redundancy, num_volumes,
+            100.0 * float(redundancy) / num_volumes))
+    if capacity is not None:
+        print_wrap("The largest %s is about %.1f MB, which %s on the media (%.1f MB)." % (
+                "image" if plan["image_sizes"] else "volume", max(sizes) / (1024.0 * 1024.0),
+                "fits" if max(sizes) <= capacity else "does NOT fit", capacity / (1024.0 * 1024.0)))
+    print("")
+    print("Predicted time:")
+    stage_labels = get_stage_labels(compress)
+    for stage, seconds in plan["predicted_seconds"].items():
+        print("%s: %s" % (stage_labels[stage], format_duration(seconds)))
+    print("Total: %s" % format_duration(sum(plan["predicted_seconds"].values())))
+    print("")
+    if calibration_paths:
+        print_wrap("The times are calibrated with %d earlier run%s." % (
+                len(calibration_paths), "s" if len(calibration_paths) > 1 else ""))
+    else:
+        print_wrap("The times are rough estimates. Give the --metrics-json files of earlier runs with "
+                    "--calibrate to make them more accurate.")
+    print("")
+
 
 def check_integer_equal_or_greater(minimum):
     def check(n):
@@ -358,31 +3780,40 @@ def check_integer_in_interval(minimum, maximum):
     return check
 
 
-def main():
-    parser = argparse.ArgumentParser(description=(
-        "Prepare all files in a directory to be written to a set of backup volumes (e.g. DVDs). "
-        "Each file is optionally compressed and encrypted using 7zip and then a set of par2 files are created. "
-        "The par2 files makes it possible to restore files even if one of the backup volumes is lost, "
-        "if I/O errors are encountered, or if files are silently corrupted when reading back the data. "
-        "This script will create one folder for each volume with approximately equal amount of data "
-        "in each one. "))
-        
-    DEFAULT_REDUNDANCY = decimal.Decimal("1.1")
+DEFAULT_REDUNDANCY = decimal.Decimal("1.1")
 
-    parser.add_argument("-i", "--indir", metavar="DIR",
-            help="Process the files in this directory. Default: current directory.")
+
+def add_archive_arguments(parser, batch=False):
+    """Adds the options of a run of the script to parser. A batch has no input directory and
+    prefix of its own, and shares the cores and the memory between its directories."""
+    if not batch:
+        parser.add_argument("-i", "--indir", metavar="DIR",
+                help="Process the files in this directory. Default: current directory.")
+    parser.add_argument("-R", "--recursive", action="store_true",
+            help="Also process the files in the subdirectories of the input directory (but not in the "
+                    "output and temporary directories, if they are inside it). The files keep their "
+                    "paths relative to the input directory in the volumes.")
     parser.add_argument("-o", "--outdir", metavar="DIR",
             help="Create the volume directories in this directory. Default: current directory.")
     parser.add_argument("-t", "--tmpdir", "--tempdir", metavar="DIR",
             help="The temporary directory to use. Default: output directory.")
-    parser.add_argument("-p", "--prefix", metavar="PREFIX",
-            help="The volume directories will get this name followed by underscore followed by a number. "
-                    "Default: name of current directory followed by underscore.")
+    if not batch:
+        parser.add_argument("-p", "--prefix", metavar="PREFIX",
+                help="The volume directories will get this name followed by underscore followed by a number. "
+                        "Default: name of current directory followed by underscore.")
     parser.add_argument("-c", "--compress", action="store_true",
             help="Compress each file.")
     parser.add_argument("-e", "--encrypt", action="store_true",
             help="Encrypt each file (implies compression since the encryption will be done using 7zip). "
                     "You will be prompted for a password.")
+    parser.add_argument("--compression-level", metavar="LEVEL", type=check_integer_in_interval(0, 9),
+            help="The 7z compression level (-mx) of the files that are compressed. Default: that of 7z.")
+    parser.add_argument("--compression-threads", metavar="NUM_THREADS", type=check_integer_equal_or_greater(1),
+            help="Number of threads each 7z may use (-mmt). Default: let 7z decide.")
+    parser.add_argument("--compress-all", action="store_true",
+            help="Compress all files. By default samples of each file are first compressed with zlib, "
+                    "and files that are already compressed (e.g. JPEG, MP4 or ZIP files) and don't shrink "
+                    "are only stored in their archives (and still encrypted with --encrypt).")
     parser.add_argument("num_volumes", metavar="NUM_VOLUMES", type=check_integer_equal_or_greater(3),
             help="Number of volumes. Must be an integer greater or equal to 3.")
     parser.add_argument("-r", "--redundancy", metavar="NUM_VOLUMES", type=check_decimal_greater(0),
@@ -391,190 +3822,1053 @@ def main():
             help="Force creation even if the input files are not suitable to spread over the number "
                     "of volumes specified.")
     parser.add_argument("--block-size", metavar="BLOCK_SIZE", type=check_integer_in_interval(100, 200*1024*1024),
-            help="Block size to pass on to par2. Default: Heuristically chosen.")
+            help="Block size to pass on to par2. Default: The block size with the lowest estimated "
+                    "cost in padding and par2 time, see --explain-block-size.")
     parser.add_argument("--num-blocks", metavar="NUM_BLOCKS", type=check_integer_in_interval(2, 32600),
-            help="Set the number of blocks for par2 to use. Default: Heuristically chosen.")
-    parser.add_argument("--memory", metavar="MEGABYTES", type=check_integer_in_interval(1, 1000*1000),
-            help="Number of megabytes of memory par2 may use. Default: Let par2 decide for itself.")
+            help="Set the number of blocks for par2 to use. Default: The number of blocks of the block "
+                    "size with the lowest estimated cost, see --block-size.")
+    parser.add_argument("--explain-block-size", action="store_true",
+            help="Show the best block sizes considered and how they were scored.")
+    if batch:
+        parser.add_argument("--memory", metavar="MEGABYTES", type=check_integer_in_interval(1, 1000*1000),
+                default=get_par2_split_memory(),
+                help="Number of megabytes of memory the par2 runs of all directories may use together. "
+                        "Default: half of the available memory (%(default)s).")
+    else:
+        parser.add_argument("--memory", metavar="MEGABYTES", type=check_integer_in_interval(1, 1000*1000),
+                help="Number of megabytes of memory par2 may use. Default: Let par2 decide for itself.")
+    parser.add_argument("--staging", choices=STAGING_MODES, default="auto",
+            help="How to bring uncompressed input files into the temporary directory: 'reflink' "
+                    "shares the data blocks of the input files, 'hardlink' creates hard links to them "
+                    "and 'copy' always copies them. Reflinks and hard links fall back to copying when the "
+                    "file system doesn't support them. 'auto' tries reflinks, then hard links, then "
+                    "copying. Default: %(default)s.")
+    if batch:
+        parser.add_argument("-j", "--jobs", metavar="NUM_CORES", type=check_integer_equal_or_greater(1),
+                help="Number of cores the directories share. Default: number of CPU cores (%d)."
+                        % get_default_num_jobs())
+    else:
+        parser.add_argument("-j", "--jobs", metavar="NUM_JOBS", type=check_integer_equal_or_greater(1),
+                help="Number of files to compress at the same time. Default: number of CPU cores (%d)."
+                        % get_default_num_jobs())
+    parser.add_argument("--max-in-flight", metavar="MEGABYTES", type=check_integer_equal_or_greater(1),
+            default=4096,
+            help="Maximum number of megabytes of input files being compressed at the same time, "
+                    "to limit the use of the temporary directory. Default: %(default)s.")
+    parser.add_argument("--cache-dir", metavar="DIR",
+            help="Keep the compressed files in this directory and reuse them when the same file is "
+                    "compressed again with the same password, e.g. when archiving a directory that "
+                    "overlaps with one archived before. Default: no cache.")
+    parser.add_argument("--cache-size", metavar="MEGABYTES", type=check_integer_equal_or_greater(1),
+            default=100*1024,
+            help="Maximum size of the compression cache. The least recently used files are removed "
+                    "when it grows larger. Default: %(default)s.")
+    parser.add_argument("--par2-engine", choices=PAR2_ENGINES, default="par2",
+            help="What creates the par2 files: the 'par2' program, 'par2-split', which runs several "
+                    "par2 processes at the same time that each create a range of the recovery blocks "
+                    "(as many as there are --jobs and fit in --memory, which defaults to half of the "
+                    "available memory; needs par2cmdline 0.7 or later), or the 'builtin' "
+                    "implementation, which needs NumPy and computes the recovery blocks using --jobs "
+                    "processes. Default: %(default)s.")
+    parser.add_argument("--pipeline", action="store_true",
+            help="Overlap the stages: each file is hashed and moved into a volume directory as soon "
+                    "as it has been compressed or copied, and the par2 files of a recovery set are "
+                    "created as soon as all of its files are done.")
+    parser.add_argument("--resume", action="store_true",
+            help="Continue a run that failed or was interrupted, reusing the files it compressed or "
+                    "copied and the par2 files it created if they are unchanged. The progress of each "
+                    "run is recorded in a hidden journal file in the output directory.")
+    parser.add_argument("--iso", action="store_true",
+            help="Write each volume as an ISO 9660 image with Joliet file names, ready to be burned, "
+                    "instead of as a directory. The images are written after verification, and each "
+                    "volume directory is removed once its image is complete. Files larger than 4 GiB "
+                    "are stored as several extents (ISO 9660 level 3).")
+    parser.add_argument("--media", choices=sorted(MEDIA_CAPACITIES),
+            help="Check that each volume fits on this kind of media: before starting, from an estimate "
+                    "of the volume sizes, and with --iso exactly before writing the images.")
+    parser.add_argument("--media-size", metavar="MEGABYTES", type=check_integer_equal_or_greater(1),
+            help="Like --media, for media of this size.")
+    parser.add_argument("--split-size", metavar="MEGABYTES", type=check_integer_equal_or_greater(1),
+            help="Split files larger than this into parts of this size, so that large files can be spread "
+                    "over the volumes. A %s file in each volume lists the files to join again. Default: "
+                    "only split the files larger than the data per volume, which keep the volumes from "
+                    "being balanced, into parts of the largest power of two that is at most 1/%d of the "
+                    "data per volume." % (SPLIT_MANIFEST_FILENAME, SPLIT_PARTS_PER_VOLUME))
+    parser.add_argument("--no-split", action="store_true",
+            help="Never split files.")
+    parser.add_argument("--pack-below", metavar="KILOBYTES", type=check_integer_equal_or_greater(1),
+            help="Pack files smaller than this into uncompressed tar containers of the size of the parts "
+                    "of split files (see --split-size), which cuts the number of files and the par2 blocks "
+                    "that are mostly padding. A %s file in each volume lists the containers to unpack. "
+                    "Files of at least half the container size are never packed. Default: don't pack." % (
+                    PACKED_MANIFEST_FILENAME))
     parser.add_argument("--no-verify", action="store_true",
-            help="Do not invoke par2 to verify that a missing volume does not lead to data loss.")
-
-    args = parser.parse_args()
+            help="Do not verify that a missing volume does not lead to data loss.")
+    parser.add_argument("--verify-losses", metavar="NUM_VOLUMES", type=check_integer_equal_or_greater(1),
+            default=1,
+            help="Verify that all files can be restored if up to this many volumes are lost. The "
+                    "check is done by counting the data blocks and par2 recovery blocks in each "
+                    "volume, without reading the data. Default: %(default)s.")
+    parser.add_argument("--deep-verify", action="store_true",
+            help="Also invoke par2 to verify that a missing volume does not lead to data loss. This "
+                    "reads all the data once for each volume, for as many volumes at a time as given "
+                    "by --jobs.")
+    parser.add_argument("--metrics-json", metavar="FILE",
+            help="Write the wall time, CPU time, memory use and I/O of each stage, and of each run of "
+                    "7z and par2 and each file hashed, to this file as JSON. It can be given to --calibrate "
+                    "in later runs.")
+    parser.add_argument("--plan", action="store_true",
+            help="Only show what would be done: the recovery sets, the predicted size of each volume and "
+                    "of the par2 files, and how long each stage is predicted to take. Only the sizes of "
+                    "the input files are looked at. With many files the time goes mostly to listing them, "
+                    "about a second for 100,000 files; the volume sizes are then even shares of each recovery "
+                    "set unless a file is too large for that. With --iso the sizes of the images are "
+                    "estimated from the names and sizes of the files, which doesn't lay out each image.")
+    parser.add_argument("--calibrate", metavar="FILE", action="append",
+            help="Predict the times and the compression ratio for --plan from the --metrics-json file of "
+                    "an earlier run. Can be given several times.")
+    parser.add_argument("--profile", metavar="FILE",
+            help="Profile the Python code of this script (not 7z or par2) using cProfile, write the "
+                    "statistics to this file in the format of the pstats module, and show the "
+                    "functions most time was spent in.")
 
-    # encryption implies compression
-    compress = args.compress or args.encrypt
 
-    outdir = args.outdir or os.getcwd()
-    indir = args.indir or os.getcwd()
-    prefix = args.prefix or (os.path.split(os.getcwd())[-1] + " ")
-    redundancy = args.redundancy or DEFAULT_REDUNDANCY
+def read_password():
+    password = raw_input("Choose password: ")
 
-    if redundancy > args.num_volumes - 1:
-        print_wrap("Can't dedicate that many volumes to redundancy, at least one must contain the actual data.")
+    if password == "":
+        print_wrap("Can't have empty password. Use without the --encrypt switch to run without encryption.")
         raise SystemExit(1)
-    
-    if args.num_blocks is not None and args.block_size is not None:
-        print_wrap("Can't set both block size and number of blocks.")
+
+    valid_password_regexp = r"""^[a-zA-Z0-9!@#$%^&*+=,.\-_\\/()|;: ~<>?"'{}[\]]+$"""
+    if not re.match(valid_password_regexp, password):
+        print_wrap("To prevent problems with command lines and differences in escaping and such, only "
+                    "passwords matching the following regular expression are allowed: %r" % valid_password_regexp)
         raise SystemExit(1)
 
-    infiles_paths = sorted([os.path.join(indir, f) for f in filter_infiles(os.listdir(indir))])
-    infiles_paths = [f for f in infiles_paths if os.path.isfile(f)]
+    verify_password = raw_input("Verify password: ")
 
-    if infiles_paths == []:
-        print("No input files")
+    if password != verify_password:
+        print_wrap("Passwords don't match.")
         raise SystemExit(1)
+    return password
 
-    if len(infiles_paths) < args.num_volumes - redundancy and not args.force:
-        print_wrap(
-                "Not enough input files to spread out over %d volumes. I suggest you use 7zip to create "
-                "volumes out of the data, e.g. '7z a -v<volume_size> *'. You can use the option --force "
-                "to still go ahead with the creation but the results will most likely not be what you want."
-            )
-        raise SystemExit(1)
 
-    MAX_NUM_FILES = 6000
+class ArchiveJob(object):
+    """A run of the script over one input directory, with the options of add_archive_arguments.
+    Its stages are run by calling plan(), stage(), par2(), place(), checksum(), verify() and
+    finish() in that order, or plan() and then run(), and report() shows the summary
+    afterwards. Some stages take the number of cores (jobs) and megabytes of par2 memory to
+    use, by default those of the options, so that several jobs can share a computer (see
+    batch). Errors are shown and raise SystemExit, like in main. The stages are recorded in
+    metrics, with the name of the job if given."""
 
-    if len(infiles_paths) > MAX_NUM_FILES:
-        print_wrap(
-                "Can't process %d files at once. You must split them up into " % len(infiles_paths) +
-                "directories containing no more than %d files each." % MAX_NUM_FILES
-            )
-        raise SystemExit(1)
+    def __init__(self, options, name=None):
+        self.options = options
+        self.name = name
 
-    for filepath in infiles_paths:
-        if os.path.splitext(filepath) == ".par2" and not args.force:
-            print_wrap(
-                    "The input directory already contains .par2 files. You probably want to delete "
-                    "them and start over instead of creating another set of .par2 files protecting "
-                    "the old set. You can use the option --force to continue anyway."
-                )
+        # encryption implies compression
+        self.compress = options.compress or options.encrypt
+
+        self.outdir = options.outdir or os.getcwd()
+        self.indir = options.indir or os.getcwd()
+        self.prefix = options.prefix or (os.path.split(os.getcwd())[-1] + " ")
+        self.redundancy = options.redundancy or DEFAULT_REDUNDANCY
+        self.jobs = options.jobs or get_default_num_jobs()
+        self.num_volumes = options.num_volumes
+
+        if self.redundancy > self.num_volumes - 1:
+            print_wrap("Can't dedicate that many volumes to redundancy, at least one must contain the actual data.")
+            raise SystemExit(1)
+
+        if options.verify_losses >= self.num_volumes:
+            print_wrap("Can't verify the loss of %d volumes out of %d." % (options.verify_losses, self.num_volumes))
+            raise SystemExit(1)
+
+        if options.media is not None and options.media_size is not None:
+            print_wrap("Can't give both --media and --media-size.")
             raise SystemExit(1)
+        self.capacity = MEDIA_CAPACITIES[options.media] if options.media is not None else (
+                options.media_size * 1024 * 1024 if options.media_size is not None else None)
 
+        if options.num_blocks is not None and options.block_size is not None:
+            print_wrap("Can't set both block size and number of blocks.")
+            raise SystemExit(1)
 
-    input_filesizes = {f: os.path.getsize(f) for f in infiles_paths}
+        if options.par2_engine == "builtin" and numpy is None:
+            print_wrap("The builtin par2 engine requires NumPy, which could not be imported.")
+            raise SystemExit(1)
 
-    last_bin_size_fraction = redundancy % 1 or 1
-    bins, bin_sizes = distribute_files_uniformly(input_filesizes,
-                                                    args.num_volumes - int(math.floor(redundancy)),
-                                                    last_bin_size_fraction)
-    adjusted_bin_sizes = bin_sizes[:-1] + [int(bin_sizes[-1] / last_bin_size_fraction)]
+        if options.cache_dir is not None and not self.compress:
+            print_wrap("The compression cache can only be used together with --compress or --encrypt.")
+            raise SystemExit(1)
 
-    total_file_sizes = sum(input_filesizes.values())
-    average_volume_size = float(sum(adjusted_bin_sizes)) / len(adjusted_bin_sizes)
-    unevenness = max(adjusted_bin_sizes) / average_volume_size
-    if unevenness > args.num_volumes - 0.05 and not args.force:
-        print_wrap(
-                "The sizes of the input files %s" % ("(before compression) " if args.compression else "") +
-                "is uneven and it will probably not be possible to restore the files if one of the volumes "
-                "fail. To continue anyway you need to use the option --force."
-            )
-        raise SystemExit(1)
+        self.policy = None
+        if self.compress:
+            self.policy = CompressionPolicy(options.compression_level, options.compression_threads,
+                    sample=not options.compress_all)
 
+        self.journal_path = os.path.join(os.path.abspath(self.outdir), ".%s.journal" % self.prefix.strip().strip("_"))
+        if options.resume and options.pipeline:
+            print_wrap("Can't resume a run in --pipeline mode.")
+            raise SystemExit(1)
+        if options.resume and not os.path.exists(self.journal_path):
+            print_wrap("There is no run to resume (no journal %r)." % self.journal_path)
+            raise SystemExit(1)
 
-    password = None
-    if args.encrypt:
-        password = raw_input("Choose password: ")
-        
-        if password == "":
-            print_wrap("Can't have empty password. Use without the --encrypt switch to run without encryption.")
+        self.estimate = None
+        self.journal = None
+        self.tmpdir = None
+        self.cache = None
+        self.pipeline_md5_sums = {}
+        self.size_statistics = None
+        self.image_sizes = None
+
+    @contextlib.contextmanager
+    def metrics_stage(self, name, num_bytes=None):
+        with metrics.stage(name, num_bytes) as entry:
+            if self.name is not None:
+                entry["job"] = self.name
+            yield entry
+
+    def plan(self):
+        """Scans the input directory and decides how to split, pack and spread the files over
+        the recovery sets. Returns the plan of make_plan if --plan or --metrics-json (for a run
+        that isn't resumed) is given, else None."""
+        options = self.options
+        indir = self.indir
+        redundancy = self.redundancy
+
+        # The input directory is scanned once, and the sizes found are used from then on. The output
+        # directory, the volume directories and the temporary directories of runs are skipped, in
+        # case they are inside the input directory.
+        self.tmp_parent_dir = options.tmpdir or self.outdir
+        excluded_dirs = set(os.path.abspath(d) for d in [self.outdir, self.tmp_parent_dir] +
+                            get_dest_dirs(self.outdir, self.prefix, self.num_volumes))
+        if os.path.isdir(self.tmp_parent_dir):
+            excluded_dirs.update(os.path.abspath(os.path.join(self.tmp_parent_dir, name))
+                                    for name in os.listdir(self.tmp_parent_dir)
+                                    if name.startswith("%s_" % self.prefix) and name.endswith("_tmp"))
+        excluded_dirs.discard(os.path.abspath(indir))
+        scanned = scan_files(indir, recursive=options.recursive, ignore=True, exclude_dirs=excluded_dirs,
+                jobs=self.jobs)
+        # The journal is in the input directory if the output directory is. The names are compared
+        # relative to the input directory, which is much cheaper than an absolute path per file.
+        scanned.pop(os.path.relpath(self.journal_path, os.path.abspath(indir)), None)
+        # The path of each input file (and later of the planned parts and containers) in the volumes.
+        indir_prefix = os.path.join(indir, "")
+        input_names = dict((indir_prefix + name, name) for name in scanned)
+        input_filesizes = dict((path, scanned[name]) for path, name in input_names.items())
+        infiles_paths = sorted(input_filesizes)
+
+        if infiles_paths == []:
+            print("No input files")
             raise SystemExit(1)
 
-        valid_password_regexp = r"""^[a-zA-Z0-9!@#$%^&*+=,.\-_\\/()|;: ~<>?"'{}[\]]+$"""
-        if not re.match(valid_password_regexp, password):
-            print_wrap("To prevent problems with command lines and differences in escaping and such, only "
-                        "passwords matching the following regular expression are allowed: %r" % valid_password_regexp)
+        original_infiles_paths = infiles_paths
+        original_filesizes = dict(input_filesizes)
+
+        # Files that are too large to balance the volumes with are split into parts, which from now
+        # on take their place. The parts are created in the temporary directory when the files are
+        # prepared.
+        split = []
+        split_size = None
+        if not options.no_split:
+            if options.split_size is not None:
+                split_size = options.split_size * 1024 * 1024
+                split = plan_split_files(infiles_paths, input_filesizes, split_size)
+            else:
+                total_size = sum(input_filesizes.values())
+                split_size = get_split_part_size(total_size, self.num_volumes, redundancy)
+                split = plan_split_files(infiles_paths, input_filesizes, split_size,
+                        get_split_threshold(total_size, self.num_volumes, redundancy))
+        if split:
+            for infile, parts in split:
+                for part, offset, length in parts:
+                    if os.path.lexists(part):
+                        print_wrap("Can't split %r into parts, since %r is in the way." % (infile, part))
+                        raise SystemExit(1)
+                    input_filesizes[part] = length
+                del input_filesizes[infile]
+            infiles_paths = sorted(input_filesizes)
+            print_wrap("Splitting %d files into parts of %.1f MB. The %s file in each volume tells which "
+                        "parts to join to get them back." % (
+                        len(split), split_size / (1024.0 * 1024.0), SPLIT_MANIFEST_FILENAME))
+        else:
+            split_size = None
+
+        # Small files are packed into tar containers, which from now on take their place. Like the
+        # parts of split files, the containers are created in the temporary directory.
+        packed = []
+        pack_below = None
+        if options.pack_below is not None:
+            container_size = split_size or get_split_part_size(sum(input_filesizes.values()), self.num_volumes,
+                    redundancy)
+            pack_below = min(options.pack_below * 1024, container_size // 2)
+            # Parts of split files are not in the input directory yet, so they are never packed.
+            packed = plan_packed_files([f for f in infiles_paths if f in original_filesizes], input_filesizes,
+                    pack_below, container_size)
+        if packed:
+            for container, size, infiles in packed:
+                if os.path.lexists(container):
+                    print_wrap("Can't pack small files into %r, since there already is a file with that name." %
+                                container)
+                    raise SystemExit(1)
+                for infile in infiles:
+                    del input_filesizes[infile]
+                input_filesizes[container] = size
+            infiles_paths = sorted(input_filesizes)
+            print_wrap("Packing %d files smaller than %.1f kB into %d tar containers. The %s file in each "
+                        "volume tells which containers to unpack to get them back." % (
+                        sum(len(infiles) for container, size, infiles in packed), pack_below / 1024.0, len(packed),
+                        PACKED_MANIFEST_FILENAME))
+        else:
+            pack_below = None
+
+        input_names.update((f, os.path.relpath(f, indir)) for f in input_filesizes if f not in input_names)
+
+        if len(infiles_paths) < self.num_volumes - redundancy and not options.force:
+            print_wrap(
+                    "Not enough input files to spread out over %d volumes. I suggest you use 7zip to create "
+                    "volumes out of the data, e.g. '7z a -v<volume_size> *'. You can use the option --force "
+                    "to still go ahead with the creation but the results will most likely not be what you want."
+                    % self.num_volumes)
             raise SystemExit(1)
 
-        verify_password = raw_input("Verify password: ")
+        for filepath in infiles_paths:
+            if filepath.endswith(".par2") and not options.force:
+                print_wrap(
+                        "The input directory already contains .par2 files. You probably want to delete "
+                        "them and start over instead of creating another set of .par2 files protecting "
+                        "the old set. You can use the option --force to continue anyway."
+                    )
+                raise SystemExit(1)
+
+
+        # The parts of split files and the containers of packed files are a whole number of blocks
+        # if the block size divides their size. Compressed, their sizes are anything.
+        part_size = None
+        if not self.compress and (split or packed):
+            part_size = split_size or container_size
 
-        if password != verify_password:
-            print_wrap("Passwords don't match.")
+        redundancy_fraction = fractions.Fraction(redundancy) / self.num_volumes
+        num_recovery_sets = get_num_recovery_sets(input_filesizes, self.num_volumes, redundancy_fraction,
+                part_size)
+        infiles_per_set = split_into_recovery_sets(infiles_paths, input_filesizes, num_recovery_sets)
+        if num_recovery_sets > 1:
+            print_wrap("Splitting the %d files into %d independent par2 recovery sets, each of which is "
+                        "spread over all volumes." % (len(infiles_paths), num_recovery_sets))
+
+        # Distributing all the files only to check how even the volumes are takes long for many
+        # files, and is only done if the check could fail. distribute_files_uniformly first puts
+        # each file in the least loaded bin, so no bin gets more than an equal share of the other
+        # bins plus the largest file, and the average of the adjusted bin sizes is at least the
+        # total size over the number of bins.
+        total_file_sizes = sum(input_filesizes.values())
+        max_unevenness = self.num_volumes - 0.05
+        num_bins = self.num_volumes - int(math.floor(redundancy))
+        unevenness = (float(num_bins) / max(1, num_bins - 1) +
+                        float(num_bins) * max(input_filesizes.values()) / max(1, total_file_sizes))
+        if unevenness > max_unevenness:
+            last_bin_size_fraction = redundancy % 1 or 1
+            bins, bin_sizes = distribute_files_uniformly(input_filesizes, num_bins, last_bin_size_fraction)
+            adjusted_bin_sizes = bin_sizes[:-1] + [int(bin_sizes[-1] / last_bin_size_fraction)]
+            average_volume_size = float(sum(adjusted_bin_sizes)) / len(adjusted_bin_sizes)
+            unevenness = max(adjusted_bin_sizes) / average_volume_size
+        if unevenness > max_unevenness and not options.force:
+            print_wrap(
+                    "The sizes of the input files %s" % ("(before compression) " if self.compress else "") +
+                    "is uneven and it will probably not be possible to restore the files if one of the volumes "
+                    "fail. To continue anyway you need to use the option --force."
+                )
             raise SystemExit(1)
 
-    start_time = time.time()
 
-    tmp_parent_dir = args.tmpdir or outdir
-    create_dir_if_not_exists_or_fail(tmp_parent_dir)
-    
-    tmpdir = tempfile.mkdtemp(prefix="%s_"%prefix, suffix="_tmp", dir=tmp_parent_dir)
-    try:
-        assert os.listdir(tmpdir) == []
+        if options.iso:
+            names = [get_prepared_filename(input_names[f], self.compress) for f in infiles_paths] + [
+                    MD5SUM_FILENAME] + [get_par2_filename(self.prefix, i, num_recovery_sets)
+                    for i in range(num_recovery_sets)] + (
+                    [SPLIT_MANIFEST_FILENAME] if split else []) + ([PACKED_MANIFEST_FILENAME] if packed else [])
+            for name in names:
+                problem = check_iso_filename(name)
+                if problem is not None:
+                    print_wrap("Can't store %r in an ISO image with its name intact, since %s." % (name, problem))
+                    raise SystemExit(1)
 
+        if self.capacity is not None:
+            def estimate(num_volumes):
+                return estimate_volume_size(total_file_sizes, len(infiles_paths), num_volumes, redundancy)
+            if estimate(self.num_volumes) > self.capacity and not options.force and not options.plan:
+                min_num_volumes = self.num_volumes
+                while estimate(min_num_volumes) > self.capacity:
+                    min_num_volumes += 1
+                print_wrap("The volumes will probably be about %.1f MB each, which doesn't fit on media of "
+                            "%.1f MB. Use at least %d volumes. You can use the option --force to go ahead "
+                            "anyway." % (estimate(self.num_volumes) / (1024.0 * 1024.0),
+                                         self.capacity / (1024.0 * 1024.0), min_num_volumes))
+                raise SystemExit(1)
 
-        if compress:
-            files_to_be_archived = compress_files(infiles=infiles_paths,
-                                        outdir=tmpdir,
-                                        tmpdir=tmpdir,
-                                        password=password)
+        self.original_infiles_paths = original_infiles_paths
+        self.original_filesizes = original_filesizes
+        self.input_filesizes = input_filesizes
+        self.input_names = input_names
+        self.split = split
+        self.split_size = split_size
+        self.packed = packed
+        self.pack_below = pack_below
+        self.part_size = part_size
+        self.redundancy_fraction = redundancy_fraction
+        self.num_recovery_sets = num_recovery_sets
+        self.infiles_per_set = infiles_per_set
+        self.total_file_sizes = total_file_sizes
+
+        if options.plan or (options.metrics_json is not None and not options.resume):
+            calibration = read_calibration(options.calibrate or [], options.par2_engine) if options.plan else None
+            self.estimate = make_plan(infiles_per_set, input_filesizes, self.prefix, self.num_volumes, redundancy,
+                    self.compress, block_size=options.block_size, num_blocks=options.num_blocks,
+                    memory=options.memory, jobs=self.jobs, par2_engine=options.par2_engine,
+                    pipeline=options.pipeline, verify=not options.no_verify, deep_verify=options.deep_verify,
+                    iso=options.iso, split_bytes=sum(original_filesizes[infile] for infile, parts in split),
+                    pack_bytes=sum(size for container, size, infiles in packed), calibration=calibration,
+                    names=input_names, part_size=self.part_size)
+        return self.estimate
+
+    def print_plan(self):
+        print_plan(self.estimate, self.compress, self.redundancy, self.num_volumes, self.capacity,
+                self.options.calibrate)
+
+    def start(self, password=None):
+        """Starts a new run, or the run to resume: checks the journal (and that password is the
+        one of the run to resume) or that the volumes don't exist, and sets up the temporary
+        directory and the compression cache."""
+        options = self.options
+        parameters = {"indir": os.path.abspath(self.indir), "prefix": self.prefix, "num_volumes": self.num_volumes,
+                      "redundancy": str(self.redundancy), "compress": self.compress, "encrypt": options.encrypt,
+                      "block_size": options.block_size, "num_blocks": options.num_blocks,
+                      "par2_engine": options.par2_engine, "iso": options.iso, "split_size": self.split_size,
+                      "pack_below": self.pack_below, "recursive": options.recursive,
+                      "compression_level": options.compression_level, "compress_all": options.compress_all,
+                      "input_files": [[self.input_names[f], self.original_filesizes[f]]
+                                      for f in self.original_infiles_paths]}
+        if options.resume:
+            journal = Journal.load(self.journal_path)
+            recorded_parameters = dict(journal.state["parameters"])
+            recorded_parameters.pop("password_verifier", None)
+            if recorded_parameters != parameters:
+                print_wrap("The parameters or the input files are not the same as in the run to resume.")
+                raise SystemExit(1)
+            if options.encrypt and not journal.is_password_right(password):
+                print_wrap("The password is not the same as in the run to resume.")
+                raise SystemExit(1)
+            tmpdir = journal.state["tmpdir"]
+            if not journal.is_stage_done("move") and not os.path.isdir(tmpdir):
+                print_wrap("The temporary directory %r of the run to resume is gone." % tmpdir)
+                raise SystemExit(1)
+            print_wrap("Resuming the previous run, which completed the stages: %s" % (
+                    ", ".join(journal.state["stages"]) or "none"))
         else:
-            files_to_be_archived = copy_files(infiles=infiles_paths, outdir=tmpdir)
-        
-        compression_copy_time = time.time()
-        
-        tmpdir_contents = sorted([os.path.join(tmpdir, f) for f in os.listdir(tmpdir)])
-        assert tmpdir_contents == sorted(files_to_be_archived), "%r" % list(itertools.izip_longest(
-                tmpdir_contents, sorted(files_to_be_archived)))
+            for d in get_dest_dirs(self.outdir, self.prefix, self.num_volumes):
+                if os.path.exists(d):
+                    print_wrap("The volume directory %r already exists." % d)
+                    raise SystemExit(1)
+            for iso_path in get_iso_paths(self.outdir, self.prefix, self.num_volumes) if options.iso else []:
+                if os.path.exists(iso_path):
+                    print_wrap("The image %r already exists." % iso_path)
+                    raise SystemExit(1)
 
-        file_sizes = {f: os.path.getsize(f) for f in files_to_be_archived}
+            create_dir_if_not_exists_or_fail(self.tmp_parent_dir)
+            create_dir_if_not_exists_or_fail(self.outdir)
+
+            tmpdir = os.path.abspath(tempfile.mkdtemp(prefix="%s_" % self.prefix, suffix="_tmp",
+                    dir=self.tmp_parent_dir))
+            assert os.listdir(tmpdir) == []
+            # Runs in pipeline mode place the files in the volumes as they go and can't be resumed.
+            if options.encrypt:
+                parameters["password_verifier"] = Journal.get_password_verifier(password)
+            journal = Journal(None if options.pipeline else self.journal_path, parameters, tmpdir)
+            journal.save()
+        self.journal = journal
+        self.tmpdir = tmpdir
+
+        if options.cache_dir is not None:
+            try:
+                self.cache = CompressionCache(options.cache_dir, options.cache_size * 1024 * 1024, options.staging)
+            except (IOError, OSError, ValueError) as e:
+                print_wrap("Could not open the compression cache %r: %s" % (options.cache_dir, e))
+                raise SystemExit(1)
+
+        self.set_dirs = [os.path.join(tmpdir, "set%d" % (i+1)) for i in range(self.num_recovery_sets)]
+        self.par2_filenames = [get_par2_filename(self.prefix, i, self.num_recovery_sets)
+                               for i in range(self.num_recovery_sets)]
+
+    @contextlib.contextmanager
+    def keeping_progress_on_failure(self):
+        """Saves the compression cache if the with block fails, and keeps the temporary directory
+        for --resume, or removes it if the run can't be resumed."""
+        try:
+            yield
+        except BaseException:
+            if self.cache is not None:
+                try:
+                    self.cache.save()
+                except (IOError, OSError):
+                    pass
+            if self.journal.path is None:
+                shutil.rmtree(self.tmpdir)
+            else:
+                print_wrap("Keeping the temporary directory %r. Run again with the same options and "
+                            "--resume to continue where this run stopped." % self.tmpdir)
+            raise
+
+    def create_recovery_set(self, i, jobs, memory, quiet):
+        options = self.options
+        set_dir = self.set_dirs[i]
+        set_name = (" for recovery set %d" % (i+1)) if self.num_recovery_sets > 1 else ""
+        if self.journal.is_par2_set_done(set_dir, self.par2_filenames[i]):
+            print_wrap("Reusing the par2 files%s from the previous run" % set_name)
+            return
+        file_sizes = {}
+        for name, size in scan_files(set_dir).items():
+            if is_par2_file(name):
+                os.remove(os.path.join(set_dir, name))
+            else:
+                file_sizes[os.path.join(set_dir, name)] = size
+
+        block_size = options.block_size
+        if options.num_blocks is None and block_size is None:
+            block_size = get_suitable_block_size(file_sizes, redundancy_fraction=self.redundancy_fraction,
+                    memory=memory * 1024 * 1024 if memory else None, jobs=jobs,
+                    explain=options.explain_block_size, part_size=self.part_size)
+            print_wrap("Using block size %d%s" % (block_size, set_name))
 
-        redundancy_fraction = fractions.Fraction(redundancy) / args.num_volumes
-        
-        block_size = args.block_size
-        if args.num_blocks is None and block_size is None:
-            block_size = get_suitable_block_size(file_sizes)
-            print_wrap("Using block size %d" % block_size)
-        
         if block_size is not None:
             total_blocks = get_total_num_blocks(file_sizes.values(), block_size)
-            num_recovery_blocks = get_num_recovery_blocks(total_blocks, redundancy_fraction)
+            num_recovery_blocks = get_num_recovery_blocks(total_blocks, self.redundancy_fraction)
         else:
-            num_recovery_blocks = get_num_recovery_blocks(args.num_blocks, redundancy_fraction)
+            num_recovery_blocks = get_num_recovery_blocks(options.num_blocks, self.redundancy_fraction)
+
+        create_par2_files(set_dir, self.par2_filenames[i], num_recovery_blocks=num_recovery_blocks,
+                block_size=block_size, num_blocks=options.num_blocks, memory=memory,
+                engine=options.par2_engine, jobs=jobs, quiet=quiet)
+        self.journal.record_par2_set(set_dir, self.par2_filenames[i])
+
+    def stage(self, password=None, jobs=None, memory=None):
+        """Splits and packs the files and compresses (or copies) them into the temporary
+        directory of their recovery set. In pipeline mode this also creates the par2 files and
+        moves the files to the volumes, using memory megabytes for par2."""
+        options = self.options
+        jobs = jobs or self.jobs
+        memory = memory if memory is not None else options.memory
+        compress = self.compress
+        input_names = self.input_names
+        input_filesizes = self.input_filesizes
+        self.start(password)
+        journal = self.journal
+        tmpdir = self.tmpdir
+        cache = self.cache
+        set_dirs = self.set_dirs
+        if journal.is_stage_done("move"):
+            return
+
+        with self.keeping_progress_on_failure():
+            if self.split:
+                partsdir = os.path.join(tmpdir, "parts")
+                if not os.path.isdir(partsdir):
+                    os.mkdir(partsdir)
+                with self.metrics_stage("split", sum(self.original_filesizes[infile] for infile, parts in self.split)):
+                    part_paths = split_files(self.split, self.indir, partsdir)
+                for part, path in part_paths.items():
+                    input_names[path] = input_names[part]
+                    input_filesizes[path] = input_filesizes[part]
+                self.infiles_per_set = [[part_paths.get(f, f) for f in infiles] for infiles in self.infiles_per_set]
+            if self.packed:
+                packdir = os.path.join(tmpdir, "packed")
+                if not os.path.isdir(packdir):
+                    os.mkdir(packdir)
+                with self.metrics_stage("pack", sum(size for container, size, infiles in self.packed)):
+                    container_paths = pack_files(self.packed, self.indir, packdir)
+                for container, path in container_paths.items():
+                    input_names[path] = input_names[container]
+                    input_filesizes[path] = input_filesizes[container]
+                self.infiles_per_set = [[container_paths.get(f, f) for f in infiles]
+                                        for infiles in self.infiles_per_set]
+
+            return_files_to_set_dirs(get_dest_dirs(self.outdir, self.prefix, self.num_volumes), set_dirs, journal)
+            for set_dir in set_dirs:
+                if not os.path.isdir(set_dir):
+                    os.mkdir(set_dir)
+
+            if options.pipeline:
+                dest_dirs = get_dest_dirs(self.outdir, self.prefix, self.num_volumes)
+                for d in dest_dirs:
+                    os.mkdir(d)
+
+                # The recovery sets are created in parallel, sharing the cores and the memory.
+                parallel_sets, par2_jobs, par2_memory = get_par2_resources(memory, options.par2_engine, jobs,
+                        self.num_recovery_sets)
+
+                def prepare_file(infile, set_dir):
+                    filename = input_names[infile]
+                    outfile = os.path.join(set_dir, get_prepared_filename(filename, compress))
+                    make_parent_dirs(outfile)
+                    if compress:
+                        try:
+                            compress_file(infile=infile, outfile=outfile, tmpdir=tmpdir, password=password,
+                                    quiet=True, cache=cache, policy=self.policy)
+                        except ExecutionFailed as e:
+                            print_execution_output(e)
+                            print_wrap("Couldn't compress file %r" % filename)
+                            raise SystemExit(1)
+                    else:
+                        stage_file(infile, outfile, options.staging)
+                    return outfile
+
+                def create_and_place_recovery_set(i):
+                    self.create_recovery_set(i, par2_jobs, par2_memory, quiet=True)
+                    self.place_recovery_set(i, quiet=True)
+
+                try:
+                    with self.metrics_stage("pipeline", self.total_file_sizes) as stage:
+                        files_to_be_archived, self.pipeline_md5_sums, prepared_time = prepare_and_place_files(
+                                self.infiles_per_set, set_dirs, prepare_file, create_and_place_recovery_set,
+                                jobs=jobs, max_bytes_in_flight=options.max_in_flight * 1024 * 1024,
+                                queue_size=2 * jobs, file_sizes=input_filesizes, parallel_sets=parallel_sets)
+                        stage["prepared_seconds"] = prepared_time - stage["start_time"]
+                except BaseException:
+                    # A run in pipeline mode can't be resumed, so the volumes it started are
+                    # removed to let the next run start over.
+                    for d in dest_dirs:
+                        shutil.rmtree(d, ignore_errors=True)
+                    raise
+            else:
+                def record_prepared_file(infile, outfile):
+                    # Compressed files are hashed while they are still in the page cache; staged files
+                    # are just links to the input files and are hashed by par2 anyway.
+                    journal.record_prepared_file(infile, outfile,
+                            get_prepared_filename(input_names[infile], compress),
+                            md5_of_file(outfile) if compress else None)
+
+                files_to_be_archived = []
+                with self.metrics_stage("compress" if compress else "copy", self.total_file_sizes):
+                    for set_dir, infiles in zip(set_dirs, self.infiles_per_set):
+                        outfiles = [os.path.join(set_dir, get_prepared_filename(input_names[f], compress))
+                                    for f in infiles]
+                        todo = [f for f, outfile in zip(infiles, outfiles) if not journal.is_file_prepared(f, outfile)]
+                        if len(todo) < len(infiles):
+                            print_wrap("Reusing %d files prepared by the previous run" % (len(infiles) - len(todo)))
+                        for f in todo:
+                            outfile = os.path.join(set_dir, get_prepared_filename(input_names[f], compress))
+                            if os.path.lexists(outfile):
+                                os.remove(outfile)
+
+                        if compress:
+                            compress_files(infiles=todo,
+                                            outdir=set_dir,
+                                            tmpdir=tmpdir,
+                                            password=password,
+                                            jobs=jobs,
+                                            max_bytes_in_flight=options.max_in_flight * 1024 * 1024,
+                                            on_file_done=record_prepared_file,
+                                            cache=cache,
+                                            names=input_names,
+                                            file_sizes=input_filesizes,
+                                            policy=self.policy)
+                        else:
+                            stage_files(infiles=todo, outdir=set_dir, mode=options.staging,
+                                    on_file_done=record_prepared_file, names=input_names)
+                        files_to_be_archived.append(outfiles)
 
-        par2_filename = "%s.par2" % prefix.strip().strip("_")
-        create_par2_files(tmpdir, par2_filename, num_recovery_blocks=num_recovery_blocks,
-                block_size=block_size, num_blocks=args.num_blocks, memory=args.memory)
+                journal.mark_stage_done("prepare")
 
-        par2_creation_time = time.time()
+                for set_dir, set_files in zip(set_dirs, files_to_be_archived):
+                    set_dir_contents = sorted([os.path.join(set_dir, f) for f in list_files(set_dir)
+                                                    if not is_par2_file(f)])
+                    assert set_dir_contents == sorted(set_files), "%r" % list(itertools.izip_longest(
+                            set_dir_contents, sorted(set_files)))
 
-        create_dir_if_not_exists_or_fail(outdir)
+    def par2(self, jobs=None, memory=None):
+        """Creates the par2 files of the recovery sets (already done in pipeline mode), using
+        jobs cores and memory megabytes (None lets par2 decide)."""
+        if not self.journal.is_stage_done("move"):
+            if not self.options.pipeline:
+                with self.keeping_progress_on_failure():
+                    # The recovery sets are created in parallel, sharing the cores and the memory.
+                    parallel_sets, par2_jobs, par2_memory = get_par2_resources(
+                            memory if memory is not None else self.options.memory, self.options.par2_engine,
+                            jobs or self.jobs, self.num_recovery_sets)
+                    with self.metrics_stage("par2"):
+                        run_in_parallel(lambda i: self.create_recovery_set(i, par2_jobs, par2_memory,
+                                quiet=parallel_sets > 1 or self.name is not None),
+                                range(self.num_recovery_sets), parallel_sets)
+            self.journal.mark_stage_done("par2")
 
-        move_files_to_destination_dir(srcdir=tmpdir, destdir=outdir, par2_filename=par2_filename,
-                prefix=prefix, num_volumes=args.num_volumes)
+    def place_recovery_set(self, i, quiet=False):
+        """Moves the files and the par2 files of recovery set i to the volumes, balancing them
+        by par2 blocks."""
+        move_files_to_destination_dir(srcdir=self.set_dirs[i], destdir=self.outdir,
+                par2_filename=self.par2_filenames[i], prefix=self.prefix, num_volumes=self.num_volumes,
+                staging_mode=self.options.staging, quiet=quiet)
 
+    def place(self):
+        """Moves the files and the par2 files of each recovery set to the volumes (already done
+        in pipeline mode)."""
+        if self.journal.is_stage_done("move"):
+            return
+        if not self.options.pipeline:
+            with self.keeping_progress_on_failure():
+                with self.metrics_stage("move"):
+                    for i in range(self.num_recovery_sets):
+                        self.place_recovery_set(i)
+
+        shutil.rmtree(self.tmpdir)
+        self.journal.mark_stage_done("move")
+        if self.cache is not None:
+            self.cache.save()
+
+    def checksum(self, jobs=None):
+        """Writes the manifests of split and packed files and the MD5SUM file of each volume."""
+        if not self.journal.is_stage_done("md5"):
+            dest_dirs = get_dest_dirs(self.outdir, self.prefix, self.num_volumes)
+            with self.metrics_stage("md5"):
+                if self.split:
+                    write_split_manifest(dest_dirs, self.split, self.indir)
+                if self.packed:
+                    write_packed_manifest(dest_dirs, self.packed, self.indir)
+                create_md5_sums(inoutdir=self.outdir, prefix=self.prefix, num_volumes=self.num_volumes,
+                        jobs=jobs or self.jobs, known_md5_sums=self.pipeline_md5_sums or self.journal.get_md5_sums())
+            self.journal.mark_stage_done("md5")
+
+    def verify(self, jobs=None):
+        """Checks that the files can be restored if volumes are lost, unless --no-verify."""
+        options = self.options
+        if not options.no_verify and not self.journal.is_stage_done("verify"):
+            with self.metrics_stage("verify"):
+                verify(self.outdir, self.prefix, self.num_volumes, options.verify_losses)
+                if options.deep_verify:
+                    deep_verify(self.outdir, self.par2_filenames, self.prefix, self.num_volumes, jobs or self.jobs)
+        self.journal.mark_stage_done("verify")
+
+    def finish(self):
+        """Collects the size statistics, writes the ISO images if asked to and ends the run."""
+        # The volume directories are gone once the images are written.
+        if all(os.path.isdir(d) for d in get_dest_dirs(self.outdir, self.prefix, self.num_volumes)):
+            self.size_statistics = get_size_statistics(self.outdir, self.prefix, self.num_volumes)
+
+        if self.options.iso:
+            with self.metrics_stage("iso"):
+                self.image_sizes = write_iso_images(self.outdir, self.prefix, self.num_volumes, self.capacity)
+            self.journal.mark_stage_done("iso")
+
+        self.journal.remove()
+
+    def run(self, password=None):
+        """Runs the stages after plan() one after another."""
+        self.stage(password)
+        self.par2()
+        self.place()
+        self.checksum()
+        self.verify()
+        self.finish()
+
+    def report(self):
+        print("")
+        print("Success, everything done.")
+        print("")
+        print("Time statistics:")
+        stage_labels = get_stage_labels(self.compress)
+        for stage in metrics.stages:
+            if stage.get("job") != self.name:
+                continue
+            print("%s: %.1f seconds (%.1f seconds of CPU time)%s" % (
+                    stage_labels[stage["name"]], stage["wall_seconds"],
+                    stage["cpu_seconds"] + stage["child_cpu_seconds"],
+                    (", all files prepared after %.1f seconds" % stage["prepared_seconds"])
+                        if "prepared_seconds" in stage else ""))
+        if self.cache is not None:
+            print("Compression cache: %d hits, %d misses, %.1f MB less to compress" % (
+                    self.cache.num_hits, self.cache.num_misses, self.cache.bytes_saved / (1024.0 * 1024.0)))
+        if self.policy is not None and self.policy.sample and self.policy.decisions:
+            (num_stored, num_stored_bytes), (num_compressed, num_compressed_bytes) = self.policy.get_totals()
+            print_wrap("Adaptive compression: %d files (%.1f MB) compressed, %d files (%.1f MB) that didn't shrink "
+                        "stored, saving about %s of CPU time" % (
+                    num_compressed, num_compressed_bytes / (1024.0 * 1024.0), num_stored,
+                    num_stored_bytes / (1024.0 * 1024.0), format_duration(self.policy.get_cpu_seconds_saved())))
+            stored = sorted((self.input_names.get(infile, os.path.split(infile)[-1]), ratio)
+                            for infile, (store, ratio, size) in self.policy.decisions.items() if store)
+            for name, ratio in stored:
+                print_wrap("  Stored %s (samples compressed to %.0f %%)" % (name, 100.0 * ratio))
+
+        if self.options.iso:
+            print("")
+            print("Image sizes:")
+            print("\n".join(create_bar_chart(self.image_sizes)))
+        if self.size_statistics is not None:
+            volume_sizes, par2_sizes, par2_set_sizes = self.size_statistics
+            if not self.options.iso:
+                print("")
+                print("Volume sizes:")
+                print("\n".join(create_bar_chart(volume_sizes)))
+            print("")
+            if self.num_recovery_sets > 1:
+                print("Par2 file sizes per recovery set:")
+                for name, size in sorted(par2_set_sizes.items()):
+                    print("%s: %d" % (name, size))
+                print("")
+            print_wrap(("Par2 recovery files are %.1f %% of the output (ideal for a redundancy "
+                        "of %s volumes out of %d would be %.1f %%)") % (
+                    100.0 * sum(par2_sizes) / sum(volume_sizes),
+                    self.redundancy,
+                    self.num_volumes,
+                    100.0 * float(self.redundancy) / self.num_volumes))
+            if self.capacity is not None and not self.options.iso and max(volume_sizes) > self.capacity:
+                print("")
+                print_wrap("Warning: the largest volume is %d bytes, which doesn't fit on the media (%d bytes)." % (
+                        max(volume_sizes), self.capacity))
+        print("")
+
+
+class ResourceBudget(object):
+    """The cores, megabytes of memory and disk streams (stages reading or writing files) shared
+    by the num_jobs jobs of a batch."""
+
+    def __init__(self, cores, memory, disk_streams, num_jobs=1):
+        self.totals = {"cores": cores, "memory": memory, "disk_streams": disk_streams}
+        self.free = dict(self.totals)
+        self.num_active_jobs = num_jobs
+        self.condition = threading.Condition()
+
+    def job_done(self):
+        """Lets the jobs that are left have a larger share of the resources."""
+        with self.condition:
+            self.num_active_jobs -= 1
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def use(self, **demands):
+        """Waits until at least the minimum of each resource in demands (a name and a (minimum,
+        maximum) pair) is free, and gives a dict with the amount of each resource the with block
+        may use: as much as is free, up to the maximum, but no more than an equal share of the
+        total per active job (or the minimum, if that is larger), so that one job doesn't keep the
+        stages of the others waiting. A minimum larger than the total is lowered to the total, so
+        that no stage waits forever."""
+        demands = dict((name, (min(minimum, self.totals[name]), maximum))
+                       for name, (minimum, maximum) in demands.items())
+        with self.condition:
+            while any(self.free[name] < minimum for name, (minimum, maximum) in demands.items()):
+                self.condition.wait()
+            granted = dict((name, min(self.free[name], maximum,
+                                      max(minimum, self.totals[name] // max(1, self.num_active_jobs))))
+                           for name, (minimum, maximum) in demands.items())
+            for name, amount in granted.items():
+                self.free[name] -= amount
+        try:
+            yield granted
+        finally:
+            with self.condition:
+                for name, amount in granted.items():
+                    self.free[name] += amount
+                self.condition.notify_all()
+
+
+# The least memory a batch gives par2, in megabytes.
+MIN_BATCH_PAR2_MEMORY = 256
+
+
+def get_batch_stages(job, password, budget):
+    """Returns the stages of job after plan(), each as its name, its demands on the budget (see
+    ResourceBudget.use) and a function running it with the resources granted. Stages that
+    mostly compute ask for cores, and stages that read or write files for a disk stream, so
+    that the stages of different jobs that need different resources run at the same time.
+    Checksumming is limited by the disk rather than by MD5, so it takes no cores and hashes one
+    file at a time."""
+    cores = (1, budget.totals["cores"])
+    memory = (MIN_BATCH_PAR2_MEMORY, budget.totals["memory"])
+    disk = (1, 1)
+    pipeline = job.options.pipeline
+    return [
+        ("stage", dict(cores=cores if job.compress or pipeline else (0, 0), memory=memory if pipeline else (0, 0),
+                       disk_streams=disk),
+            lambda granted: job.stage(password, granted["cores"] or None, granted["memory"] or None)),
+        ("par2", dict(cores=cores, memory=memory if not pipeline else (0, 0), disk_streams=disk),
+            lambda granted: job.par2(granted["cores"], granted["memory"] or None)),
+        ("place", dict(disk_streams=disk),
+            lambda granted: job.place()),
+        ("checksum", dict(disk_streams=disk),
+            lambda granted: job.checksum(1)),
+        ("verify", dict(cores=cores if job.options.deep_verify else (0, 0),
+                        disk_streams=disk if job.options.deep_verify else (0, 0)),
+            lambda granted: job.verify(granted["cores"] or None)),
+        ("finish", dict(disk_streams=disk if job.options.iso else (0, 0)),
+            lambda granted: job.finish()),
+    ]
+
+
+def run_batch_jobs(jobs, password, budget):
+    """Runs the ArchiveJobs all at the same time, each stage when the budget has the resources
+    it demands (see get_batch_stages). Returns whether each job succeeded; a job that fails
+    doesn't stop the others."""
+    lock = threading.Lock()
+
+    def run_job(job):
+        try:
+            return run_job_stages(job)
+        finally:
+            budget.job_done()
+
+    def run_job_stages(job):
+        try:
+            with budget.use(disk_streams=(1, 1)):
+                job.plan()
+            for stage, demands, run_stage in get_batch_stages(job, password, budget):
+                with budget.use(**demands) as granted:
+                    resources = ", ".join("%d %s" % (granted[resource], unit) for resource, unit in
+                                          [("cores", "cores"), ("memory", "MB of memory")] if granted.get(resource))
+                    with lock:
+                        print("%s: %s%s" % (job.name, stage, (" (%s)" % resources) if resources else ""))
+                    run_stage(granted)
+        except SystemExit:
+            with lock:
+                print_wrap("%s failed" % job.name)
+            return False
+        except Exception:
+            with lock:
+                traceback.print_exc()
+                print_wrap("%s failed" % job.name)
+            return False
+        return True
+
+    return run_in_parallel(run_job, jobs, len(jobs))
+
+
+def batch(argv):
+    parser = argparse.ArgumentParser(prog="%s batch" % os.path.split(sys.argv[0])[-1], description=(
+        "Prepare the files of each of several directories like the script does for one directory, "
+        "running the stages of the directories at the same time. The cores (--jobs), the memory of "
+        "par2 (--memory) and the number of stages reading or writing files (--disk-streams) are "
+        "shared by all directories, so that e.g. the files of one directory are compressed while "
+        "those of another are checksummed. The volume directories of each directory are named "
+        "after it. A directory that fails doesn't stop the others."))
+    add_archive_arguments(parser, batch=True)
+    parser.add_argument("directories", metavar="DIR", nargs="+",
+            help="The directories to process.")
+    parser.add_argument("--disk-streams", metavar="N", type=check_integer_equal_or_greater(1), default=2,
+            help="Number of stages (of any directory) that may read or write files at the same time. "
+                    "Default: %(default)s.")
+    args = parser.parse_args(argv)
+
+    names = []
+    for directory in args.directories:
+        if not os.path.isdir(directory):
+            print_wrap("%r is not a directory." % directory)
+            raise SystemExit(1)
+        name = os.path.split(os.path.abspath(directory))[-1]
+        if name in names:
+            print_wrap("There are several directories named %r, whose volumes would get the same names." % name)
+            raise SystemExit(1)
+        names.append(name)
+
+    if args.profile is not None:
+        metrics.start_profiling()
+
+    jobs = []
+    for directory, name in zip(args.directories, names):
+        options = argparse.Namespace(**vars(args))
+        options.indir = directory
+        options.prefix = name + " "
+        jobs.append(ArchiveJob(options, name))
+    budget = ResourceBudget(jobs[0].jobs, args.memory, args.disk_streams, len(jobs))
+
+    if args.plan:
+        for job in jobs:
+            print("")
+            print("%s:" % job.name)
+            job.plan()
+            job.print_plan()
+        return
+
+    password = read_password() if args.encrypt else None
+    start_time = time.time()
+    try:
+        succeeded = run_batch_jobs(jobs, password, budget)
+
+        for job, ok in zip(jobs, succeeded):
+            if ok:
+                print("")
+                print("%s:" % job.name)
+                job.report()
+        print_wrap("%d of %d directories done in %s." % (sum(succeeded), len(jobs),
+                format_duration(time.time() - start_time)))
+        failed = [job.name for job, ok in zip(jobs, succeeded) if not ok]
+        if failed:
+            print_wrap("Failed: %s" % ", ".join(failed))
     finally:
-        shutil.rmtree(tmpdir)
+        # Also written if the batch is interrupted, with the stages that failed marked as such.
+        if args.metrics_json is not None:
+            metrics.write_json(args.metrics_json, {"num_volumes": args.num_volumes, "compress": args.compress or
+                    args.encrypt, "jobs": budget.totals["cores"], "memory": args.memory,
+                    "disk_streams": args.disk_streams, "par2_engine": args.par2_engine,
+                    "pipeline": args.pipeline, "directories": names})
+    if args.profile is not None:
+        metrics.write_profile(args.profile)
+    if failed:
+        raise SystemExit(1)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(epilog=(
+        "Burned volumes can be checked with '%(prog)s check-media MOUNT_POINT...', the files "
+        "restored from them with '%(prog)s restore -o DIR MOUNT_POINT...', and several directories "
+        "processed at the same time with '%(prog)s batch NUM_VOLUMES DIR...'."), description=(
+        "Prepare all files in a directory to be written to a set of backup volumes (e.g. DVDs). "
+        "Each file is optionally compressed and encrypted using 7zip and then a set of par2 files are created. "
+        "The par2 files makes it possible to restore files even if one of the backup volumes is lost, "
+        "if I/O errors are encountered, or if files are silently corrupted when reading back the data. "
+        "This script will create one folder for each volume with approximately equal amount of data "
+        "in each one. "))
+    add_archive_arguments(parser)
+    args = parser.parse_args()
 
-    create_md5_sums(inoutdir=outdir, prefix=prefix, num_volumes=args.num_volumes)
+    job = ArchiveJob(args)
 
-    md5sum_time = time.time()
+    if args.profile is not None:
+        metrics.start_profiling()
 
-    if not args.no_verify:
-        verify(outdir, par2_filename, prefix, args.num_volumes)
+    plan = job.plan()
+    if args.plan:
+        job.print_plan()
+        return
 
-    verify_time = time.time()
+    password = read_password() if args.encrypt else None
+    try:
+        job.run(password)
+        job.report()
+    finally:
+        # Also written if the run fails, with the stage that failed marked as such.
+        if args.metrics_json is not None:
+            # The estimates of the plan are recorded so that later plans can be calibrated with this run.
+            for stage in metrics.stages:
+                stage["model_seconds"] = plan["model_seconds"].get(stage["name"]) if plan is not None else None
+            prepared_size = None
+            if job.size_statistics is not None:
+                prepared_size = sum(job.size_statistics[0]) - sum(job.size_statistics[1])
+            metrics.write_json(args.metrics_json, {"num_volumes": args.num_volumes,
+                    "redundancy": str(job.redundancy), "compress": job.compress, "jobs": job.jobs,
+                    "par2_engine": args.par2_engine, "pipeline": args.pipeline,
+                    "num_input_files": len(job.original_infiles_paths), "input_size": job.total_file_sizes,
+                    "prepared_size": prepared_size})
+    if args.profile is not None:
+        metrics.write_profile(args.profile)
 
-    print("")
-    print("Success, everything done.")
-    print("")
-    print("Time statistics:")
-    print(("Compression: " if compress else "Initial file copy: ") +
-            "%.1f seconds" % (compression_copy_time - start_time))
-    print("Par2 creation: %.1f seconds" % (par2_creation_time - compression_copy_time))
-    print("MD5 sum: %.1f seconds" % (md5sum_time - par2_creation_time))
-    print("Verification: %.1f seconds" % (verify_time - md5sum_time))
 
-    volume_sizes, par2_sizes = get_size_statistics(outdir, prefix, args.num_volumes)
-    print("")
-    print("Volume sizes:")
-    print("\n".join(create_bar_chart(volume_sizes)))
-    print("")
-    print_wrap(("Par2 recovery files are %.1f %% of the output (ideal for a redundancy "
-                "of %s volumes out of %d would be %.1f %%)") % (
-            100.0 * sum(par2_sizes) / sum(volume_sizes),
-            redundancy,
-            args.num_volumes,
-            100.0 * float(redundancy) / args.num_volumes))
-    print("")
+SUBCOMMANDS = {
+    "batch": batch,
+    "check-media": check_media,
+    "restore": restore,
+}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,1072 @@
+"""Tests of create_par2.py. The unit tests need nothing but Python; the end-to-end tests run the
+real par2 and 7z, and are skipped if par2 or 7z (or NumPy, for the builtin par2 engine) is not
+installed. Run with: python -m unittest test_create_par2"""
+
+import fractions
+import random
+
+import argparse
+import filecmp
+import hashlib
+import itertools
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import create_par2
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "create_par2.py")
+
+
+def find_executable(name):
+    which = getattr(shutil, "which", None)
+    if which is None:
+        # Python 2
+        import distutils.spawn
+        which = distutils.spawn.find_executable
+    return which(name)
+
+
+def run_par2(args, cwd):
+    with open(os.devnull, "wb") as devnull:
+        return subprocess.call(["par2"] + args, cwd=cwd, stdout=devnull, stderr=devnull)
+
+
+def read_recovery_packets(directory):
+    """Returns {exponent: (recovery set id, recovery data)} for the recovery slice packets of the
+    par2 files in directory."""
+    packets = {}
+    for name in os.listdir(directory):
+        if not create_par2.is_par2_file(name):
+            continue
+        with open(os.path.join(directory, name), "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset < len(data):
+            magic, length, packet_hash, set_id, packet_type = create_par2.PAR2_PACKET_HEADER.unpack_from(
+                    data, offset)
+            if packet_type == create_par2.PAR2_RECOVERY_SLICE_PACKET:
+                body = data[offset + create_par2.PAR2_PACKET_HEADER.size:offset + length]
+                packets[struct.unpack("<I", body[:4])[0]] = (set_id, body[4:])
+            offset += length
+    return packets
+
+
+def run_script(args, cwd):
+    with open(os.devnull, "wb") as devnull:
+        subprocess.check_call([sys.executable, SCRIPT] + args, cwd=cwd, stdout=devnull)
+
+
+class BlockSizeTest(unittest.TestCase):
+
+    REDUNDANCY = fractions.Fraction(1, 5)
+
+    def get_candidates(self, sizes, max_num_blocks=create_par2.MAX_NUM_BLOCKS_PER_RECOVERY_SET):
+        file_sizes = dict(("file%d" % i, size) for i, size in enumerate(sizes))
+        return create_par2.get_block_size_candidates(file_sizes, self.REDUNDANCY, max_num_blocks)
+
+    def test_empty_files(self):
+        candidates = self.get_candidates([0] * 5)
+        self.assertEqual([(c.block_size, c.num_blocks) for c in candidates], [(4096, 0)])
+
+    def test_single_file(self):
+        for size in [1, 3, 4096, 1000003]:
+            candidates = self.get_candidates([size])
+            self.assertTrue(candidates)
+            for c in candidates:
+                self.assertEqual(c.block_size % 4, 0)
+                self.assertEqual(c.num_blocks, create_par2.get_total_num_blocks([size], c.block_size))
+
+    def test_candidates_are_exact_and_within_limit(self):
+        rng = random.Random(1)
+        sizes = [rng.randint(0, 3000000) for i in range(500)]
+        candidates = self.get_candidates(sizes, max_num_blocks=2000)
+        self.assertTrue(candidates)
+        self.assertEqual(candidates, sorted(candidates, key=lambda c: c.score))
+        for c in candidates:
+            self.assertEqual(c.block_size % 4, 0)
+            self.assertEqual(c.num_blocks, create_par2.get_total_num_blocks(sizes, c.block_size))
+            self.assertLessEqual(c.num_blocks, 2000)
+
+    def test_block_size_divides_part_size(self):
+        rng = random.Random(7)
+        part_size = 1024 * 1024
+        sizes = [part_size] * 40 + [rng.randint(1, part_size) for i in range(10)] + [
+                rng.randint(1, 300000) for i in range(300)]
+        for part_size in [part_size, 3 * part_size]:
+            file_sizes = dict(("file%d" % i, size) for i, size in enumerate(sizes + [part_size]))
+            candidates = create_par2.get_block_size_candidates(file_sizes, self.REDUNDANCY, 2000,
+                    part_size=part_size)
+            self.assertTrue(candidates)
+            for c in candidates:
+                self.assertEqual(part_size % c.block_size, 0)
+                self.assertEqual(c.block_size % 4, 0)
+        self.assertEqual(create_par2.get_divisors_of_multiple_of_4(24), [4, 8, 12, 24])
+
+    def test_total_num_blocks_of_sorted(self):
+        rng = random.Random(2)
+        for sizes in [[], [0], [0, 0, 0], [1], [4096, 4096, 4097],
+                      sorted(rng.randint(0, 100000) for i in range(1000)),
+                      sorted(rng.choice([0, 1, 4095, 4096, 4097, 8192]) for i in range(100))]:
+            for block_size in [4, 100, 4096, 4100, 65536]:
+                self.assertEqual(create_par2.get_total_num_blocks_of_sorted(sizes, block_size),
+                        create_par2.get_total_num_blocks(sizes, block_size), (sizes[:10], block_size))
+
+
+class AnalyticVerifyTest(unittest.TestCase):
+
+    SET_ID = b"0123456789abcdef"
+    SLICE_SIZE = 1024
+    # Data file, its size and the recovery block exponents of each volume.
+    VOLUMES = [("a", 3000, [0, 1]), ("b", 2048, [2, 3]), ("c", 1, [4])]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_create_par2_")
+        file_ids = [struct.pack("<16s", name.encode("ascii")) for name, size, exponents in self.VOLUMES]
+        critical = create_par2.make_par2_packet(self.SET_ID, create_par2.PAR2_MAIN_PACKET,
+                struct.pack("<QI", self.SLICE_SIZE, len(file_ids)) + b"".join(file_ids))
+        for file_id, (name, size, exponents) in zip(file_ids, self.VOLUMES):
+            critical += create_par2.make_par2_packet(self.SET_ID, create_par2.PAR2_FILE_DESCRIPTION_PACKET,
+                    struct.pack("<16s16s16sQ", file_id, b"\0" * 16, b"\0" * 16, size) +
+                    create_par2.pad_to_multiple_of_4(name.encode("ascii")))
+        for i, (name, size, exponents) in enumerate(self.VOLUMES):
+            volume = os.path.join(self.tmpdir, "vol_%d" % (i + 1))
+            os.makedirs(volume)
+            with open(os.path.join(volume, name), "wb") as f:
+                f.truncate(size)
+            with open(os.path.join(volume, "vol.par2"), "wb") as f:
+                f.write(critical)
+            with open(os.path.join(volume, "vol.vol%d+%d.par2" % (exponents[0], len(exponents))), "wb") as f:
+                for exponent in exponents:
+                    f.write(create_par2.make_par2_packet(self.SET_ID, create_par2.PAR2_RECOVERY_SLICE_PACKET,
+                            struct.pack("<I", exponent) + b"\0" * self.SLICE_SIZE))
+                f.write(critical)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_volume_dirs(self):
+        return create_par2.get_dest_dirs(self.tmpdir, "vol_", len(self.VOLUMES))
+
+    def test_count_blocks_per_volume(self):
+        blocks = create_par2.count_blocks_per_volume(create_par2.list_volume_files(self.get_volume_dirs()))
+        self.assertEqual(list(blocks), ["vol.par2"])
+        data_blocks, recovery_exponents, missing_names = blocks["vol.par2"]
+        self.assertEqual(data_blocks, [3, 2, 1])
+        self.assertEqual(recovery_exponents, [set([0, 1]), set([2, 3]), set([4])])
+        self.assertEqual(missing_names, [])
+        self.assertEqual(create_par2.find_unrecoverable_volume_losses(data_blocks, recovery_exponents, 1), [])
+        self.assertEqual(create_par2.find_unrecoverable_volume_losses(data_blocks, recovery_exponents, 2),
+                [(0, 1), (0, 2), (1, 2)])
+
+    def test_verify(self):
+        with open(os.devnull, "w") as devnull:
+            stdout = sys.stdout
+            sys.stdout = devnull
+            try:
+                create_par2.verify(self.tmpdir, "vol_", len(self.VOLUMES), max_lost_volumes=1)
+                self.assertRaises(SystemExit, create_par2.verify, self.tmpdir, "vol_", len(self.VOLUMES),
+                        max_lost_volumes=2)
+                # A data file that is in no volume can't be restored whatever is lost.
+                os.remove(os.path.join(self.get_volume_dirs()[2], "c"))
+                self.assertRaises(SystemExit, create_par2.verify, self.tmpdir, "vol_", len(self.VOLUMES),
+                        max_lost_volumes=1)
+            finally:
+                sys.stdout = stdout
+
+
+class CompressionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_create_par2_")
+        self.cache_dir = os.path.join(self.tmpdir, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_file(self, name, data, mtime=None):
+        path = os.path.join(self.tmpdir, name)
+        create_par2.make_parent_dirs(path)
+        with open(path, "wb") as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def read_file(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def store_archive(self, cache, infile, data, password=None):
+        """Stores data as the archive of infile, as compress_file does after running 7z."""
+        key = cache.get_key(infile, password)
+        self.assertFalse(cache.fetch(key, os.path.join(self.tmpdir, "unused.7z"), 0))
+        cache.store(key, self.write_file("archive.7z", data))
+        os.remove(os.path.join(self.tmpdir, "archive.7z"))
+        return key
+
+    def test_keys(self):
+        cache = create_par2.CompressionCache(self.cache_dir, 1000000)
+        a = self.write_file("a/file", b"contents")
+        key = cache.get_key(a, None)
+        # The key only depends on the contents and the name of the file, not on its directory.
+        self.assertEqual(cache.get_key(self.write_file("b/file", b"contents"), None), key)
+        self.assertNotEqual(cache.get_key(self.write_file("b/other", b"contents"), None), key)
+        self.assertNotEqual(cache.get_key(self.write_file("c/file", b"Contents"), None), key)
+        self.assertNotEqual(cache.get_key(a, None, ["-mx0"]), key)
+        self.assertNotEqual(cache.get_key(a, "password"), key)
+        self.assertNotEqual(cache.get_key(a, "password"), cache.get_key(a, "passwore"))
+
+    def test_hit_after_save(self):
+        cache = create_par2.CompressionCache(self.cache_dir, 1000000)
+        infile = self.write_file("file", b"contents")
+        key = self.store_archive(cache, infile, b"archive", password="secret")
+        cache.save()
+
+        cache = create_par2.CompressionCache(self.cache_dir, 1000000)
+        self.assertEqual(cache.get_key(infile, "secret"), key)
+        outfile = os.path.join(self.tmpdir, "out.7z")
+        self.assertTrue(cache.fetch(key, outfile, 8))
+        self.assertEqual(self.read_file(outfile), b"archive")
+        self.assertEqual((cache.num_hits, cache.num_misses, cache.bytes_saved), (1, 0, 8))
+
+    def test_miss_after_change(self):
+        cache = create_par2.CompressionCache(self.cache_dir, 1000000)
+        infile = self.write_file("file", b"contents", mtime=1000000)
+        key = self.store_archive(cache, infile, b"archive")
+        cache.save()
+
+        # The same size, but a new modification time, so the contents are hashed again.
+        self.write_file("file", b"Contents", mtime=2000000)
+        cache = create_par2.CompressionCache(self.cache_dir, 1000000)
+        changed_key = cache.get_key(infile, None)
+        self.assertNotEqual(changed_key, key)
+        self.assertFalse(cache.fetch(changed_key, os.path.join(self.tmpdir, "out.7z"), 8))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "out.7z")))
+
+        # A damaged archive in the cache is not used either.
+        self.write_file("file", b"contents", mtime=1000000)
+        self.assertEqual(cache.get_key(infile, None), key)
+        with open(cache.get_object_path(key), "ab") as f:
+            f.write(b"more")
+        self.assertFalse(cache.fetch(key, os.path.join(self.tmpdir, "out.7z"), 8))
+
+    def test_least_recently_used_are_evicted(self):
+        cache = create_par2.CompressionCache(self.cache_dir, 250)
+        keys = []
+        for i in range(3):
+            keys.append(self.store_archive(cache, self.write_file("file%d" % i, b"%d" % i), b"x" * 100))
+            cache.index["objects"][keys[-1]]["last_used"] = 1000 + i
+        # The first archive is used again, so the second is the least recently used one.
+        self.assertTrue(cache.fetch(keys[0], os.path.join(self.tmpdir, "out.7z"), 1))
+        cache.save()
+        self.assertEqual([os.path.isfile(cache.get_object_path(key)) for key in keys], [True, False, True])
+        cache = create_par2.CompressionCache(self.cache_dir, 250)
+        self.assertEqual(sorted(cache.index["objects"]), sorted([keys[0], keys[2]]))
+
+
+class CompressionPolicyTest(unittest.TestCase):
+
+    TEXT = b"".join(b"line %d of some repetitive text\n" % i for i in range(100000))
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_create_par2_")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_file(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def get_switches(self, policy, path):
+        return policy.get_switches(path, os.path.getsize(path))
+
+    def test_decisions(self):
+        policy = create_par2.CompressionPolicy(level=7, threads=2)
+        random_file = self.write_file("random", os.urandom(2000000))
+        text_file = self.write_file("text", self.TEXT)
+        small_random_file = self.write_file("small_random", os.urandom(1000))
+        small_text_file = self.write_file("small_text", self.TEXT[:1000])
+        # The samples skip the start of the file, which compresses well in e.g. JPEG files.
+        jpeg_like_file = self.write_file("jpeg_like", self.TEXT[:20000] + os.urandom(1000000))
+        empty_file = self.write_file("empty", b"")
+        # The small files are compressed whole, being smaller than a sample.
+        self.assertGreater(create_par2.COMPRESSION_SAMPLE_SIZE, 1000)
+
+        self.assertEqual(self.get_switches(policy, random_file), ["-mx0"])
+        self.assertEqual(self.get_switches(policy, text_file), ["-mx7", "-mmt2"])
+        self.assertEqual(self.get_switches(policy, small_random_file), ["-mx0"])
+        self.assertEqual(self.get_switches(policy, small_text_file), ["-mx7", "-mmt2"])
+        self.assertEqual(self.get_switches(policy, jpeg_like_file), ["-mx0"])
+        self.assertEqual(self.get_switches(policy, empty_file), ["-mx7", "-mmt2"])
+
+        self.assertTrue(policy.describe(random_file).startswith("stored, samples compressed to"))
+        self.assertTrue(policy.describe(text_file).startswith("level 7, samples compressed to"))
+        (num_stored, stored_bytes), (num_compressed, compressed_bytes) = policy.get_totals()
+        self.assertEqual((num_stored, stored_bytes), (3, 2000000 + 1000 + 20000 + 1000000))
+        self.assertEqual((num_compressed, compressed_bytes), (3, len(self.TEXT) + 1000))
+
+    def test_without_sampling(self):
+        policy = create_par2.CompressionPolicy(sample=False)
+        random_file = self.write_file("random", os.urandom(100000))
+        self.assertEqual(self.get_switches(policy, random_file), [])
+        self.assertEqual(policy.describe(random_file), "compressed")
+
+
+class DistributeFilesTest(unittest.TestCase):
+
+    def check_distribution(self, sizes, num_bins, last_bin_size_fraction=1, weights=None):
+        bins, bin_sizes = create_par2.distribute_files_uniformly(sizes, num_bins, last_bin_size_fraction,
+                weights)
+        self.assertEqual(len(bins), num_bins)
+        self.assertEqual(sorted(f for b in bins for f in b), sorted(sizes))
+        self.assertEqual(bin_sizes, [sum(sizes[f] for f in b) for b in bins])
+
+        weights = weights or sizes
+        capacities = [1.0] * (num_bins - 1) + [float(last_bin_size_fraction)]
+        loads = [sum(weights[f] for f in b) / c for b, c in zip(bins, capacities)]
+        ideal = sum(weights.values()) / sum(capacities)
+        self.assertLessEqual(max(loads), ideal + max(weights.values()) / min(capacities))
+        return bins, loads
+
+    def test_balanced(self):
+        rng = random.Random(3)
+        sizes = dict(("file%d" % i, rng.randint(1, 10000)) for i in range(300))
+        bins, loads = self.check_distribution(sizes, 7)
+        self.assertLess(max(loads) - min(loads), 0.01 * max(loads))
+
+    def test_last_bin_size_fraction(self):
+        rng = random.Random(4)
+        sizes = dict(("file%d" % i, rng.randint(1, 1000)) for i in range(400))
+        bins, loads = self.check_distribution(sizes, 5, last_bin_size_fraction=0.25)
+        bin_sizes = [sum(sizes[f] for f in b) for b in bins]
+        self.assertAlmostEqual(float(bin_sizes[-1]) / max(bin_sizes[:-1]), 0.25, delta=0.02)
+
+    def test_weights(self):
+        rng = random.Random(5)
+        sizes = dict(("file%d" % i, rng.randint(1, 100000)) for i in range(200))
+        weights = create_par2.get_block_weights(sizes, 4096)
+        self.check_distribution(sizes, 4, weights=weights)
+
+    def test_few_files(self):
+        self.check_distribution({"a": 10, "b": 1}, 3)
+        self.check_distribution({"a": 10, "b": 10, "c": 10}, 3, last_bin_size_fraction=0.5)
+
+    def test_local_search(self):
+        # All in one bin to start with; moves and a swap reach the even 9 + 9 split.
+        bin_items = [[(2, 0), (3, 1), (4, 2), (8, 3)], [(1, 4)]]
+        bin_loads = [17, 1]
+        create_par2.improve_bins_by_local_search(bin_items, bin_loads, [1.0, 1.0], max_iterations=100)
+        self.assertEqual(bin_loads, [9, 9])
+        self.assertEqual(bin_loads, [sum(weight for weight, key in items) for items in bin_items])
+        self.assertEqual(sorted(item for items in bin_items for item in items),
+                [(1, 4), (2, 0), (3, 1), (4, 2), (8, 3)])
+        for items in bin_items:
+            self.assertEqual(items, sorted(items))
+
+    def test_local_search_with_capacities(self):
+        bin_items = [[(1, i) for i in range(30)], []]
+        bin_loads = [30, 0]
+        create_par2.improve_bins_by_local_search(bin_items, bin_loads, [1.0, 0.5], max_iterations=100)
+        self.assertEqual(bin_loads, [20, 10])
+
+
+class SplitFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_create_par2_")
+        self.indir = os.path.join(self.tmpdir, "in")
+        os.makedirs(os.path.join(self.indir, "sub"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_split_threshold(self):
+        self.assertEqual(create_par2.get_split_threshold(1000, 5, 1), 250)
+        self.assertEqual(create_par2.get_split_threshold(1000, 4, fractions.Fraction(1, 2)), 285)
+
+    def test_plan(self):
+        file_sizes = {"a": 100, "b": 101, "c": 250, "d": 0}
+        split = create_par2.plan_split_files(sorted(file_sizes), file_sizes, 100)
+        self.assertEqual(split, [
+                ("b", [("b.part001", 0, 100), ("b.part002", 100, 1)]),
+                ("c", [("c.part001", 0, 100), ("c.part002", 100, 100), ("c.part003", 200, 50)])])
+        # Only the files above the threshold are split, into parts of the part size.
+        split = create_par2.plan_split_files(sorted(file_sizes), file_sizes, 100, threshold=200)
+        self.assertEqual([infile for infile, parts in split], ["c"])
+        file_sizes = {"e": 1000 * 100}
+        split = create_par2.plan_split_files(["e"], file_sizes, 100)
+        self.assertEqual(split[0][1][-1], ("e.part1000", 99900, 100))
+
+    def test_split_and_join(self):
+        data = {"big": os.urandom(10000), os.path.join("sub", "other"): os.urandom(8192)}
+        file_sizes = {}
+        for name, contents in data.items():
+            path = os.path.join(self.indir, name)
+            with open(path, "wb") as f:
+                f.write(contents)
+            file_sizes[path] = len(contents)
+        split = create_par2.plan_split_files(sorted(file_sizes), file_sizes, 4096)
+        partsdir = os.path.join(self.tmpdir, "parts")
+        part_paths = create_par2.split_files(split, self.indir, partsdir)
+        self.assertEqual(len(part_paths), 3 + 2)
+        for infile, parts in split:
+            for part, offset, length in parts:
+                self.assertEqual(os.path.getsize(part_paths[part]), length)
+        self.assertEqual(os.path.getsize(os.path.join(partsdir, "big.part003")), 10000 - 2 * 4096)
+
+        manifest = os.path.join(self.tmpdir, create_par2.SPLIT_MANIFEST_FILENAME)
+        create_par2.write_split_manifest([self.tmpdir], split, self.indir)
+        entries = create_par2.parse_split_manifest(manifest)
+        self.assertEqual(sorted(entries), [("big", 10000, 3), (os.path.join("sub", "other"), 8192, 2)])
+        self.assertEqual(create_par2.join_split_files(partsdir, entries), [])
+        for name, contents in data.items():
+            with open(os.path.join(partsdir, name), "rb") as f:
+                self.assertEqual(f.read(), contents)
+        self.assertEqual(sorted(create_par2.list_files(partsdir)), sorted(data))
+
+    def test_join_with_missing_part(self):
+        os.makedirs(os.path.join(self.tmpdir, "parts"))
+        partsdir = os.path.join(self.tmpdir, "parts")
+        with open(os.path.join(partsdir, "f.part001"), "wb") as f:
+            f.write(b"x" * 10)
+        self.assertEqual(create_par2.join_split_files(partsdir, [("f", 15, 2)]), ["f"])
+        self.assertEqual(os.listdir(partsdir), ["f.part001"])
+
+
+class PackFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_create_par2_")
+        self.indir = os.path.join(self.tmpdir, "in")
+        os.makedirs(os.path.join(self.indir, "sub"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_files(self, sizes):
+        file_sizes = {}
+        for name, size in sizes.items():
+            path = os.path.join(self.indir, name)
+            with open(path, "wb") as f:
+                f.write(os.urandom(size))
+            file_sizes[path] = size
+        return file_sizes
+
+    def test_plan(self):
+        join = os.path.join
+        file_sizes = dict((join("d", "f%d" % i), 1000) for i in range(10))
+        file_sizes.update({join("d", "big"): 5000, join("e", "g"): 10, join("f", "x"): 10, join("f", "y"): 10})
+        packed = create_par2.plan_packed_files(sorted(file_sizes), file_sizes, 5000, 8192)
+        # A member of 1000 bytes takes 1536 bytes, so 4 fit with the end of the archive. The file
+        # of 5000 bytes and the file alone in its directory are not packed.
+        self.assertEqual([len(files) for container, size, files in packed], [4, 4, 2, 2])
+        for container, size, files in packed:
+            self.assertEqual(os.path.dirname(container), os.path.dirname(files[0]))
+            self.assertTrue(all(os.path.dirname(f) == os.path.dirname(files[0]) for f in files))
+            self.assertGreaterEqual(size, create_par2.TAR_END_SIZE + sum(
+                    create_par2.get_tar_member_size(os.path.basename(f), file_sizes[f]) for f in files))
+        self.assertEqual([size for container, size, files in packed[:-1]], [8192] * (len(packed) - 1))
+        # The last container is padded to a multiple of 1/16 of the container size.
+        self.assertEqual(packed[-1][1] % 512, 0)
+        self.assertLess(packed[-1][1], 8192)
+        self.assertEqual(packed[-1][2], [join("f", "x"), join("f", "y")])
+        packed_files = [f for container, size, files in packed for f in files]
+        self.assertEqual(sorted(packed_files), sorted(set(file_sizes) - set([join("d", "big"), join("e", "g")])))
+        self.assertEqual(len(set(container for container, size, files in packed)), len(packed))
+
+    def test_pack_and_unpack(self):
+        file_sizes = self.write_files({"a": 0, "b": 511, "c": 512, "d": 3000,
+                                       os.path.join("sub", "e"): 700, os.path.join("sub", "f"): 1})
+        packed = create_par2.plan_packed_files(sorted(file_sizes), file_sizes, 4096, 16384)
+        self.assertEqual(len(packed), 2)
+        packdir = os.path.join(self.tmpdir, "pack")
+        container_paths = create_par2.pack_files(packed, self.indir, packdir)
+        for container, size, files in packed:
+            self.assertEqual(os.path.getsize(container_paths[container]), size)
+
+        create_par2.write_packed_manifest([self.tmpdir], packed, self.indir)
+        entries = create_par2.parse_packed_manifest(os.path.join(self.tmpdir,
+                create_par2.PACKED_MANIFEST_FILENAME))
+        self.assertEqual(sorted(entries), [(create_par2.PACKED_CONTAINER_NAME % 1, 4),
+                                           (os.path.join("sub", create_par2.PACKED_CONTAINER_NAME % 2), 2)])
+        self.assertEqual(create_par2.unpack_containers(packdir, entries), [])
+        for path in file_sizes:
+            name = os.path.relpath(path, self.indir)
+            self.assertTrue(filecmp.cmp(path, os.path.join(packdir, name), shallow=False), name)
+            self.assertEqual(int(os.path.getmtime(os.path.join(packdir, name))), int(os.path.getmtime(path)))
+        self.assertEqual(sorted(create_par2.list_files(packdir)),
+                sorted(os.path.relpath(path, self.indir) for path in file_sizes))
+
+    def test_container_too_small(self):
+        file_sizes = self.write_files({"a": 1000, "b": 1000})
+        path = os.path.join(self.tmpdir, "container.tar")
+        self.assertRaises(IOError, create_par2.write_tar_container, path, sorted(file_sizes), 2048)
+        self.assertFalse(os.path.exists(path))
+
+    def test_unpack_does_not_overwrite(self):
+        file_sizes = self.write_files({"a": 10, "b": 20})
+        path = os.path.join(self.tmpdir, "container.tar")
+        create_par2.write_tar_container(path, sorted(file_sizes), 10240)
+        with open(os.path.join(self.tmpdir, "b"), "wb") as f:
+            f.write(b"existing")
+        self.assertEqual(create_par2.unpack_containers(self.tmpdir, [("container.tar", 2)]), ["container.tar"])
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "a")))
+        with open(os.path.join(self.tmpdir, "b"), "rb") as f:
+            self.assertEqual(f.read(), b"existing")
+        # A wrong number of files in the manifest is refused as well.
+        os.remove(os.path.join(self.tmpdir, "b"))
+        self.assertEqual(create_par2.unpack_containers(self.tmpdir, [("container.tar", 3)]), ["container.tar"])
+
+
+def read_iso_directory(image, sector, size):
+    """Returns the (identifier, flags, sector, size) of the directory records of the directory at
+    sector, without the records for the directory itself and its parent."""
+    records = []
+    image.seek(sector * create_par2.ISO_SECTOR_SIZE)
+    data = image.read(size)
+    offset = 0
+    while offset < len(data):
+        length = struct.unpack_from("<B", data, offset)[0]
+        if length == 0:
+            # The rest of the sector is padding.
+            offset += -offset % create_par2.ISO_SECTOR_SIZE
+            continue
+        record = data[offset:offset + length]
+        extent, extent_size = struct.unpack_from("<I", record, 2)[0], struct.unpack_from("<I", record, 10)[0]
+        # Both byte orders must agree.
+        assert struct.unpack_from(">I", record, 6)[0] == extent and struct.unpack_from(">I", record, 14)[0] == extent_size
+        identifier = record[33:33 + struct.unpack_from("<B", record, 32)[0]]
+        if identifier not in (b"\0", b"\1"):
+            records.append((identifier, struct.unpack_from("<B", record, 25)[0], extent, extent_size))
+        offset += length
+    return records
+
+
+def read_iso_tree(image, descriptor_sector, decode):
+    """Returns {path: data} of the files in the tree of the volume descriptor at
+    descriptor_sector, following the multi-extent records of large files, and the path table
+    as a list of (identifier, sector, parent number)."""
+    image.seek(descriptor_sector * create_par2.ISO_SECTOR_SIZE)
+    descriptor = image.read(create_par2.ISO_SECTOR_SIZE)
+    root = descriptor[156:156 + 34]
+    path_table_size = struct.unpack_from("<I", descriptor, 132)[0]
+    l_path_table, m_path_table = struct.unpack_from("<I", descriptor, 140)[0], struct.unpack_from(">I", descriptor, 148)[0]
+    path_tables = []
+    for sector, byte_order in [(l_path_table, "<"), (m_path_table, ">")]:
+        image.seek(sector * create_par2.ISO_SECTOR_SIZE)
+        data = image.read(path_table_size)
+        entries = []
+        offset = 0
+        while offset < len(data):
+            length, extended, extent, parent = struct.unpack_from(byte_order + "BBIH", data, offset)
+            entries.append((data[offset + 8:offset + 8 + length], extent, parent))
+            offset += 8 + length + length % 2
+        path_tables.append(entries)
+    assert path_tables[0] == path_tables[1]
+
+    files = {}
+    directories = [("", struct.unpack_from("<I", root, 2)[0], struct.unpack_from("<I", root, 10)[0])]
+    while directories:
+        path, sector, size = directories.pop()
+        pending = b""
+        for identifier, flags, extent, extent_size in read_iso_directory(image, sector, size):
+            name = os.path.join(path, decode(identifier))
+            if flags & 2:
+                directories.append((name, extent, extent_size))
+                continue
+            image.seek(extent * create_par2.ISO_SECTOR_SIZE)
+            pending += image.read(extent_size)
+            if not flags & 0x80:
+                files[name] = pending
+                pending = b""
+    return files, path_tables[0]
+
+
+class IsoImageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_create_par2_")
+        self.volume = os.path.join(self.tmpdir, "vol_1")
+        self.contents = {
+            "MD5SUM": b"",
+            "photo 1.jpg": os.urandom(5000),
+            os.path.join("sub", "b.bin"): os.urandom(2048),
+            os.path.join("sub", "deeper", "c"): os.urandom(1),
+            os.path.join("sub", "deeper", "C"): os.urandom(3000),
+            os.path.join("other", "long name with spaces.tar.7z"): os.urandom(100),
+        }
+        for name, data in self.contents.items():
+            path = os.path.join(self.volume, name)
+            create_par2.make_parent_dirs(path)
+            with open(path, "wb") as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_image(self):
+        files = create_par2.list_volume_files([self.volume])[0]
+        predicted = create_par2.IsoImage(files, "vol_1", dict((name, len(self.contents[name]))
+                                                              for name, path in files))
+        image = create_par2.IsoImage(files, "vol_1")
+        self.assertEqual(predicted.size, image.size)
+        iso_path = self.volume + ".iso"
+        image.write(iso_path)
+        self.assertEqual(os.path.getsize(iso_path), image.size)
+        return iso_path
+
+    def check_image(self, iso_path):
+        with open(iso_path, "rb") as image:
+            files, path_table = read_iso_tree(image, 17, lambda identifier: identifier.decode("utf-16-be"))
+            self.assertEqual(files, self.contents)
+            # The root is identified by a single zero byte in both path tables.
+            self.assertEqual([(identifier, parent) for identifier, extent, parent in path_table],
+                    [(b"\0", 1), (u"other".encode("utf-16-be"), 1), (u"sub".encode("utf-16-be"), 1),
+                     (u"deeper".encode("utf-16-be"), 3)])
+
+            # The primary tree has the same files under ISO 9660 identifiers.
+            files, path_table = read_iso_tree(image, 16, lambda identifier: identifier.decode("ascii"))
+            self.assertEqual(sorted(files.values()), sorted(self.contents.values()))
+            self.assertEqual(sorted(files), sorted([
+                    "MD5SUM.;1", "PHOTO_1.JPG;1", os.path.join("SUB", "B.BIN;1"),
+                    os.path.join("SUB", "DEEPER", "C.;1"), os.path.join("SUB", "DEEPER", "C_1.;1"),
+                    os.path.join("OTHER", "LONG_NAME_WITH_SPACES_TAR.7Z;1")]))
+            self.assertEqual([identifier for identifier, extent, parent in path_table],
+                    [b"\0", b"OTHER", b"SUB", b"DEEPER"])
+
+    def test_image(self):
+        iso_path = self.write_image()
+        self.check_image(iso_path)
+        for program, args in [("isoinfo", ["-J", "-l", "-i"]), ("xorriso", ["-indev"]), ("bsdtar", ["-tf"])]:
+            if find_executable(program):
+                with open(os.devnull, "wb") as devnull:
+                    self.assertEqual(subprocess.call([program] + args + [iso_path], stdout=devnull,
+                            stderr=devnull), 0, program)
+                if program == "bsdtar":
+                    listing = subprocess.check_output([program, "-tf", iso_path]).decode("utf-8").split("\n")
+                    for name in self.contents:
+                        self.assertIn(name, listing)
+
+    def test_multi_extent_files(self):
+        # Files larger than an extent are stored in several, here with a small extent size
+        # instead of 4 GiB.
+        max_extent_size = create_par2.ISO_MAX_EXTENT_SIZE
+        create_par2.ISO_MAX_EXTENT_SIZE = 2 * create_par2.ISO_SECTOR_SIZE
+        try:
+            self.check_image(self.write_image())
+        finally:
+            create_par2.ISO_MAX_EXTENT_SIZE = max_extent_size
+
+
+class PlanTest(unittest.TestCase):
+
+    def make_plan(self, sizes, num_volumes=5, **kwargs):
+        infiles = sorted(sizes)
+        num_sets = create_par2.get_num_recovery_sets(sizes, num_volumes, fractions.Fraction(1, num_volumes))
+        infiles_per_set = create_par2.split_into_recovery_sets(infiles, sizes, num_sets)
+        return create_par2.make_plan(infiles_per_set, sizes, "vol_", num_volumes, 1, False, **kwargs)
+
+    def test_empty_files(self):
+        plan = self.make_plan(dict(("f%d" % i, 0) for i in range(5)), num_volumes=3)
+        self.assertEqual([(s["block_size"], s["num_blocks"], s["num_recovery_blocks"])
+                          for s in plan["recovery_sets"]], [(4096, 0, 0)])
+
+    def test_even_shares_match_packing(self):
+        rng = random.Random(6)
+        sizes = dict((os.path.join("d%d" % (i % 7), "sub %d" % (i % 3), "f%04d.jpg" % i), rng.randint(0, 200000))
+                     for i in range(2000))
+        plan = self.make_plan(sizes, iso=True, names=dict((name, name) for name in sizes))
+        self.assertEqual(len(plan["recovery_sets"]), 1)
+        recovery_set = plan["recovery_sets"][0]
+
+        # Pack the files and par2 files of the recovery set one by one instead, and lay out the
+        # images of the volumes.
+        par2_file_sizes = create_par2.estimate_par2_file_sizes(recovery_set["par2_filename"], sizes,
+                recovery_set["block_size"], recovery_set["num_recovery_blocks"])
+        index_size = par2_file_sizes.pop(recovery_set["par2_filename"])[0]
+        all_sizes = dict(sizes)
+        all_sizes.update((name, size) for name, (size, count) in par2_file_sizes.items())
+        weights = dict((name, (size + recovery_set["block_size"] - 1) // recovery_set["block_size"])
+                       for name, size in sizes.items())
+        weights.update((name, count) for name, (size, count) in par2_file_sizes.items())
+        bins, bin_sizes = create_par2.distribute_files_uniformly(all_sizes, 5, 1, weights)
+        # The rest is the MD5SUM files, with a line for each file.
+        md5sum_size = (sum(plan["volume_sizes"]) - sum(bin_sizes) - 5 * index_size) // 5
+        self.assertLess(abs(md5sum_size - (len(all_sizes) // 5 + 1) * (32 + 2 + len("vol_") + 20)), 100)
+        common_files = [(recovery_set["par2_filename"], index_size), (create_par2.MD5SUM_FILENAME, md5sum_size)]
+        self.assertLess(abs(max(plan["volume_sizes"]) - max(bin_sizes) - index_size - md5sum_size),
+                0.01 * max(plan["volume_sizes"]))
+
+        # The estimated images are as much larger than the volumes as the images laid out.
+        for current_bin, bin_size, volume_size, image_size in zip(bins, bin_sizes, plan["volume_sizes"],
+                                                                  plan["image_sizes"]):
+            files = [(name, all_sizes[name]) for name in current_bin] + common_files
+            image = create_par2.IsoImage([(name, None) for name, size in files], "", dict(files))
+            overhead = image.size - bin_size - index_size - md5sum_size
+            self.assertLess(abs(image_size - volume_size - overhead), 0.02 * overhead)
+
+    def test_large_file_is_packed(self):
+        sizes = dict(("f%04d" % i, 1000) for i in range(100))
+        sizes["large"] = 1000000
+        plan = self.make_plan(sizes)
+        self.assertGreaterEqual(max(plan["volume_sizes"]), 1000000)
+
+
+class StubArchiveJob(create_par2.ArchiveJob):
+    """An ArchiveJob whose stages only record the resources they run with."""
+
+    def __init__(self, options, name, usage, budget):
+        create_par2.ArchiveJob.__init__(self, options, name)
+        self.usage = usage
+        self.budget = budget
+
+    def run_stage(self, cores=0, memory=0, disk_streams=1):
+        # No more than an equal share per job that is left (or the minimum of the stage). The
+        # share only grows while the stage runs, as jobs finish.
+        with self.budget.condition:
+            num_active_jobs = self.budget.num_active_jobs
+        assert (cores or 0) <= max(1, self.budget.totals["cores"] // num_active_jobs), cores
+        assert (memory or 0) <= max(create_par2.MIN_BATCH_PAR2_MEMORY,
+                                    self.budget.totals["memory"] // num_active_jobs), memory
+        self.usage.start(cores or 0, memory or 0, disk_streams)
+        time.sleep(0.01)
+        self.usage.stop(cores or 0, memory or 0, disk_streams)
+
+    def plan(self):
+        self.run_stage()
+
+    def stage(self, password=None, jobs=None, memory=None):
+        self.run_stage(jobs, memory)
+
+    def par2(self, jobs=None, memory=None):
+        self.run_stage(jobs, memory)
+
+    def place(self):
+        self.run_stage()
+
+    def checksum(self, jobs=None):
+        self.run_stage()
+
+    def verify(self, jobs=None):
+        self.run_stage(jobs, disk_streams=0)
+
+    def finish(self):
+        self.run_stage(disk_streams=0)
+
+
+class ResourceUsage(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_use = [0, 0, 0]
+        self.max_in_use = [0, 0, 0]
+        self.grants = []
+
+    def start(self, *amounts):
+        with self.lock:
+            self.grants.append(amounts)
+            self.in_use = [n + amount for n, amount in zip(self.in_use, amounts)]
+            self.max_in_use = [max(n, m) for n, m in zip(self.in_use, self.max_in_use)]
+
+    def stop(self, *amounts):
+        with self.lock:
+            self.in_use = [n - amount for n, amount in zip(self.in_use, amounts)]
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_create_par2_")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_batch(self, args, cores, memory, disk_streams, num_jobs=5):
+        parser = argparse.ArgumentParser()
+        create_par2.add_archive_arguments(parser, batch=True)
+        usage = ResourceUsage()
+        budget = create_par2.ResourceBudget(cores, memory, disk_streams, num_jobs)
+        jobs = []
+        for i in range(num_jobs):
+            options = parser.parse_args(args + ["-o", self.tmpdir, "-j", str(cores), "3"])
+            options.indir = self.tmpdir
+            options.prefix = "dir%d " % i
+            jobs.append(StubArchiveJob(options, "dir%d" % i, usage, budget))
+        with open(os.devnull, "w") as devnull:
+            stdout = sys.stdout
+            sys.stdout = devnull
+            try:
+                succeeded = create_par2.run_batch_jobs(jobs, None, budget)
+            finally:
+                sys.stdout = stdout
+        self.assertEqual(succeeded, [True] * num_jobs)
+        self.assertEqual(budget.free, budget.totals)
+        self.assertEqual(usage.in_use, [0, 0, 0])
+        self.assertLessEqual(usage.max_in_use[0], cores)
+        self.assertLessEqual(usage.max_in_use[1], memory)
+        self.assertLessEqual(usage.max_in_use[2], disk_streams)
+        return usage
+
+    def test_budget_is_not_exceeded(self):
+        usage = self.run_batch(["-c"], cores=8, memory=2048, disk_streams=2)
+        # The plan and the six stages of each job.
+        self.assertEqual(len(usage.grants), 5 * 7)
+        self.assertEqual(usage.max_in_use[2], 2)
+
+    def test_pipeline_takes_memory_while_staging(self):
+        usage = self.run_batch(["--pipeline"], cores=4, memory=1024, disk_streams=1, num_jobs=3)
+        self.assertEqual(usage.max_in_use[2], 1)
+        self.assertTrue(all(memory >= create_par2.MIN_BATCH_PAR2_MEMORY for cores, memory, disk_streams in
+                usage.grants if memory))
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_create_par2_")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parallel_sets_are_bounded(self):
+        infiles_per_set = []
+        set_dirs = []
+        for i in range(6):
+            infile = os.path.join(self.tmpdir, "in%d" % i)
+            with open(infile, "wb") as f:
+                f.write(b"x" * i)
+            infiles_per_set.append([infile])
+            set_dirs.append(os.path.join(self.tmpdir, "set%d" % i))
+            os.mkdir(set_dirs[-1])
+        lock = threading.Lock()
+        running = [0]
+        max_running = [0]
+        done = []
+
+        def prepare_file(infile, set_dir):
+            outfile = os.path.join(set_dir, os.path.basename(infile))
+            shutil.copyfile(infile, outfile)
+            return outfile
+
+        def on_set_prepared(set_index):
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+                done.append(set_index)
+
+        files_per_set, md5_sums, prepared_time = create_par2.prepare_and_place_files(
+                infiles_per_set, set_dirs, prepare_file, on_set_prepared, jobs=4, max_bytes_in_flight=None,
+                queue_size=8, parallel_sets=2)
+        self.assertEqual(sorted(done), list(range(6)))
+        self.assertLessEqual(max_running[0], 2)
+        self.assertEqual(len(md5_sums), 6)
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_create_par2_")
+        self.path = os.path.join(self.tmpdir, "journal.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_file(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def record_files(self, num_files):
+        journal = create_par2.Journal(self.path, {"indir": self.tmpdir}, self.tmpdir)
+        journal.save()
+        files = []
+        for i in range(num_files):
+            infile = self.write_file("in%d" % i, b"input %d" % i)
+            outfile = self.write_file("out%d" % i, b"output %d" % i)
+            journal.record_prepared_file(infile, outfile, "name%d" % i, md5="%032x" % i)
+            files.append((infile, outfile))
+        journal.close_log()
+        return files
+
+    def test_load_with_cut_short_last_line(self):
+        files = self.record_files(3)
+        with open(self.path, "rb") as f:
+            data = f.read()
+        with open(self.path, "wb") as f:
+            f.write(data[:-10])
+        journal = create_par2.Journal.load(self.path)
+        self.assertEqual(journal.state["parameters"], {"indir": self.tmpdir})
+        self.assertEqual([journal.is_file_prepared(infile, outfile) for infile, outfile in files],
+                [True, True, False])
+        # The journal is written back as a single line, which loads the same.
+        with open(self.path) as f:
+            self.assertEqual(len(f.read().splitlines()), 1)
+        self.assertEqual(create_par2.Journal.load(self.path).state, journal.state)
+
+    def test_file_is_not_prepared_after_input_changes(self):
+        files = self.record_files(3)
+        journal = create_par2.Journal.load(self.path)
+        self.write_file("in0", b"changed input")
+        self.write_file("out1", b"changed output")
+        os.remove(files[2][1])
+        self.assertEqual([journal.is_file_prepared(infile, outfile) for infile, outfile in files],
+                [False, False, False])
+        self.assertFalse(journal.is_file_prepared(files[0][0], files[1][1]))
+
+    def test_password_verifier(self):
+        journal = create_par2.Journal(self.path, {"password_verifier":
+                create_par2.Journal.get_password_verifier("secret")}, self.tmpdir)
+        journal.save()
+        journal = create_par2.Journal.load(self.path)
+        self.assertTrue(journal.is_password_right("secret"))
+        self.assertFalse(journal.is_password_right("Secret"))
+        self.assertFalse(create_par2.Journal(None, {}, self.tmpdir).is_password_right("secret"))
+
+
+@unittest.skipUnless(find_executable("par2") and find_executable("7z"), "par2 and 7z are needed")
+class RestoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_create_par2_")
+        self.indir = os.path.join(self.tmpdir, "in")
+        self.outdir = os.path.join(self.tmpdir, "out")
+        os.makedirs(self.indir)
+        os.makedirs(self.outdir)
+        for i in range(12):
+            with open(os.path.join(self.indir, "file%02d.bin" % i), "wb") as f:
+                f.write(os.urandom(50000 + 7919 * i))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def create_volumes(self, *args):
+        run_script(["-i", self.indir, "-o", self.outdir, "-p", "vol_", "-f"] + list(args) + ["5"],
+                cwd=self.tmpdir)
+        return [os.path.join(self.outdir, "vol_%d" % (i+1)) for i in range(5)]
+
+    def assert_restored(self, volumes):
+        restored = os.path.join(self.tmpdir, "restored")
+        run_script(["restore", "-o", restored] + volumes, cwd=self.tmpdir)
+        names = sorted(os.listdir(self.indir))
+        self.assertEqual(sorted(os.listdir(restored)), names)
+        match, mismatch, errors = filecmp.cmpfiles(self.indir, restored, names, shallow=False)
+        self.assertEqual((mismatch, errors), ([], []))
+
+    def test_restore_after_volume_loss(self):
+        volumes = self.create_volumes()
+        shutil.rmtree(volumes[1])
+        data_files = sorted(name for name in os.listdir(volumes[2]) if name.startswith("file"))
+        # The file is replaced rather than changed in place, since it may be a hard link to the
+        # input file.
+        path = os.path.join(volumes[2], data_files[0])
+        with open(path, "rb") as f:
+            data = bytearray(f.read())
+        data[1000] ^= 1
+        os.remove(path)
+        with open(path, "wb") as f:
+            f.write(data)
+        self.assert_restored(volumes[:1] + volumes[2:])
+
+
+@unittest.skipUnless(create_par2.numpy is not None, "NumPy is needed")
+class Md5SumTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_create_par2_")
+        self.setdir = os.path.join(self.tmpdir, "set")
+        os.makedirs(os.path.join(self.setdir, "sub"))
+        self.names = ["file0.bin", "empty", os.path.join("sub", "file2.bin"), "back\\slash"]
+        for i, name in enumerate(self.names):
+            with open(os.path.join(self.setdir, name), "wb") as f:
+                f.write(os.urandom([10000, 0, 4096, 777][i]))
+        create_par2.create_par2_files_builtin(self.setdir, "vol.par2", 4, 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_md5sum_files_match_hashlib(self):
+        names = create_par2.list_files(self.setdir)
+        for i, name in enumerate(sorted(names)):
+            dest = os.path.join(self.tmpdir, "vol_%d" % (i % 3 + 1), name)
+            create_par2.make_parent_dirs(dest)
+            os.rename(os.path.join(self.setdir, name), dest)
+        volume_files = create_par2.list_volume_files(create_par2.get_dest_dirs(self.tmpdir, "vol_", 3))
+        expected = {}
+        for name, path in itertools.chain(*volume_files):
+            with open(path, "rb") as f:
+                expected[name] = hashlib.md5(f.read()).hexdigest()
+
+        # The MD5 sums of the data files come from the par2 files.
+        known = create_par2.get_known_md5_sums(volume_files)
+        self.assertEqual(sorted(known), sorted((name, os.path.getsize(path))
+                for name, path in itertools.chain(*volume_files) if not create_par2.is_par2_file(name)))
+        for (name, size), md5_hex in known.items():
+            self.assertEqual(md5_hex, expected[name], name)
+
+        create_par2.create_md5_sums(self.tmpdir, "vol_", 3, jobs=2)
+        for d, files in zip(create_par2.get_dest_dirs(self.tmpdir, "vol_", 3), volume_files):
+            md5sums = create_par2.parse_md5sum_file(os.path.join(d, create_par2.MD5SUM_FILENAME))
+            self.assertEqual(sorted((name, md5_hex) for md5_hex, name in md5sums),
+                    sorted((name, expected[name]) for name, path in files))
+
+
+@unittest.skipUnless(find_executable("par2") and create_par2.numpy is not None, "par2 and NumPy are needed")
+class BuiltinEngineTest(unittest.TestCase):
+
+    BLOCK_SIZE = 4096
+    NUM_RECOVERY_BLOCKS = 12
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_create_par2_")
+        self.builtin_dir = os.path.join(self.tmpdir, "builtin")
+        self.par2_dir = os.path.join(self.tmpdir, "par2")
+        os.makedirs(self.builtin_dir)
+        os.makedirs(self.par2_dir)
+        # Sizes that are not a whole number of blocks, so that the last block of a file is padded.
+        self.names = []
+        for i, size in enumerate([30000, 4096, 12345, 100]):
+            data = os.urandom(size)
+            name = "file%d.bin" % i
+            for d in (self.builtin_dir, self.par2_dir):
+                with open(os.path.join(d, name), "wb") as f:
+                    f.write(data)
+            self.names.append(name)
+        create_par2.create_par2_files_builtin(self.builtin_dir, "test.par2", self.NUM_RECOVERY_BLOCKS,
+                self.BLOCK_SIZE, jobs=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_par2_verifies_and_repairs(self):
+        self.assertEqual(run_par2(["verify", "--", "test.par2"], self.builtin_dir), 0)
+        original = os.path.join(self.par2_dir, self.names[0])
+        os.remove(os.path.join(self.builtin_dir, self.names[0]))
+        self.assertEqual(run_par2(["repair", "--", "test.par2"], self.builtin_dir), 0)
+        self.assertTrue(filecmp.cmp(original, os.path.join(self.builtin_dir, self.names[0]), shallow=False))
+
+    def test_same_recovery_packets_as_par2(self):
+        self.assertEqual(run_par2(["create", "-s%d" % self.BLOCK_SIZE, "-c%d" % self.NUM_RECOVERY_BLOCKS,
+                "--", "test.par2"] + self.names, self.par2_dir), 0)
+        expected = read_recovery_packets(self.par2_dir)
+        self.assertEqual(sorted(expected), list(range(self.NUM_RECOVERY_BLOCKS)))
+        self.assertEqual(read_recovery_packets(self.builtin_dir), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()